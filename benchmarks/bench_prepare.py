@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Micro-benchmark for the per-row overhead of InstanceGenerator.prepare.
+
+Compares the compiled preparation plan with the previous implementation
+which walked all model fields for every row. No database access is
+required. Run from the repository root:
+
+    python benchmarks/bench_prepare.py [rows]
+"""
+from __future__ import print_function
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+
+import django  # noqa: E402
+django.setup()
+
+from django.core.exceptions import ValidationError  # noqa: E402
+from django.db.models import ManyToOneRel  # noqa: E402
+
+from etl_sync.generators import (  # noqa: E402
+    InstanceGenerator, get_fields, get_internal_type)
+from tests.models import TestModel  # noqa: E402
+
+
+def legacy_prepare(generator, dic):
+    """InstanceGenerator.prepare before the preparation plan."""
+    ret = {}
+    back_refs = {}
+    for field in get_fields(generator.model_class):
+        if field.name not in dic:
+            continue
+        if isinstance(field, ManyToOneRel):
+            back_refs[field] = dic.pop(field.name)
+            continue
+        fieldtype = get_internal_type(field)
+        prepare_function = getattr(
+            generator, generator.preparations[fieldtype],
+            generator.prepare_field)
+        try:
+            res = prepare_function(field, dic.pop(field.name))
+        except ValidationError as e:
+            raise ValidationError({field.name: str(e.message)})
+        if res is not None:
+            if not res and getattr(field, 'null', False):
+                res = None
+            ret[field.name] = res
+    return ret, back_refs
+
+
+def main(rows=100000):
+    generator = InstanceGenerator(TestModel)
+    row = {'record': '1234', 'name': 'test', 'zahl': 17}
+    results = []
+    for name, function in [('legacy', legacy_prepare),
+                           ('plan', InstanceGenerator.prepare)]:
+        seconds = min(timeit.repeat(
+            lambda: function(generator, row.copy()), number=rows, repeat=3))
+        results.append(seconds)
+        print('{:<8} {:>8.3f} us/row'.format(name, seconds / rows * 1e6))
+    print('speedup  {:>8.2f}x'.format(results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
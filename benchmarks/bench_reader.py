@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Benchmark for reading and transforming tab-delimited files.
+
+Compares backports.csv.DictReader, the default of the Loader,
+with CSVReader and MmapCSVReader, reading alone and followed by
+Transformer.remap. Pass the path of a large tab-delimited file with a
+header line, or a number of rows to generate a temporary file. Run from the repository root:
+
+    python benchmarks/bench_reader.py [path or rows]
+"""
+from __future__ import print_function
+
+import io
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from backports import csv  # noqa: E402
+
+from etl_sync.readers import CSVReader, MmapCSVReader  # noqa: E402
+from etl_sync.transformations import Transformer  # noqa: E402
+
+COLUMNS = ['record', 'name', 'zahl', 'date', 'numero', 'nombre', 'text',
+           'latitude', 'longitude', 'remarks']
+
+
+class Remap(Transformer):
+    mappings = {'rec': 'record', 'number': 'zahl'}
+
+
+def generate(rows):
+    fil = tempfile.NamedTemporaryFile(
+        'w', suffix='.txt', delete=False, encoding='utf-8')
+    with fil:
+        fil.write(u'\t'.join(COLUMNS) + u'\n')
+        for index in range(rows):
+            fil.write(
+                u'{0}\tname {0}\t{1}\t2017-01-01\tuno\tun\tsome text with '
+                u'words\t37.87{0}\t-122.27{0}\t\n'.format(index, index % 97))
+    return fil.name
+
+
+def run(reader_class, path, transform):
+    start = time.time()
+    rows = 0
+    with io.open(path, encoding='utf-8', newline='') as fil:
+        reader = reader_class(
+            fil, delimiter=u'\t', quoting=csv.QUOTE_NONE)
+        for row in reader:
+            if transform:
+                Remap(row).remap(row)
+            rows += 1
+    return rows, time.time() - start
+
+
+def main(arg='200000'):
+    path = arg if os.path.isfile(arg) else generate(int(arg))
+    try:
+        size = os.path.getsize(path)
+        print('{} ({:.1f} MB)'.format(path, size / 1e6))
+        for transform in (False, True):
+            results = []
+            for name, reader_class in [('DictReader', csv.DictReader),
+                                       ('CSVReader', CSVReader),
+                                       ('MmapCSV', MmapCSVReader)]:
+                rows, seconds = run(reader_class, path, transform)
+                results.append(seconds)
+                print('{:<10} {:<10} {:>12,.0f} rows/s {:>8.1f} MB/s'.format(
+                    name, 'remap' if transform else 'read',
+                    rows / seconds, size / seconds / 1e6))
+            for name, seconds in zip(['CSVReader', 'MmapCSV'], results[1:]):
+                print('speedup {:<10}     {:>8.2f}x'.format(
+                    name, results[0] / seconds))
+    finally:
+        if path != arg:
+            os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,259 @@
+"""
+asyncio front ends for loaders and generators. The Django ORM is
+synchronous, batches are therefore written by a pool of threads, each
+with a database connection and a generator of its own, while the event
+loop keeps reading. The generators resolve related records with the
+concurrent option.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+from django.db import connections, router
+
+from .caches import atomic
+from .generators import InstanceGenerator
+from .loaders import Loader
+from .logging import StdoutLogger
+
+
+def is_sqlite(model_class):
+    return connections[router.db_for_write(model_class)].vendor == 'sqlite'
+
+
+def get_pool_options(model_class, options):
+    """
+    Returns:
+        tuple: The number of threads (max_concurrency option, defaults
+        to 4 or to 1 on SQLite) and the options of the pooled objects.
+    """
+    size = options.get('max_concurrency') or (
+        1 if is_sqlite(model_class) else 4)
+    return size, dict(options, concurrent=True)
+
+
+def close_connections(barrier):
+    """
+    Closes the database connections of a pool thread, the barrier makes
+    sure that each thread of the pool runs one call.
+    """
+    barrier.wait()
+    connections.close_all()
+
+
+class ThreadPool(object):
+    """
+    Runs functions with one of several objects (e.g. generators) in a
+    pool of threads, at most one call per object at a time.
+
+    Args:
+        objects (list): Objects handed to the functions, one per thread.
+        serialize (bool): Run one call at a time, e.g. on databases with
+            a single writer. Calls still overlap with the event loop.
+    """
+
+    def __init__(self, objects, serialize=False):
+        self.size = len(objects)
+        self.executor = ThreadPoolExecutor(max_workers=self.size)
+        self.objects = Queue()
+        for obj in objects:
+            self.objects.put(obj)
+        self.semaphore = None
+        self.lock = threading.Lock() if serialize else None
+
+    def call(self, function, *args):
+        obj = self.objects.get()
+        try:
+            if self.lock is None:
+                return function(obj, *args)
+            with self.lock:
+                return function(obj, *args)
+        finally:
+            self.objects.put(obj)
+
+    async def acquire(self):
+        """
+        Waits for a free thread, see run.
+        """
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.size)
+        await self.semaphore.acquire()
+
+    def run(self, function, *args):
+        """
+        Schedules a call in a thread which must have been acquired.
+
+        Returns:
+            asyncio.Future
+        """
+        future = asyncio.get_event_loop().run_in_executor(
+            self.executor, self.call, function, *args)
+        future.add_done_callback(lambda future: self.semaphore.release())
+        return future
+
+    async def close(self):
+        barrier = threading.Barrier(self.size)
+        loop = asyncio.get_event_loop()
+        await asyncio.gather(*[
+            loop.run_in_executor(self.executor, close_connections, barrier)
+            for _ in range(self.size)])
+        self.executor.shutdown()
+
+
+class AsyncInstanceGenerator(object):
+    """
+    asyncio front end for a generator class. Batches of dictionaries are
+    generated concurrently in a transaction each, by at most
+    max_concurrency threads (option, defaults to 4, to 1 on SQLite).
+    SQLite allows a single writer, batches are then written one at a
+    time. Several syncs can be driven by a single event loop.
+
+    Args:
+        model_class (Model): The target model.
+        persistence (list): Passed on to the generators.
+        options (dict): Passed on to the generators.
+    """
+    generator_class = InstanceGenerator
+
+    def __init__(self, model_class, persistence=None, options=None):
+        self.model_class = model_class
+        self.options = options or {}
+        size, options = get_pool_options(model_class, self.options)
+        self.pool = ThreadPool([
+            self.generator_class(model_class, persistence=persistence,
+                                 options=options)
+            for _ in range(size)], serialize=is_sqlite(model_class))
+
+    @staticmethod
+    def generate_sync(generator, dics):
+        with atomic(generator.get_journals()):
+            instances = generator.get_instances(dics)
+        return list(zip(generator.results, instances))
+
+    async def generate(self, dics):
+        """
+        Returns:
+            list: (GenerationStatus, instance) for each dictionary.
+        """
+        await self.pool.acquire()
+        return await self.pool.run(self.generate_sync, dics)
+
+    async def get_instances(self, dics):
+        return [instance for _, instance in await self.generate(dics)]
+
+    async def get_instance(self, dic):
+        return (await self.get_instances([dic]))[0]
+
+    async def close(self):
+        await self.pool.close()
+
+
+class AsyncLoader(object):
+    """
+    Loads records from an async iterable (or a plain iterable), e.g.
+    an async reader or an HTTP stream. Records are transformed and
+    written in chunks (chunk_size or batch_size option, default 1000) by
+    at most max_concurrency threads (option, defaults to 4, to 1 on
+    SQLite), each with a loader_class instance of its own, see
+    Loader.write_batch. On SQLite chunks are written one at a time.
+    Results are logged in the order of the source. Reading pauses while
+    all threads are busy.
+
+    Args:
+        source: Async iterable or iterable of dictionaries.
+        model_class (Model): Passed on to loader_class.
+        logger (BaseLogger): Logger.
+        options (dict): Passed on to loader_class.
+    """
+    loader_class = Loader
+
+    def __init__(self, source, model_class=None, logger=None, options=None):
+        self.source = source
+        self.options = options or {}
+        self.model_class = model_class or self.loader_class.model_class
+        self.logger = logger or StdoutLogger()
+        self.chunk_size = (self.options.get('chunk_size') or
+                           self.options.get('batch_size') or 1000)
+        size, options = get_pool_options(self.model_class, self.options)
+        self.loaders = [
+            self.loader_class(None, model_class=self.model_class,
+                              logger=self.logger, options=options)
+            for _ in range(size)]
+        self.pool = ThreadPool(
+            self.loaders, serialize=is_sqlite(self.model_class))
+
+    @staticmethod
+    def process_sync(loader, records):
+        """
+        Transforms and writes records.
+
+        Returns:
+            list: (dictionary, status, instance, error message) for each
+            record.
+        """
+        entries = [loader.transform((record, None)) for record in records]
+        dics = [dic for dic, error in entries if not error]
+        results = iter(loader.write_batch(dics) if dics else [])
+        ret = []
+        for dic, error in entries:
+            if error:
+                ret.append((dic, None, None, error))
+            else:
+                res, instance, error = next(results)
+                ret.append((dic, res, instance, error))
+        return ret
+
+    async def records(self):
+        if hasattr(self.source, '__aiter__'):
+            async for record in self.source:
+                yield record
+        else:
+            for record in self.source:
+                yield record
+
+    def log(self, results):
+        for dic, res, instance, error in results:
+            if error:
+                self.logger.reject(error, dic)
+            else:
+                self.logger.accept(res, dic, instance)
+
+    async def load(self):
+        """
+        Returns:
+            Counter: The logger's counter.
+        """
+        self.logger.start()
+        pending = deque()
+        records = []
+        try:
+            async for record in self.records():
+                records.append(record)
+                if len(records) < self.chunk_size:
+                    continue
+                await self.pool.acquire()
+                pending.append(self.pool.run(self.process_sync, records))
+                records = []
+                while pending and pending[0].done():
+                    self.log(pending.popleft().result())
+            if records:
+                await self.pool.acquire()
+                pending.append(self.pool.run(self.process_sync, records))
+            while pending:
+                self.log(await pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+            await self.pool.close()
+        metrics = OrderedDict()
+        for loader in self.loaders:
+            for name, value in loader.generator.get_metrics().items():
+                metrics[name] = metrics.get(name, 0) + value
+        for name, value in metrics.items():
+            self.logger.metric(name, value)
+        self.logger.finish()
+        return self.logger.counter
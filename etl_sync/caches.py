@@ -0,0 +1,524 @@
+from __future__ import absolute_import
+
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import FieldDoesNotExist, Model, Q
+
+
+def freeze(value):
+    """
+    Returns a hashable representation of nested dictionaries and lists
+    as used in data dictionaries for related records.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    if isinstance(value, Model):
+        return (value.__class__, value.pk)
+    return value
+
+
+@contextmanager
+def atomic(journals):
+    """
+    Transaction (or savepoint) which keeps journaled caches consistent
+    with the database.
+    """
+    for journal in journals:
+        journal.begin()
+    try:
+        with transaction.atomic():
+            yield
+    except Exception:
+        for journal in journals:
+            journal.rollback()
+        raise
+    for journal in journals:
+        journal.commit()
+
+
+class JournaledCache(object):
+    """
+    Dictionary cache for values that refer to database records. Entries
+    added within a transaction are journaled. Call begin, commit, and
+    rollback along with the transaction in order to drop entries that
+    were never committed. Journals can be nested like savepoints.
+    """
+
+    def __init__(self):
+        self.data = OrderedDict()
+        self.journals = []
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value):
+        self.data[key] = value
+        if self.journals:
+            self.journals[-1].append(key)
+
+    def clear(self):
+        self.data.clear()
+        self.journals = []
+
+    def begin(self):
+        self.journals.append([])
+
+    def commit(self):
+        keys = self.journals.pop()
+        if self.journals:
+            self.journals[-1].extend(keys)
+
+    def rollback(self):
+        for key in self.journals.pop():
+            self.data.pop(key, None)
+
+
+class ChangeCounter(JournaledCache):
+    """
+    Counts changed fields by name. Journals hold the names counted
+    within a transaction, which are subtracted again on rollback.
+    """
+
+    def update(self, names):
+        for name in names:
+            self.set(name, self.data.get(name, 0) + 1)
+
+    def most_common(self):
+        """
+        Returns:
+            list: (name, count) pairs in descending order of counts.
+        """
+        return sorted(self.data.items(), key=lambda item: -item[1])
+
+    def rollback(self):
+        for key in self.journals.pop():
+            self.data[key] -= 1
+            if not self.data[key]:
+                del self.data[key]
+
+
+class RelatedCache(JournaledCache):
+    """
+    Bounded LRU cache for related instances resolved by the generators
+    during a load, e.g. foreign keys given as strings, integers, or
+    nested dictionaries. The cache is shared by a generator and all
+    generators it creates for related models.
+
+    Be aware that a cached nested dictionary will not be written again.
+    If the same related record appears with different values, each
+    distinct dictionary is written once.
+
+    Args:
+        maxsize (int): Maximum number of cached instances.
+    """
+
+    def __init__(self, maxsize=100000):
+        super(RelatedCache, self).__init__()
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model_class, value, related_field=None):
+        """
+        Returns the cache key for a value of a related field or None if
+        the value cannot be cached. Integers refer to the primary key
+        unless related_field is given.
+        """
+        if isinstance(value, Model):
+            return None
+        if not isinstance(value, int) or isinstance(value, bool):
+            related_field = None
+        else:
+            related_field = related_field or model_class._meta.pk.name
+        key = (model_class, related_field, freeze(value))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        try:
+            instance = self.data[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key)
+        self.hits += 1
+        return instance
+
+    def set(self, key, instance):
+        super(RelatedCache, self).set(key, instance)
+        self.data.move_to_end(key)
+        while len(self.data) > self.maxsize:
+            self.data.popitem(last=False)
+
+    def preload(self, model_class, related_field=None):
+        """
+        Warms the cache with all records of a small lookup table using a
+        single query. Records are cached by primary key (or related_field)
+        and by their unique string field if there is exactly one.
+        """
+        from .generators import get_unique_string_fields
+        string_fields = get_unique_string_fields(model_class)
+        related_field = related_field or model_class._meta.pk.name
+        for instance in model_class.objects.all()[:self.maxsize]:
+            self.set(self.make_key(
+                model_class, getattr(instance, related_field), related_field),
+                instance)
+            if len(string_fields) == 1:
+                self.set(self.make_key(
+                    model_class,
+                    getattr(instance, string_fields[0].name)), instance)
+
+
+class PersistenceIndex(JournaledCache):
+    """
+    In-memory map of the persistence keys present in the table of a
+    model to primary keys. The key columns and primary keys are streamed
+    once with a single query when the index is used first. Afterwards
+    the index tells without a database round trip whether and as which
+    row a record exists. Keys of records created during the load must be
+    added with add, entries added in a rolled back transaction are
+    dropped (see JournaledCache).
+
+    Keys have the format returned by BaseGenerator.get_persistence_keys,
+    values are converted with the fields' to_python. If the table holds
+    more than limit keys the index gets disabled and generators fall
+    back to database queries.
+
+    Args:
+        model_class (Model): The target model.
+        persistence (list): Persistence criteria, fields or field tuples.
+        limit (int): Maximum number of keys held in memory.
+    """
+
+    def __init__(self, model_class, persistence, limit=None):
+        super(PersistenceIndex, self).__init__()
+        self.model_class = model_class
+        self.persistence = persistence
+        self.limit = limit
+        self.criteria = None
+        self.disabled = False
+
+    def load(self):
+        meta = self.model_class._meta
+        criteria = []
+        columns = [meta.pk.attname]
+        for field in self.persistence:
+            names = tuple(field) if isinstance(field, (list, tuple)) else (
+                field,)
+            try:
+                attnames = [meta.get_field(name).attname for name in names]
+            except FieldDoesNotExist:
+                continue
+            for attname in attnames:
+                if attname not in columns:
+                    columns.append(attname)
+            criteria.append(
+                (names, [columns.index(attname) for attname in attnames]))
+        self.criteria = set(names for names, _ in criteria)
+        self.data = {}
+        if not criteria:
+            return
+        rows = self.model_class.objects.values_list(*columns).iterator()
+        for row in rows:
+            for names, positions in criteria:
+                values = tuple(row[position] for position in positions)
+                if None not in values:
+                    self.data[self.normalize(names, values)] = row[0]
+            if self.limit and len(self.data) > self.limit:
+                self.disable()
+                return
+
+    def disable(self):
+        self.data = {}
+        self.disabled = True
+
+    def normalize(self, names, values):
+        ret = []
+        for name, value in zip(names, values):
+            field = self.model_class._meta.get_field(name)
+            value = getattr(value, 'pk', value)
+            try:
+                ret.append(field.to_python(value))
+            except ValidationError:
+                ret.append(value)
+        return names, tuple(ret)
+
+    def find(self, key):
+        """
+        Returns:
+            tuple: Whether the key exists (None if unknown to the index)
+            and its primary key.
+        """
+        if self.disabled:
+            return None, None
+        if self.criteria is None:
+            self.load()
+            if self.disabled:
+                return None, None
+        names = tuple(name for name, _ in key)
+        if names not in self.criteria:
+            return None, None
+        entry = self.normalize(names, [value for _, value in key])
+        if entry in self.data:
+            return True, self.data[entry]
+        return False, None
+
+    def contains(self, key):
+        """
+        Returns:
+            bool: Whether the key exists, None if unknown to the index.
+        """
+        return self.find(key)[0]
+
+    def get(self, key):
+        """
+        Returns:
+            Primary key of the row with the key or None.
+        """
+        return self.find(key)[1]
+
+    def add(self, key, pk=None):
+        if self.criteria is None or self.disabled:
+            return
+        names = tuple(name for name, _ in key)
+        if names not in self.criteria:
+            return
+        entry = self.normalize(names, [value for _, value in key])
+        if self.data.get(entry) is None:
+            self.set(entry, pk)
+            if self.limit and len(self.data) > self.limit:
+                self.disable()
+
+
+class HashIndex(JournaledCache):
+    """
+    Maps record hashes to primary keys for all records of a model. The
+    index is loaded with a single query on first use, see HashMixin.
+    The hash of each primary key is kept as well, so that the former
+    hash of an updated row is removed. Journals hold the previous
+    primary key of each changed hash.
+
+    Args:
+        model_class (Model): The target model.
+        hashfield (str): Name of the field holding the hash.
+    """
+
+    def __init__(self, model_class, hashfield):
+        super(HashIndex, self).__init__()
+        self.model_class = model_class
+        self.hashfield = hashfield
+        self.hashes = {}
+        self.loaded = False
+
+    def load(self):
+        self.data = dict(self.model_class.objects.exclude(
+            **{self.hashfield: None}).values_list(
+                self.hashfield, 'pk').iterator())
+        self.hashes = dict((pk, key) for key, pk in self.data.items())
+        self.loaded = True
+
+    def get(self, key):
+        if not self.loaded:
+            self.load()
+        return self.data.get(key)
+
+    def set(self, key, value):
+        if not self.loaded:
+            return
+        previous = self.hashes.get(value)
+        if previous is not None and previous != key:
+            self.assign(previous, None)
+        self.assign(key, value)
+
+    def assign(self, key, value):
+        if self.journals:
+            self.journals[-1].append((key, self.data.get(key)))
+        self.put(key, value)
+
+    def put(self, key, value):
+        previous = self.data.pop(key, None)
+        if previous is not None and self.hashes.get(previous) == key:
+            del self.hashes[previous]
+        if value is not None:
+            self.data[key] = value
+            self.hashes[value] = key
+
+    def clear(self):
+        super(HashIndex, self).clear()
+        self.hashes = {}
+
+    def rollback(self):
+        for key, value in reversed(self.journals.pop()):
+            self.put(key, value)
+
+
+class KeySet(object):
+    """
+    Compact set of primary keys. Integer keys are stored in an array of
+    8 bytes per key, which is sorted once all keys are added; other keys
+    in a set.
+    """
+
+    def __init__(self):
+        self.array = array('q')
+        self.set = None
+        self.sorted = True
+
+    def add(self, key):
+        if self.set is None:
+            if isinstance(key, int) and not isinstance(key, bool):
+                try:
+                    self.array.append(key)
+                    self.sorted = False
+                    return
+                except OverflowError:
+                    pass
+            self.set = set(self.array)
+            self.array = array('q')
+        self.set.add(key)
+
+    def __contains__(self, key):
+        if self.set is not None:
+            return key in self.set
+        if not self.sorted:
+            self.array = array('q', sorted(set(self.array)))
+            self.sorted = True
+        index = bisect_left(self.array, key)
+        return index < len(self.array) and self.array[index] == key
+
+    def __len__(self):
+        if self.set is not None:
+            return len(self.set)
+        if not self.sorted:
+            return len(set(self.array))
+        return len(self.array)
+
+
+class MergeOrderError(RuntimeError):
+    """
+    Raised when the keys of a merge join are out of order. Unlike the
+    errors of single records it aborts the load.
+    """
+
+
+class MergeCursor(object):
+    """
+    Scans the table of a model in the order of a unique key, one page
+    of instances at a time (keyset pagination: WHERE key > last ORDER BY
+    key). Unlike a database cursor the scan survives commits. Rows with
+    NULL key values are not scanned.
+
+    The position follows transactions like a JournaledCache: call begin,
+    commit, and rollback along with the transaction. The cursor also
+    holds the merge state of MergeJoinMixin: the last key of the source
+    (last), the primary keys of unmatched rows (unmatched), the number
+    of deleted rows, and the keys of records looked up in transactions
+    which were rolled back (protected, such rows must not be deleted).
+
+    Args:
+        queryset (QuerySet): Rows to scan.
+        attnames (tuple): Column attributes of the key.
+        size (int): Number of rows per page.
+    """
+
+    def __init__(self, queryset, attnames, size=2000):
+        self.queryset = queryset.filter(**dict(
+            ('{}__isnull'.format(attname), False)
+            for attname in attnames)).order_by(*attnames)
+        self.attnames = attnames
+        self.size = size
+        self.page = []
+        self.index = 0
+        self.end = None
+        self.exhausted = False
+        self.last = None
+        self.unmatched = []
+        self.deleted = 0
+        self.scanned = 0
+        self.protected = set()
+        self.journals = []
+
+    def key(self, instance):
+        return tuple(getattr(instance, attname) for attname in self.attnames)
+
+    def after(self, values):
+        """
+        Returns:
+            Q: Rows with keys greater than values.
+        """
+        query = Q()
+        for position, attname in enumerate(self.attnames):
+            condition = Q(**{'{}__gt'.format(attname): values[position]})
+            for previous in range(position):
+                condition &= Q(**{self.attnames[previous]: values[previous]})
+            query |= condition
+        return query
+
+    def peek(self):
+        """
+        Returns:
+            Model instance: The current row or None at the end of the
+            table.
+        """
+        while self.index >= len(self.page):
+            if self.exhausted:
+                return None
+            queryset = self.queryset
+            if self.end is not None:
+                queryset = queryset.filter(self.after(self.end))
+            page = list(queryset[:self.size])
+            previous = self.end
+            for instance in page:
+                key = self.key(instance)
+                if previous is not None and not previous < key:
+                    raise MergeOrderError(
+                        'The database orders keys differently than Python '
+                        '({} after {}), use a binary collation.'.format(
+                            key, previous))
+                previous = key
+            self.page, self.index = page, 0
+            self.exhausted = len(page) < self.size
+            if page:
+                self.end = self.key(page[-1])
+            self.scanned += len(page)
+        return self.page[self.index]
+
+    def next(self):
+        self.index += 1
+
+    def state(self):
+        return (self.page, self.index, self.end, self.exhausted, self.last,
+                list(self.unmatched), self.deleted, self.scanned)
+
+    def begin(self):
+        self.journals.append((self.state(), []))
+
+    def look_up(self, key):
+        """Records the key of a record looked up in a transaction."""
+        if self.journals:
+            self.journals[-1][1].append(key)
+
+    def commit(self):
+        _, keys = self.journals.pop()
+        if self.journals:
+            self.journals[-1][1].extend(keys)
+
+    def rollback(self):
+        state, keys = self.journals.pop()
+        (self.page, self.index, self.end, self.exhausted, self.last,
+         self.unmatched, self.deleted, self.scanned) = state
+        self.protected.update(keys)
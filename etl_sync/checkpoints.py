@@ -0,0 +1,160 @@
+from __future__ import absolute_import
+
+import hashlib
+import io
+import json
+import os
+from collections.abc import Mapping
+
+
+def fingerprint(source):
+    """
+    Returns:
+        dict: Path, size, and modification time of a source file or None
+        for other sources.
+    """
+    path = getattr(source, 'name', source)
+    if not isinstance(path, str) or not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size,
+            'mtime': stat.st_mtime}
+
+
+class FileCheckpointStore(object):
+    """
+    Stores the checkpoint of a load in a JSON file. The file is replaced
+    atomically, a crash while saving leaves the previous checkpoint.
+    Other stores (e.g. a database table) need to provide the same
+    methods.
+
+    Args:
+        path (str): Path to the checkpoint file.
+    """
+    suffix = '.etlckpt'
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def for_source(cls, source, suffix=None):
+        """
+        Returns:
+            FileCheckpointStore: Store next to a source file or None if
+            the source is not a file.
+        """
+        path = getattr(source, 'name', source)
+        if not isinstance(path, str) or not os.path.isfile(path):
+            return None
+        return cls(path + (suffix or cls.suffix))
+
+    def load(self):
+        """
+        Returns:
+            dict: The last checkpoint or None.
+        """
+        try:
+            with io.open(self.path, encoding='utf-8') as fil:
+                return json.load(fil)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def save(self, checkpoint):
+        temp = self.path + '.tmp'
+        with io.open(temp, 'w', encoding='utf-8') as fil:
+            fil.write(json.dumps(checkpoint))
+        os.replace(temp, self.path)
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+class ModelCheckpointStore(object):
+    """
+    Stores the checkpoint of a load in a database table. The model needs
+    a unique ``key`` field and a text field ``data``. The checkpoint is
+    saved in its own transaction after each chunk is committed.
+
+    Args:
+        model_class (Model): Checkpoint model.
+        key (str): Identifies the load, e.g. the source name.
+    """
+
+    def __init__(self, model_class, key):
+        self.model_class = model_class
+        self.key = key
+
+    def load(self):
+        data = self.model_class.objects.filter(key=self.key).values_list(
+            'data', flat=True).first()
+        try:
+            return json.loads(data) if data else None
+        except ValueError:
+            return None
+
+    def save(self, checkpoint):
+        self.model_class.objects.update_or_create(
+            key=self.key, defaults={'data': json.dumps(checkpoint)})
+
+    def clear(self):
+        self.model_class.objects.filter(key=self.key).delete()
+
+
+class ChunkFingerprints(object):
+    """
+    Fingerprints of the record chunks loaded without rejections by the
+    previous run, used to skip unchanged chunks in incremental loads.
+    Fingerprints are independent of the position of a chunk. They are
+    discarded if the signature (e.g. model and chunk size) differs.
+
+    Args:
+        store: Store with load and save methods, see FileCheckpointStore.
+        signature (dict): Settings the fingerprints depend on.
+    """
+
+    def __init__(self, store, signature):
+        self.store = store
+        self.signature = signature
+        data = store.load() or {}
+        self.previous = set()
+        if data.get('signature') == signature:
+            self.previous = set(data.get('chunks', []))
+        self.current = set()
+
+    @staticmethod
+    def fingerprint(records):
+        digest = hashlib.sha1()
+        for record in records:
+            if isinstance(record, Mapping) and not isinstance(record, dict):
+                record = dict(record)
+            digest.update(json.dumps(
+                record, sort_keys=True, default=str).encode('utf-8'))
+            digest.update(b'\n')
+        return digest.hexdigest()
+
+    def unchanged(self, fingerprint):
+        """
+        Returns:
+            bool: True if the chunk was loaded by the previous run. It
+            is kept for the next one.
+        """
+        if fingerprint in self.previous:
+            self.current.add(fingerprint)
+            return True
+        return False
+
+    def add(self, fingerprint):
+        """Records a chunk loaded without rejections."""
+        self.current.add(fingerprint)
+
+    def save(self, merge=False):
+        """
+        Saves the fingerprints of this run, merged with those of the
+        previous run if only part of the source was loaded.
+        """
+        chunks = self.current | self.previous if merge else self.current
+        self.store.save(
+            {'signature': self.signature, 'chunks': sorted(chunks)})
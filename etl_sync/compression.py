@@ -0,0 +1,98 @@
+from __future__ import absolute_import
+
+import bz2
+import gzip
+import io
+import lzma
+import re
+from functools import partial
+
+from .pipeline import Pipeline
+
+# headers and file classes of supported compression formats, bzip2
+# streams start with the block size (1-9) and the magic of the first
+# block or of the end of an empty stream
+FORMATS = [
+    (re.compile(b'\x1f\x8b'), gzip.GzipFile),
+    (re.compile(b'BZh[1-9](1AY&SY|\x17rE8P\x90)'), bz2.BZ2File),
+    (re.compile(b'\xfd7zXZ\x00'), lzma.LZMAFile),
+]
+
+
+def detect_compression(path):
+    """
+    Returns:
+        class: File class decompressing the file at path or None if the
+        file is not compressed or cannot be read.
+    """
+    try:
+        with io.open(path, 'rb') as fil:
+            head = fil.read(10)
+    except (IOError, OSError, TypeError):
+        return None
+    for header, file_class in FORMATS:
+        if header.match(head):
+            return file_class
+    return None
+
+
+class ThreadedReader(io.RawIOBase):
+    """
+    Reads a binary file in a background thread in chunks of chunk_size
+    bytes, e.g. a decompressing file, so that decompression overlaps
+    with parsing. At most queue_size chunks are read ahead. Errors of the
+    file are raised by read.
+
+    Args:
+        raw (file): Binary file.
+        chunk_size (int): Number of bytes per read.
+        queue_size (int): Maximum number of chunks read ahead.
+    """
+
+    def __init__(self, raw, chunk_size=1 << 20, queue_size=8):
+        super(ThreadedReader, self).__init__()
+        self.raw = raw
+        self.pipeline = Pipeline(queue_size)
+        self.chunks = self.pipeline.stage(
+            'decompress', iter(partial(raw.read, chunk_size), b''))
+        self.chunk = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if not len(self.chunk):
+            self.chunk = memoryview(next(self.chunks, b''))
+        size = min(len(buf), len(self.chunk))
+        buf[:size] = self.chunk[:size]
+        self.chunk = self.chunk[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.pipeline.close()
+            self.raw.close()
+        super(ThreadedReader, self).close()
+
+
+def open_compressed(path, encoding=None, buffer_size=1 << 20, thread=False):
+    """
+    Opens a gzip, bzip2, or xz compressed text file for streaming.
+
+    Args:
+        path (str): Path to the file.
+        encoding (str): Text encoding, defaults to the locale's.
+        buffer_size (int): Size of the read buffer.
+        thread (bool): Decompress in a background thread.
+
+    Returns:
+        file: Text file or None if the file is not compressed.
+    """
+    file_class = detect_compression(path)
+    if file_class is None:
+        return None
+    raw = file_class(path, 'rb')
+    if thread:
+        raw = ThreadedReader(raw, buffer_size)
+    return io.TextIOWrapper(
+        io.BufferedReader(raw, buffer_size), encoding=encoding)
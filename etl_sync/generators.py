@@ -1,16 +1,21 @@
 from __future__ import print_function
 
+import hashlib
 from builtins import str as text
-from collections import OrderedDict
-from hashlib import md5
+from collections import Counter, OrderedDict
 from typing import List
 
 from django.core.exceptions import FieldError, ValidationError
-from django.db.models import FieldDoesNotExist, ManyToOneRel, Q
+from django.db import IntegrityError, connections, router
+from django.db.models import FieldDoesNotExist, ManyToOneRel, Model, Q
+from django.db.models.signals import class_prepared
 from django.forms import DateTimeField
 from future.utils import iteritems
 from six import binary_type, text_type
 
+from etl_sync.caches import (
+    ChangeCounter, HashIndex, MergeCursor, MergeOrderError, PersistenceIndex,
+    RelatedCache, atomic)
 from etl_sync.types import GenerationStatus
 
 
@@ -83,8 +88,141 @@ def get_unique_string_fields(model_class):
         field.unique]
 
 
+class ModelInfo(object):
+    """
+    Introspection results for a model class. Computed once per process
+    and shared by all generators for that model, see get_model_info.
+    """
+
+    def __init__(self, model_class):
+        self.model_class = model_class
+        self.fields = get_fields(model_class)
+        self.field_names = OrderedDict([
+            (field.name, get_internal_type(field)) for field in self.fields])
+        self.concrete_names = set(
+            field.name for field in self.fields
+            if getattr(field, 'concrete', False))
+        self.unique_string_fields = get_unique_string_fields(model_class)
+        self.persistence = get_persistence(model_class)
+        # compiled preparation plans by generator class
+        self.plans = {}
+
+
+_model_info = {}
+
+
+def get_model_info(model_class):
+    """
+    Returns the cached ModelInfo for a model class.
+    """
+    try:
+        return _model_info[model_class]
+    except KeyError:
+        info = _model_info[model_class] = ModelInfo(model_class)
+        return info
+
+
+def clear_model_info(sender=None, **kwargs):
+    """
+    Clears the introspection registry. Connected to class_prepared so
+    that entries of models reloaded (e.g. in tests) get dropped.
+    """
+    if sender is None:
+        _model_info.clear()
+        return
+    label = (sender._meta.app_label, sender._meta.model_name)
+    for model_class in list(_model_info):
+        if (model_class._meta.app_label,
+                model_class._meta.model_name) == label:
+            del _model_info[model_class]
+
+
+class_prepared.connect(clear_model_info)
+
+
+def get_lookup_value(field, value):
+    """
+    Returns the value as stored in the field's attribute, i.e. the
+    referenced key for related instances. Used to match prepared
+    dictionaries with records fetched from the database.
+    """
+    if isinstance(value, Model) and getattr(field, 'target_field', None):
+        return getattr(value, field.target_field.attname)
+    return value
+
+
+def get_key_value(field, value):
+    """
+    Returns a persistence key value of the field's Python type, e.g. an
+    integer or a date for a string read from a text file, so that keys
+    of prepared dictionaries and of fetched instances compare equal.
+
+    Raises:
+        ValidationError: If the value cannot be converted.
+    """
+    return field.to_python(get_lookup_value(field, value))
+
+
+def bulk_update(model_class, objs, fields, batch_size=None):
+    """
+    Wrapper for Django < 2.2 compatibility which lacks
+    QuerySet.bulk_update. Falls back to one update per instance.
+    """
+    try:
+        return model_class.objects.bulk_update(
+            objs, fields, batch_size=batch_size)
+    except AttributeError:
+        for obj in objs:
+            model_class.objects.filter(pk=obj.pk).update(
+                **dict((name, getattr(obj, name)) for name in fields))
+
+
+def copy_value(value):
+    """
+    Copies nested dictionaries and lists, generators pop options from
+    dictionaries.
+    """
+    if isinstance(value, dict):
+        return dict((key, copy_value(item)) for key, item in iteritems(value))
+    if isinstance(value, list):
+        return [copy_value(item) for item in value]
+    return value
+
+
+def chunked(lst, size):
+    """
+    Splits a list into lists of given size.
+    """
+    for index in range(0, len(lst), size):
+        yield lst[index:index + size]
+
+
+class GenerationRecord(object):
+    """
+    Holds the state of a single dictionary while a batch of instances
+    is generated.
+    """
+    __slots__ = ('dic', 'back_refs', 'related_instances', 'persistence',
+                 'create', 'update', 'keys', 'matches', 'instance', 'res')
+
+    def __init__(self, dic=None, back_refs=None, related_instances=None,
+                 persistence=None, create=True, update=True):
+        self.dic = dic
+        self.back_refs = back_refs or {}
+        self.related_instances = related_instances or {}
+        self.persistence = persistence
+        self.create = create
+        self.update = update
+        self.keys = []
+        self.matches = []
+        self.instance = None
+        self.res = None
+
+
 class BaseGenerator(object):
     persistence = None
+    # maximum number of values in a single persistence query
+    query_chunk_size = 500
 
     def __init__(self, model_class, persistence=None, options=None):
         options = options or {}
@@ -93,21 +231,78 @@ class BaseGenerator(object):
         self.create = options.get('create', True)
         self.update = options.get('update', True)
         self.related_field = options.get('related_field')
+        self.m2m_replace = options.get('m2m_replace', False)
+        self.materialize = options.get('materialize', True)
+        self.concurrent = options.get('concurrent', False)
+        self.unchanged_status = (
+            GenerationStatus.Unchanged
+            if options.get('report_unchanged', True)
+            else GenerationStatus.Updated)
+        self.changed_fields = ChangeCounter()
+        self.related_cache = options.get('related_cache')
+        if self.related_cache is None and options.get('related_cache_size'):
+            self.related_cache = RelatedCache(options['related_cache_size'])
+            for model_class in options.get('related_cache_preload', []):
+                self.related_cache.preload(model_class)
         self.res = None
+        self.results = []
+        self.model_info = get_model_info(self.model_class)
         self.persistence = (self.persistence or persistence or
-                            get_persistence(self.model_class))
+                            list(self.model_info.persistence))
         if isinstance(self.persistence, (text_type, binary_type)):
             self.persistence = [self.persistence]
-        self.model_fields = get_fields(self.model_class)
-        self.field_names = OrderedDict([
-            (field.name, get_internal_type(field))
-            for field in self.model_fields])
-        self.unique_string_fields = get_unique_string_fields(self.model_class)
+        self.model_fields = self.model_info.fields
+        self.field_names = self.model_info.field_names
+        self.unique_string_fields = self.model_info.unique_string_fields
+        self.persistence_index = None
+        if options.get('persistence_index'):
+            self.persistence_index = PersistenceIndex(
+                self.model_class, self.persistence,
+                options.get('persistence_index_limit'))
 
     def get_persistence_query(self, dic, persistence, update):
+        if not update and self.persistence_index is not None:
+            pk = self.get_indexed_pk(dic, persistence)
+            if pk is not None:
+                return dic, [self.indexed_instance(pk)], update
         return dic, self.get_from_db(dic, persistence), update
 
+    def get_indexed_pk(self, dic, lookup):
+        """
+        Returns:
+            Primary key of the record according to the persistence index,
+            False if the record does not exist or None if unknown.
+        """
+        keys = self.get_persistence_keys(dic, lookup)
+        if not keys:
+            return None
+        absent = True
+        for key in keys:
+            exists, pk = self.persistence_index.find(key)
+            if pk is not None:
+                return pk
+            absent = absent and exists is False
+        return False if absent else None
+
+    def indexed_instance(self, pk):
+        """
+        Returns an instance of a row known to the persistence index with
+        all fields but the primary key deferred, i.e. loaded from the
+        database on access rather than set to their defaults.
+        """
+        return self.model_class.from_db(
+            router.db_for_read(self.model_class),
+            [self.model_class._meta.pk.attname], [pk])
+
     def get_from_db(self, dic, lookup):
+        if lookup and self.persistence_index is not None:
+            pk = self.get_indexed_pk(dic, lookup)
+            if pk is False:
+                return self.model_class.objects.none()
+            if pk is not None:
+                return self.get_queryset(*[
+                    name for name in dic
+                    if name in self.model_info.concrete_names]).filter(pk=pk)
         if lookup:
             query = Q()
             for field in lookup:
@@ -124,11 +319,24 @@ class BaseGenerator(object):
                     if value:
                         query |= Q(**{field: value})
             try:
-                return self.model_class.objects.filter(query)
+                return self.get_queryset(*[
+                    name for name in dic
+                    if name in self.model_info.concrete_names]).filter(query)
             except FieldError:
                 pass
         return self.model_class.objects.none()
 
+    def get_queryset(self, *fields):
+        """
+        Returns the queryset for persistence queries. If the materialize
+        option is False, only the primary key and given fields are
+        loaded.
+        """
+        if self.materialize:
+            return self.model_class.objects.all()
+        return self.model_class.objects.only(
+            self.model_class._meta.pk.name, *fields)
+
     def create_in_db(self, dic):
         return self.model_class.objects.create(**dic)
 
@@ -139,16 +347,325 @@ class BaseGenerator(object):
         1. Check for qs length was removed. If persistence queryset has more
         than one model all will be updated. Secure in model setup or override.
         2. The new setup will not trigger post save models.
+        3. The instances fetched by the persistence query are reused and
+        updated in memory, no further SELECT is issued. An update costs
+        the persistence query plus one UPDATE.
 
         Args:
-            dic(dict): Data dictionary.
-            qs(QuerySet): A django queryset.
+            dic(dict): Changed fields and their values.
+            qs(list): Instances fetched by the persistence query.
 
         Returns:
             Model instance: First model instance.
         """
-        qs.update(**dic)
-        return qs[0]
+        instances = list(qs)
+        pks = [instance.pk for instance in instances]
+        if len(pks) == 1:
+            self.model_class.objects.filter(pk=pks[0]).update(**dic)
+        else:
+            self.model_class.objects.filter(pk__in=pks).update(**dic)
+        for instance in instances:
+            for name, value in iteritems(dic):
+                setattr(instance, name, value)
+        return instances[0]
+
+    def get_persistence_keys(self, dic, lookup):
+        """
+        Returns hashable keys of a prepared dictionary, one for each
+        persistence criterion, following the rules of get_from_db. A key
+        is a tuple of (field name, value) pairs, values are converted to
+        the field's type (see get_key_value). Criteria with values which
+        cannot be converted are left out.
+        """
+        if isinstance(lookup, (text_type, binary_type)):
+            lookup = [lookup]
+        keys = []
+        for field in lookup or []:
+            if isinstance(field, (list, tuple)):
+                names = [name for name in field
+                         if dic.get(name, None) is not None]
+            else:
+                names = [field] if dic.get(field, None) else []
+            try:
+                key = tuple(
+                    (name, get_key_value(
+                        self.model_class._meta.get_field(name), dic[name]))
+                    for name in names)
+                hash(key)
+            except (FieldDoesNotExist, TypeError, ValidationError):
+                continue
+            if key:
+                keys.append(key)
+        return keys
+
+    def get_instance_key(self, instance, names):
+        key = []
+        for name in names:
+            field = self.model_class._meta.get_field(name)
+            value = getattr(instance, field.attname)
+            try:
+                value = field.to_python(value)
+            except ValidationError:
+                pass
+            key.append((name, value))
+        return tuple(key)
+
+    def get_from_db_by_keys(self, keys, indexed=True):
+        """
+        Fetches all instances matching any of the given persistence keys
+        with one query per chunk of keys. Keys known to be absent from
+        the persistence index are skipped unless indexed is False, e.g.
+        for rows inserted without the index.
+
+        Returns:
+            dict: {field names: {key: [instances]}}
+        """
+        if indexed and self.persistence_index is not None:
+            keys = [key for key in keys
+                    if self.persistence_index.contains(key) is not False]
+        groups = OrderedDict()
+        for key in keys:
+            groups.setdefault(tuple(name for name, _ in key), set()).add(key)
+        index = {}
+        for names, group in iteritems(groups):
+            found = index.setdefault(names, {})
+            size = max(self.query_chunk_size // len(names), 1)
+            for chunk in chunked(list(group), size):
+                if len(names) == 1:
+                    query = Q(**{'{}__in'.format(names[0]): [
+                        key[0][1] for key in chunk]})
+                else:
+                    query = Q()
+                    for key in chunk:
+                        query |= Q(**dict(key))
+                for instance in self.get_queryset(*names).filter(query):
+                    found.setdefault(
+                        self.get_instance_key(instance, names), []).append(
+                            instance)
+        return index
+
+    def record_from_dic(self, dic):
+        """
+        Prepares a dictionary for batch generation. Related instances are
+        created at this point.
+        """
+        persistence = dic.pop('etl_persistence', self.persistence)
+        if isinstance(persistence, (text_type, binary_type)):
+            persistence = [persistence]
+        create = dic.pop('etl_create', self.create)
+        update = dic.pop('etl_update', self.update)
+        self.related_instances = {}
+        dic, back_refs = self.prepare(dic)
+        record = GenerationRecord(
+            dic, back_refs, self.related_instances, persistence,
+            create, update)
+        self.related_instances = {}
+        return record
+
+    def lookup_records(self, records):
+        """
+        Resolves persistence for a list of records, querying the database
+        once for all of them. Records known to the persistence index are
+        fetched by primary key, or not at all if they are not updated.
+        """
+        for record in records:
+            record.keys = self.get_persistence_keys(
+                record.dic, record.persistence)
+        if self.persistence_index is not None:
+            records = self.lookup_indexed_records(records)
+        index = self.get_from_db_by_keys(
+            [key for record in records for key in record.keys])
+        for record in records:
+            for key in record.keys:
+                matches = index.get(
+                    tuple(name for name, _ in key), {}).get(key)
+                if matches:
+                    record.matches = matches
+                    break
+
+    def lookup_indexed_records(self, records):
+        """
+        Resolves persistence of records with keys known to the persistence
+        index.
+
+        Returns:
+            list: Records which need a persistence query.
+        """
+        remaining = []
+        fetch = OrderedDict()
+        for record in records:
+            pk = (self.get_indexed_pk(record.dic, record.persistence)
+                  if record.keys else None)
+            if pk is None:
+                remaining.append(record)
+            elif pk is False:
+                continue
+            elif record.update:
+                fetch.setdefault(pk, []).append(record)
+            else:
+                record.matches = [self.indexed_instance(pk)]
+        names = set()
+        for group in fetch.values():
+            names.update(name for name in group[0].dic
+                         if name in self.model_info.concrete_names)
+        for chunk in chunked(list(fetch), self.query_chunk_size):
+            for instance in self.get_queryset(*names).filter(pk__in=chunk):
+                for record in fetch.pop(instance.pk, []):
+                    record.matches = [instance]
+        # rows deleted since the index was loaded
+        for group in fetch.values():
+            for record in group:
+                record.matches = []
+        return remaining
+
+    def write_records(self, records):
+        """
+        Decides on creation or update of each record and writes them with
+        bulk operations. Records persisted by an earlier record of the
+        same batch are treated as updates of the latter.
+        """
+        created = []
+        updated = OrderedDict()
+        pending = {}
+        for record in records:
+            dic = dict((item, record.dic[item]) for item in record.dic
+                       if item in self.field_names)
+            target = None
+            if not record.matches:
+                for key in record.keys:
+                    if key in pending:
+                        target = pending[key]
+                        break
+            if record.matches or target:
+                instances = record.matches or [target.instance]
+                if record.update:
+                    record.res = self.unchanged_status
+                    for instance in instances:
+                        dirty = self.get_dirty_fields(instance, dic)
+                        if not dirty:
+                            continue
+                        record.res = GenerationStatus.Updated
+                        for name in dirty:
+                            setattr(instance, name, dic[name])
+                        if instance.pk is not None:
+                            self.changed_fields.update(dirty)
+                            updated.setdefault(
+                                id(instance), (instance, set()))[1].update(
+                                    dirty)
+                else:
+                    record.res = GenerationStatus.Exists
+                record.instance = instances[0]
+            elif record.create:
+                record.instance = self.model_class(**dic)
+                record.res = GenerationStatus.Created
+                created.append(record)
+                for key in record.keys:
+                    pending.setdefault(key, record)
+        self.bulk_create_records(created)
+        self.bulk_update_instances(updated)
+        for record in records:
+            if record.res in (GenerationStatus.Created,
+                              GenerationStatus.Updated):
+                self.index_instance(
+                    record.dic, record.instance, record.persistence)
+
+    def get_dirty_fields(self, instance, dic):
+        """
+        Compares a prepared dictionary with an instance and returns the
+        names of fields with different values. Deferred fields count as
+        changed.
+        """
+        dirty = []
+        for name, value in iteritems(dic):
+            field = self.model_class._meta.get_field(name)
+            try:
+                current = instance.__dict__[field.attname]
+                if current == get_key_value(field, value):
+                    continue
+            except (KeyError, TypeError, ValidationError):
+                pass
+            dirty.append(name)
+        return dirty
+
+    def index_instance(self, dic, instance, persistence):
+        """
+        Called for each created or updated instance in order to keep
+        in-memory indexes up to date.
+        """
+        if self.persistence_index is not None:
+            for key in self.get_persistence_keys(dic, persistence):
+                self.persistence_index.add(key, instance.pk)
+
+    def bulk_create_records(self, records):
+        """
+        Creates records with bulk_create. On backends which do not return
+        primary keys from bulk inserts, keys are fetched afterwards with
+        the persistence criteria. Records without persistence keys
+        which need a primary key for relations are created one by one.
+        """
+        connection = connections[router.db_for_write(self.model_class)]
+        if not getattr(connection.features,
+                       'can_return_ids_from_bulk_insert', False):
+            single = [record for record in records if not record.keys and
+                      (record.back_refs or record.related_instances)]
+            for record in single:
+                record.instance.save(force_insert=True)
+            records = [record for record in records if record not in single]
+        instances = [record.instance for record in records]
+        self.model_class.objects.bulk_create(
+            instances, batch_size=self.query_chunk_size)
+        missing = [record for record in records
+                   if record.keys and record.instance.pk is None]
+        if missing:
+            index = self.get_from_db_by_keys(
+                [record.keys[0] for record in missing], indexed=False)
+            for record in missing:
+                key = record.keys[0]
+                found = index.get(tuple(name for name, _ in key), {}).get(key)
+                if found:
+                    record.instance.pk = found[0].pk
+                    record.instance._state.adding = False
+                    record.instance._state.db = found[0]._state.db
+
+    def bulk_update_instances(self, updated):
+        """
+        Args:
+            updated (dict): {id: (instance, set of field names)}
+        """
+        groups = OrderedDict()
+        for instance, fields in updated.values():
+            groups.setdefault(tuple(sorted(fields)), []).append(instance)
+        for fields, instances in iteritems(groups):
+            if fields:
+                bulk_update(self.model_class, instances, list(fields),
+                            batch_size=self.query_chunk_size)
+
+    def save_back_refs(self, instance, back_refs):
+        self.save_back_refs_many([(instance, back_refs)])
+
+    def save_back_refs_many(self, pairs):
+        """
+        Creates or updates records referring to the given instances
+        (reverse relations). Children are grouped by related model and
+        generated in bulk, see get_instances.
+
+        Args:
+            pairs (list): (instance, data by ManyToOneRel field)
+        """
+        children = OrderedDict()
+        for instance, back_refs in pairs:
+            if instance is None:
+                continue
+            for field, data in back_refs.items():
+                if not isinstance(data, list):
+                    data = [data]
+                for datum in data:
+                    datum[field.field.name] = instance
+                    children.setdefault(field, []).append(datum)
+        for field, data in iteritems(children):
+            self.__class__(field.related_model, options={
+                'related_cache': self.related_cache,
+                'concurrent': self.concurrent}).get_instances(data)
 
     def instance_from_dic(self, dic):
         persistence = dic.pop('etl_persistence', self.persistence)
@@ -160,8 +677,18 @@ class BaseGenerator(object):
         instance = None
         if qs:
             if update:
-                instance = self.update_in_db(dic, qs)
-                self.res = GenerationStatus.Updated
+                instances = list(qs)
+                dirty = set()
+                for item in instances:
+                    dirty.update(self.get_dirty_fields(item, dic))
+                if dirty:
+                    instance = self.update_in_db(
+                        dict((name, dic[name]) for name in dirty), instances)
+                    self.changed_fields.update(dirty)
+                    self.res = GenerationStatus.Updated
+                else:
+                    instance = instances[0]
+                    self.res = self.unchanged_status
             else:
                 self.res = GenerationStatus.Exists
                 instance = qs[0]
@@ -169,13 +696,11 @@ class BaseGenerator(object):
             if create:
                 instance = self.create_in_db(dic)
                 self.res = GenerationStatus.Created
+        if instance and self.res in (GenerationStatus.Created,
+                                     GenerationStatus.Updated):
+            self.index_instance(dic, instance, persistence)
         if back_refs and instance:
-            for field, data in back_refs.items():
-                if not isinstance(data, list):
-                    data = [data]
-                for datum in data:
-                    datum[field.field.name] = instance
-                    self.__class__(field.related_model).get_instance(datum)
+            self.save_back_refs(instance, back_refs)
         return instance
 
     def instance_from_int(self, intnumber):
@@ -192,21 +717,72 @@ class BaseGenerator(object):
             dic = {self.unique_string_fields[0].name: string}
             return self.instance_from_dic(dic)
 
-    def assign_related(self, instance):
-        for (key, lst) in iteritems(self.related_instances):
-            field = getattr(instance, key)
+    def assign_related(self, instance, related_instances=None):
+        if related_instances is None:
+            related_instances = self.related_instances
+        self.assign_related_many([(instance, related_instances)])
+
+    def assign_related_many(self, pairs):
+        """
+        Assigns many-to-many relations for a list of instances. Existing
+        links are fetched with one query per field, only missing links
+        are inserted with bulk_create. In m2m_replace mode links not
+        present in the data are removed in bulk. Works for auto-created
+        and custom through models alike.
+
+        Args:
+            pairs (list): (instance, related instances by field name)
+        """
+        links = OrderedDict()
+        for instance, related_instances in pairs:
+            if instance is None or instance.pk is None:
+                continue
+            for key, lst in iteritems(related_instances):
+                if not hasattr(
+                        self.model_class._meta.get_field(key),
+                        'm2m_field_name'):
+                    # reverse relations
+                    getattr(instance, key).add(
+                        *[item for item in lst if item is not None])
+                    continue
+                targets = links.setdefault(key, OrderedDict())
+                items = set(item.pk for item in lst if item is not None)
+                if self.m2m_replace or instance.pk not in targets:
+                    targets[instance.pk] = items
+                else:
+                    targets[instance.pk] |= items
+        for key, targets in iteritems(links):
+            field = self.model_class._meta.get_field(key)
+            through = field.remote_field.through
+            source = through._meta.get_field(field.m2m_field_name()).attname
+            target = through._meta.get_field(
+                field.m2m_reverse_field_name()).attname
+            existing = {}
+            stale = []
+            for chunk in chunked(list(targets), self.query_chunk_size):
+                rows = through.objects.filter(
+                    **{'{}__in'.format(source): chunk}).values_list(
+                        'pk', source, target)
+                for pk, source_pk, target_pk in rows:
+                    if target_pk in targets[source_pk]:
+                        existing.setdefault(source_pk, set()).add(target_pk)
+                    else:
+                        stale.append(pk)
+            if self.m2m_replace:
+                for chunk in chunked(stale, self.query_chunk_size):
+                    through.objects.filter(pk__in=chunk).delete()
+            missing = [
+                through(**{source: source_pk, target: target_pk})
+                for source_pk, target_pks in iteritems(targets)
+                for target_pk in target_pks - existing.get(source_pk, set())]
             try:
-                field.add(*lst)
-            except AttributeError:
-                generator = InstanceGenerator(field.through)
-                for item in lst:
-                    instance = generator.get_instance({
-                        field.source_field_name: instance.pk,
-                        field.target_field_name: item.pk,
-                        'etl_persistence': [
-                            field.source_field_name,
-                            field.target_field_name
-                        ]})
+                through.objects.bulk_create(
+                    missing, batch_size=self.query_chunk_size,
+                    ignore_conflicts=True)
+            except TypeError:
+                # Django < 2.2
+                through.objects.bulk_create(
+                    missing, batch_size=self.query_chunk_size)
 
     def get_instance(self, obj):
         """
@@ -226,9 +802,109 @@ class BaseGenerator(object):
         if isinstance(obj, (text_type, binary_type)):
             return self.instance_from_str(obj)
 
+    def get_instances(self, objs):
+        """
+        Bulk counterpart of get_instance. Resolves persistence of all
+        dictionaries with a single query and writes them with bulk_create
+        and bulk_update. Be aware that bulk operations do not call
+        Model.save or send signals.
+
+        Args:
+            objs (list): Data dictionaries or anything get_instance accepts.
+
+        Returns:
+            list: Instances in the order of objs. The generation status
+            for each instance is stored in self.results.
+        """
+        records = []
+        for obj in objs:
+            if isinstance(obj, dict):
+                records.append(self.record_from_dic(obj.copy()))
+            else:
+                record = GenerationRecord()
+                record.instance = self.get_instance(obj)
+                record.res = self.res
+                records.append(record)
+        pending = [record for record in records if record.dic is not None]
+        self.lookup_records(pending)
+        self.write_records(pending)
+        self.save_back_refs_many([
+            (record.instance, record.back_refs) for record in pending
+            if record.back_refs])
+        self.assign_related_many([
+            (record.instance, record.related_instances)
+            for record in pending])
+        self.results = [record.res for record in records]
+        if records:
+            self.res = records[-1].res
+        return [record.instance for record in records]
+
     def prepare(self, dic):
         return dic, {}
 
+    def get_related_instance(self, model_class, value, options=None):
+        """
+        Returns the related instance for a value by means of a generator
+        for the related model. Looks up the related cache first if
+        present.
+        """
+        options = dict(options or {}, related_cache=self.related_cache)
+        key = None
+        if self.related_cache is not None:
+            key = self.related_cache.make_key(
+                model_class, value, options.get('related_field'))
+            if key is not None:
+                instance = self.related_cache.get(key)
+                if instance is not None:
+                    return instance
+        generator = self.__class__(model_class, options=options)
+        if self.concurrent:
+            instance = self.get_related_instance_concurrently(
+                generator, value)
+        else:
+            instance = generator.get_instance(value)
+        if key is not None and instance is not None:
+            self.related_cache.set(key, instance)
+        return instance
+
+    def get_related_instance_concurrently(self, generator, value):
+        """
+        Resolves a related value if several processes or threads load
+        overlapping data (concurrent option). The lookup and insert run
+        in a savepoint of the caller's transaction, an insert which
+        conflicts with a record created concurrently is rolled back to
+        the savepoint and retried as a lookup. This requires a unique
+        constraint on the lookup fields of the related model, without
+        one concurrent loaders may create duplicates.
+        """
+        try:
+            with atomic(generator.get_journals()):
+                return generator.get_instance(copy_value(value))
+        except IntegrityError:
+            return generator.get_instance(copy_value(value))
+
+    def get_journals(self):
+        """
+        Returns caches which need to follow database transactions, see
+        JournaledCache.
+        """
+        return [cache for cache in (self.changed_fields, self.related_cache,
+                                    self.persistence_index)
+                if cache is not None]
+
+    def get_metrics(self):
+        """
+        Returns counters collected during generation which get reported
+        by the Loader.
+        """
+        metrics = OrderedDict()
+        if self.related_cache is not None:
+            metrics['related cache hits'] = self.related_cache.hits
+            metrics['related cache misses'] = self.related_cache.misses
+        for name, count in self.changed_fields.most_common():
+            metrics['changed {}'.format(name)] = count
+        return metrics
+
     def finalize(self):
         """
         Override this method to finalize your data generation job,
@@ -242,6 +918,7 @@ class BaseGenerator(object):
 
 
 class InstanceGenerator(BaseGenerator):
+    wkb_writer = None
     preparations = {
         'AutoField': 'prepare_none',
         'ForeignKey': 'prepare_fk',
@@ -275,7 +952,7 @@ class InstanceGenerator(BaseGenerator):
         except AttributeError:
             options = {'related_field': field.related_name}
         related = getattr(field, 'related_model')
-        return self.__class__(related, options=options).get_instance(value)
+        return self.get_related_instance(related, value, options)
 
     def prepare_m2m(self, field, lst):
         """
@@ -285,10 +962,9 @@ class InstanceGenerator(BaseGenerator):
         self.related_instances[field.name] = []
         if not isinstance(lst, list):
             lst = [lst]
+        related = getattr(field, 'related_model')
         for item in lst:
-            related = getattr(field, 'related_model')
-            generator = self.__class__(related)
-            instance = generator.get_instance(item)
+            instance = self.get_related_instance(related, item)
             self.related_instances[field.name].append(instance)
 
     def prepare_date(self, field, value):
@@ -325,37 +1001,73 @@ class InstanceGenerator(BaseGenerator):
     def prepare_geometry(self, field, value):
         """
         Reduce geometry to two dimensions if GeometryField's
-        dim parameter is not set otherwise.
+        dim parameter is not set otherwise. Accepts geometries, WKT,
+        HEXEWKB, GeoJSON and WKB (memoryview, bytearray or bytes starting
+        with a byte order mark, e.g. from OGRReader). Other bytes are
+        decoded as text.
         """
         from django.contrib.gis.geos import WKBWriter, GEOSGeometry
-        if isinstance(value, (str, text_type)):
+        if isinstance(value, binary_type) and value[:1] not in (
+                b'\x00', b'\x01'):
+            value = value.decode('utf-8')
+        if isinstance(value, (binary_type, bytearray, memoryview)):
+            value = GEOSGeometry(memoryview(value))
+        elif isinstance(value, (str, text_type)):
             value = GEOSGeometry(value)
-        wkb_writer = WKBWriter()
         if isinstance(value, GEOSGeometry):
             if value.hasz and field.dim == 2:
-                value = GEOSGeometry(wkb_writer.write(value))
+                if self.wkb_writer is None:
+                    self.wkb_writer = WKBWriter()
+                value = GEOSGeometry(self.wkb_writer.write(value))
         return value
 
+    def get_preparation_plan(self):
+        """
+        Compiles the preparation plan for the model once per generator
+        class. The plan maps field names to (field, preparation function,
+        null flag); back references are kept separately.
+
+        Returns:
+            tuple: (plan, back reference fields by name)
+        """
+        cls = self.__class__
+        try:
+            return self.model_info.plans[cls]
+        except KeyError:
+            pass
+        plan = {}
+        back_refs = {}
+        for field in self.model_fields:
+            if isinstance(field, ManyToOneRel):
+                back_refs[field.name] = field
+                continue
+            name = self.preparations.get(get_internal_type(field))
+            function = getattr(cls, name, None) if name else None
+            plan[field.name] = (
+                field, function or cls.prepare_field,
+                getattr(field, 'null', False))
+        ret = self.model_info.plans[cls] = (plan, back_refs)
+        return ret
+
     def prepare(self, dic):
+        plan, back_ref_fields = self.get_preparation_plan()
         ret = {}
         back_refs = {}
-        for field in get_fields(self.model_class):
-            if field.name not in dic:
-                continue
-            if isinstance(field, ManyToOneRel):
-                back_refs[field] = dic.pop(field.name)
+        for name, value in iteritems(dic):
+            try:
+                field, function, null = plan[name]
+            except KeyError:
+                if name in back_ref_fields:
+                    back_refs[back_ref_fields[name]] = value
                 continue
-            fieldtype = get_internal_type(field)
-            prepare_function = getattr(self, self.preparations[fieldtype],
-                                       self.prepare_field)
             try:
-                res = prepare_function(field, dic.pop(field.name))
+                res = function(self, field, value)
             except ValidationError as e:
-                raise ValidationError({field.name:str(e.message)})
+                raise ValidationError({name: str(e.message)})
             if res is not None:
-                if not res and getattr(field, 'null', False):
+                if null and not res:
                     res = None
-                ret[field.name] = res
+                ret[name] = res
         return ret, back_refs
 
 
@@ -363,27 +1075,533 @@ class HashMixin(object):
     """
     Mix-in adding hashing to Generators. Replaces persistence
     criterion.
+
+    Unchanged records are recognized by their hash and not written.
+    Set the hash_index option to load the hashes of the whole table once
+    and skip the database for unchanged records. In batch mode hashes
+    are otherwise looked up with one query per batch. The hash_algorithm
+    option selects another hashlib algorithm, e.g. the faster blake2b
+    (with a 16 byte digest to fit the md5 field).
+
+    With md5 the values are hashed as a plain concatenation, compatible
+    with hashes stored by earlier versions, which does not tell e.g.
+    '1', '23' from '12', '3'. Other algorithms (or hash_encoding set to
+    'canonical') hash length-prefixed names and values.
     """
     hashfield = 'md5'
+    hash_algorithm = 'md5'
+    hash_encoding = None
     do_not_hash_fields = ['id', 'last_modified']
 
+    def __init__(self, model_class, persistence=None, options=None):
+        super(HashMixin, self).__init__(model_class, persistence, options)
+        options = options or {}
+        self.hash_algorithm = options.get(
+            'hash_algorithm', self.hash_algorithm)
+        self.hash_encoding = options.get(
+            'hash_encoding', self.hash_encoding) or (
+                'concatenated' if self.hash_algorithm == 'md5'
+                else 'canonical')
+        self.hash_excluded = set(
+            [self.hashfield] + list(self.do_not_hash_fields))
+        self.hash_index = None
+        if options.get('hash_index') and self.hashfield in self.field_names:
+            self.hash_index = HashIndex(self.model_class, self.hashfield)
+
     def get_persistence_query(self, dic, persistence, update):
         dic = self.hash_dic(dic)
+        if self.hash_index is not None:
+            pk = self.hash_index.get(dic[self.hashfield])
+            if pk is not None:
+                return dic, [self.hashed_instance(dic, pk)], False
+            return dic, self.get_from_db(dic, persistence), update
         items = self.get_from_db(dic, [self.hashfield])
         if len(items) > 0:
             return dic, items, False
         return dic, self.get_from_db(dic, persistence), update
 
+    def hashed_instance(self, dic, pk):
+        """
+        Returns an instance for an unchanged record without querying the
+        database. The hash guarantees that the values equal dic.
+        """
+        instance = self.model_class(**dict(
+            (name, dic[name]) for name in dic if name in self.field_names))
+        instance.pk = pk
+        instance._state.adding = False
+        return instance
+
+    def lookup_records(self, records):
+        for record in records:
+            record.dic = self.hash_dic(record.dic)
+        if self.hashfield not in self.field_names:
+            return super(HashMixin, self).lookup_records(records)
+        hashes = [record.dic[self.hashfield] for record in records]
+        if self.hash_index is not None:
+            known = dict((value, self.hash_index.get(value))
+                         for value in hashes)
+        else:
+            known = {}
+            for chunk in chunked(hashes, self.query_chunk_size):
+                known.update(self.model_class.objects.filter(**{
+                    '{}__in'.format(self.hashfield): chunk}).values_list(
+                        self.hashfield, 'pk'))
+        changed = []
+        hits = {}
+        for record in records:
+            pk = known.get(record.dic[self.hashfield])
+            if pk is None:
+                changed.append(record)
+                continue
+            record.keys = self.get_persistence_keys(
+                record.dic, record.persistence)
+            record.matches = [self.hashed_instance(record.dic, pk)]
+            hits[id(record)] = record.update
+            record.update = False
+        super(HashMixin, self).lookup_records(changed)
+        # rows written by an earlier record of the batch no longer hold
+        # the hashed values, such records update the same instances
+        written = {}
+        for record in records:
+            if id(record) in hits:
+                matches = written.get(record.matches[0].pk)
+                if matches is not None:
+                    record.matches = matches
+                    record.update = hits[id(record)]
+            elif record.update:
+                for instance in record.matches:
+                    written.setdefault(instance.pk, record.matches)
+
+    def index_instance(self, dic, instance, persistence):
+        super(HashMixin, self).index_instance(dic, instance, persistence)
+        if self.hash_index is not None and self.hashfield in dic:
+            self.hash_index.set(dic[self.hashfield], instance.pk)
+
+    def get_journals(self):
+        journals = super(HashMixin, self).get_journals()
+        if self.hash_index is not None:
+            journals.append(self.hash_index)
+        return journals
+
+    def new_digest(self):
+        if self.hash_algorithm.startswith('blake2'):
+            return hashlib.new(self.hash_algorithm, digest_size=16)
+        return hashlib.new(self.hash_algorithm)
+
     def hash(self, dic):
-        text_representation = ''
-        fields = sorted([
-            field for field in dic
-            if field not in [self.hashfield] +
-            list(self.do_not_hash_fields)])
-        for field in fields:
-            text_representation += text(dic[field])
-        return md5(text_representation.encode('utf-8')).hexdigest()
+        """
+        Streams the values in the order of their sorted keys into the
+        digest. The concatenated encoding hashes the values only, the
+        canonical encoding prefixes names and values with their length
+        and marks None values.
+        """
+        digest = self.new_digest()
+        canonical = self.hash_encoding == 'canonical'
+        for field in sorted(dic):
+            if field in self.hash_excluded:
+                continue
+            value = dic[field]
+            if not canonical:
+                digest.update(text(value).encode('utf-8'))
+                continue
+            name = text(field).encode('utf-8')
+            digest.update(b'%d:%s' % (len(name), name))
+            if value is None:
+                digest.update(b'-')
+            else:
+                value = text(value).encode('utf-8')
+                digest.update(b'%d:%s' % (len(value), value))
+        return digest.hexdigest()
 
     def hash_dic(self, dic):
         dic[self.hashfield] = self.hash(dic)
         return dic
+
+
+class UpsertMixin(object):
+    """
+    Mix-in writing records with native upserts, i.e. ``INSERT ... ON
+    CONFLICT`` on PostgreSQL and SQLite (3.24 or later). Records are
+    written with one statement per chunk of a batch, there is no window
+    between the persistence check and the write in which another process
+    could insert the same record.
+
+    The persistence criterion which applies to a record serves as the
+    conflict target and must be a unique field or a unique_together
+    combination. Records with update set to False are inserted with
+    DO NOTHING. Records without such a criterion, records with create set
+    to False, and all records on other backends are written with the
+    regular persistence queries.
+
+    On PostgreSQL created and updated rows are told apart by the
+    statement itself. On SQLite existing keys are selected beforehand.
+    Upserted records are always written, the report_unchanged option does
+    not apply.
+    """
+
+    def get_connection(self):
+        return connections[router.db_for_write(self.model_class)]
+
+    def get_conflict_targets(self):
+        """
+        Returns:
+            dict: {frozenset of field names: field names} for all unique
+            fields and unique_together combinations.
+        """
+        targets = getattr(self.model_info, 'conflict_targets', None)
+        if targets is None:
+            meta = self.model_class._meta
+            targets = {}
+            for names in meta.unique_together:
+                targets[frozenset(names)] = tuple(names)
+            for field in meta.concrete_fields:
+                if field.unique:
+                    targets[frozenset([field.name])] = (field.name,)
+            self.model_info.conflict_targets = targets
+        return targets
+
+    def supports_upsert(self):
+        connection = self.get_connection()
+        if self.model_class._meta.parents:
+            return False
+        if connection.vendor == 'postgresql':
+            return True
+        return (connection.vendor == 'sqlite' and
+                connection.Database.sqlite_version_info >= (3, 24, 0))
+
+    def get_conflict_target(self, record):
+        """
+        Returns the field names of the conflict target for a record or
+        None if the record cannot be upserted.
+        """
+        if record.dic is None or not record.create or len(record.keys) != 1:
+            return None
+        names = tuple(name for name, _ in record.keys[0])
+        return self.get_conflict_targets().get(frozenset(names))
+
+    def instance_from_dic(self, dic):
+        return self.get_instances([dic])[0]
+
+    def lookup_records(self, records):
+        if not self.supports_upsert():
+            return super(UpsertMixin, self).lookup_records(records)
+        for record in records:
+            record.keys = self.get_persistence_keys(
+                record.dic, record.persistence)
+        super(UpsertMixin, self).lookup_records([
+            record for record in records
+            if self.get_conflict_target(record) is None])
+
+    def write_records(self, records):
+        if not self.supports_upsert():
+            return super(UpsertMixin, self).write_records(records)
+        groups = OrderedDict()
+        fallback = []
+        for record in records:
+            target = self.get_conflict_target(record)
+            if target is None:
+                fallback.append(record)
+                continue
+            names = tuple(sorted(
+                name for name in record.dic
+                if name in self.model_info.concrete_names))
+            groups.setdefault(
+                (target, record.update, names), []).append(record)
+        super(UpsertMixin, self).write_records(fallback)
+        for (target, update, names), group in iteritems(groups):
+            # a statement must not affect the same row twice
+            rounds = []
+            seen = Counter()
+            for record in group:
+                index = seen[record.keys[0]]
+                seen[record.keys[0]] += 1
+                if index == len(rounds):
+                    rounds.append([])
+                rounds[index].append(record)
+            for chunk in rounds:
+                self.upsert_records(chunk, target, update, names)
+            for record in group:
+                if record.res in (GenerationStatus.Created,
+                                  GenerationStatus.Updated):
+                    self.index_instance(
+                        record.dic, record.instance, record.persistence)
+
+    def upsert_records(self, records, target, update, names):
+        """
+        Writes records with distinct keys and equal field names with one
+        INSERT ... ON CONFLICT statement per chunk and sets instance and
+        generation status of each record.
+
+        Args:
+            records (list): GenerationRecords.
+            target (tuple): Field names of the conflict target.
+            update (bool): Whether to update existing records.
+            names (tuple): Names of the fields given in the records.
+        """
+        connection = self.get_connection()
+        meta = self.model_class._meta
+        fields = [field for field in meta.concrete_fields
+                  if field is not meta.auto_field or field.name in names]
+        written = [field for field in fields
+                   if field.name in names or getattr(field, 'auto_now', False)]
+        size = self.query_chunk_size
+        if connection.vendor == 'sqlite':
+            size = max(min(size, 999 // len(fields)), 1)
+        for chunk in chunked(records, size):
+            self.upsert_chunk(
+                connection, chunk, target, update, fields, written)
+
+    def upsert_chunk(self, connection, records, target, update, fields,
+                     written):
+        meta = self.model_class._meta
+        qn = connection.ops.quote_name
+        target_fields = [meta.get_field(name) for name in target]
+        postgres = connection.vendor == 'postgresql'
+        returning = postgres or (
+            connection.Database.sqlite_version_info >= (3, 35, 0))
+        existing = {}
+        if not postgres:
+            for found in self.get_from_db_by_keys(
+                    [record.keys[0] for record in records]).values():
+                existing.update(found)
+        params = []
+        for record in records:
+            record.instance = self.model_class(**dict(
+                (name, record.dic[name]) for name in record.dic
+                if name in self.model_info.concrete_names))
+            params.extend(
+                field.get_db_prep_save(
+                    field.pre_save(record.instance, True), connection)
+                for field in fields)
+        row = '({})'.format(', '.join(['%s'] * len(fields)))
+        sql = 'INSERT INTO {} ({}) VALUES {} ON CONFLICT ({}) '.format(
+            qn(meta.db_table),
+            ', '.join(qn(field.column) for field in fields),
+            ', '.join([row] * len(records)),
+            ', '.join(qn(field.column) for field in target_fields))
+        if update:
+            sql += 'DO UPDATE SET {}'.format(', '.join(
+                '{0} = EXCLUDED.{0}'.format(qn(field.column))
+                for field in written))
+        else:
+            sql += 'DO NOTHING'
+        if returning:
+            sql += ' RETURNING {}'.format(', '.join(
+                [qn(meta.pk.column)] +
+                [qn(field.column) for field in target_fields] +
+                (['(xmax = 0)'] if postgres else [])))
+        rows = {}
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            if returning:
+                for values in cursor.fetchall():
+                    rows[self.normalize_key(
+                        target_fields, values[1:len(target) + 1])] = values
+        returned = [rows.get(self.normalize_key(
+            target_fields, [value for _, value in record.keys[0]]))
+            for record in records]
+        after = {}
+        for found in self.get_from_db_by_keys([
+                record.keys[0] for record, values in zip(records, returned)
+                if values is None and
+                record.keys[0] not in existing], indexed=False).values():
+            after.update(found)
+        for record, values in zip(records, returned):
+            key = record.keys[0]
+            if values is not None:
+                pk, created = values[0], (
+                    values[-1] if postgres else key not in existing)
+            elif not returning and key in after:
+                pk, created = after[key][0].pk, True
+            elif not returning and update and key in existing:
+                pk, created = existing[key][0].pk, False
+            else:
+                found = existing.get(key) or after.get(key)
+                record.instance = found[0] if found else None
+                record.res = GenerationStatus.Exists if found else None
+                continue
+            instance = record.instance
+            instance.pk = pk
+            instance._state.adding = False
+            instance._state.db = connection.alias
+            if created:
+                record.res = GenerationStatus.Created
+            else:
+                record.res = GenerationStatus.Updated
+                for field in fields:
+                    if field not in written and field is not meta.pk:
+                        instance.__dict__.pop(field.attname, None)
+
+    @staticmethod
+    def normalize_key(fields, values):
+        ret = []
+        for field, value in zip(fields, values):
+            try:
+                ret.append(field.to_python(value))
+            except ValidationError:
+                ret.append(value)
+        return tuple(ret)
+
+
+class MergeJoinMixin(object):
+    """
+    Mix-in resolving persistence by merging a source sorted by a unique
+    key with an ordered scan of the target table (merge_join option, the
+    key field or a tuple of fields). Instead of a persistence query per
+    batch, the table is read once in pages, see MergeCursor. Memory does
+    not depend on the size of the table.
+
+    Set the merge_delete option to delete rows whose keys are not part
+    of the source with one DELETE ... WHERE pk IN query per batch; rows
+    after the last key are deleted by finalize. Records without key
+    values are looked up with queries, as are records out of order
+    unless merge_delete is set: their rows may have been deleted
+    already, so a MergeOrderError aborts the load.
+
+    The database must order the key as Python does, e.g. a binary
+    collation for strings. merge_delete cannot be combined with slices
+    or incremental loads.
+    """
+
+    def __init__(self, model_class, persistence=None, options=None):
+        super(MergeJoinMixin, self).__init__(
+            model_class, persistence, options)
+        options = options or {}
+        self.merge_cursor = None
+        self.merge_delete = options.get('merge_delete', False)
+        self.merge_fallbacks = 0
+        names = options.get('merge_join')
+        if not names:
+            return
+        if self.merge_delete and (
+                options.get('slice_begin') or options.get('slice_end') or
+                options.get('incremental')):
+            raise ValueError(
+                'merge_delete cannot be combined with slices or '
+                'incremental loads.')
+        if isinstance(names, (text_type, binary_type)):
+            names = (names, )
+        self.merge_names = tuple(names)
+        meta = self.model_class._meta
+        if not ((len(names) == 1 and meta.get_field(names[0]).unique) or
+                any(set(names) == set(together)
+                    for together in meta.unique_together)):
+            raise ValueError(
+                'The merge key {} is not unique.'.format(self.merge_names))
+        self.merge_cursor = MergeCursor(
+            self.get_queryset(*self.merge_names),
+            tuple(meta.get_field(name).attname for name in names),
+            options.get('merge_page_size', 2000))
+
+    def instance_from_dic(self, dic):
+        if self.merge_cursor is None:
+            return super(MergeJoinMixin, self).instance_from_dic(dic)
+        return self.get_instances([dic])[0]
+
+    def get_merge_key(self, record):
+        """
+        Returns:
+            tuple: Key values of a record as stored in the database or
+            None if the record has no merge key.
+        """
+        for key in record.keys:
+            if tuple(name for name, _ in key) != self.merge_names:
+                continue
+            return tuple(value for _, value in key)
+        return None
+
+    def lookup_records(self, records):
+        cursor = self.merge_cursor
+        if cursor is None:
+            return super(MergeJoinMixin, self).lookup_records(records)
+        fallback = []
+        for record in records:
+            record.keys = self.get_persistence_keys(
+                record.dic, record.persistence)
+            key = self.get_merge_key(record)
+            out_of_order = (key is not None and cursor.last is not None and
+                            key < cursor.last)
+            if out_of_order and self.merge_delete:
+                raise MergeOrderError(
+                    'The key {} follows {}, sort the source.'.format(
+                        key, cursor.last))
+            if key is None or out_of_order:
+                fallback.append(record)
+                continue
+            cursor.look_up(key)
+            instance = cursor.peek()
+            while instance is not None and cursor.key(instance) < key:
+                self.pass_row(instance)
+                instance = cursor.peek()
+            if instance is not None and cursor.key(instance) == key:
+                record.matches = [instance]
+            elif key == cursor.last:
+                # repeated key, the row may have been created since
+                fallback.append(record)
+            cursor.last = key
+        self.merge_fallbacks += len(fallback)
+        super(MergeJoinMixin, self).lookup_records(fallback)
+
+    def pass_row(self, instance):
+        """
+        Advances the cursor past a row, which is deleted later if
+        merge_delete is set and no record of the source had its key.
+        """
+        cursor = self.merge_cursor
+        key = cursor.key(instance)
+        if (self.merge_delete and key != cursor.last and
+                key not in cursor.protected):
+            cursor.unmatched.append(instance.pk)
+        cursor.next()
+
+    def write_records(self, records):
+        super(MergeJoinMixin, self).write_records(records)
+        cursor = self.merge_cursor
+        if cursor is None or not cursor.unmatched:
+            return
+        matched = set(record.instance.pk for record in records
+                      if record.instance is not None)
+        self.delete_unmatched(
+            [pk for pk in cursor.unmatched if pk not in matched])
+        cursor.unmatched = []
+
+    def delete_unmatched(self, pks):
+        for chunk in chunked(pks, self.query_chunk_size):
+            self.model_class.objects.filter(pk__in=chunk).delete()
+        self.merge_cursor.deleted += len(pks)
+
+    @property
+    def deleted(self):
+        return self.merge_cursor.deleted if self.merge_cursor else 0
+
+    def finalize(self):
+        """
+        Deletes the rows after the last key of the source if
+        merge_delete is set.
+        """
+        cursor = self.merge_cursor
+        if cursor is not None and self.merge_delete:
+            with atomic(self.get_journals()):
+                instance = cursor.peek()
+                while instance is not None:
+                    self.pass_row(instance)
+                    if len(cursor.unmatched) >= self.query_chunk_size:
+                        self.delete_unmatched(cursor.unmatched)
+                        cursor.unmatched = []
+                    instance = cursor.peek()
+                self.delete_unmatched(cursor.unmatched)
+                cursor.unmatched = []
+        return super(MergeJoinMixin, self).finalize()
+
+    def get_journals(self):
+        journals = super(MergeJoinMixin, self).get_journals()
+        if self.merge_cursor is not None:
+            journals.append(self.merge_cursor)
+        return journals
+
+    def get_metrics(self):
+        metrics = super(MergeJoinMixin, self).get_metrics()
+        if self.merge_cursor is not None:
+            metrics['merge rows scanned'] = self.merge_cursor.scanned
+            metrics['merge fallback lookups'] = self.merge_fallbacks
+        return metrics
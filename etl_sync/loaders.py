@@ -1,13 +1,20 @@
 from __future__ import absolute_import, print_function
 
 import io
+import os
 
 from backports import csv
 from django.core.exceptions import ValidationError
-from django.db import DatabaseError, IntegrityError, transaction
+from django.db import DatabaseError, IntegrityError
 
-from .generators import InstanceGenerator
+from .caches import KeySet, atomic
+from .checkpoints import ChunkFingerprints, FileCheckpointStore, fingerprint
+from .compression import detect_compression, open_compressed
+from .generators import InstanceGenerator, chunked
 from .logging import StdoutLogger
+from .offsets import OffsetIndex
+from .pipeline import Pipeline
+from .readers import CSVReader
 from .transformations import Transformer
 from .types import CaseInsensitiveDict
 
@@ -25,6 +32,18 @@ class Extractor(object):
         options (dic): custom options that need to be passed through to
             reader
 
+    If the offset_index option is set (True or the number of records
+    between indexed offsets), the extractor seeks to the record at
+    slice_begin. Readers with a seek method (e.g. OGRReader) seek
+    themselves, text files are positioned with an OffsetIndex. The
+    number of records skipped this way is stored in self.skipped.
+
+    Files compressed with gzip, bzip2, or xz are recognized by their
+    magic bytes and decompressed while reading, in a background thread
+    if the decompress_thread option is set. The read_buffer_size option
+    sets the size of the read buffer (default 1 MB). Compressed files
+    are not indexed, records before slice_begin are read.
+
     Return reader instance.
     """
 
@@ -38,6 +57,8 @@ class Extractor(object):
             'quoting': csv.QUOTE_NONE
         }
         self.fil = None
+        self.reader = None
+        self.skipped = 0
 
     def __enter__(self):
         """
@@ -53,17 +74,103 @@ class Extractor(object):
             self.fil = self.source
         else:
             try:
-                self.fil = io.open(self.source)
+                self.fil = open_compressed(
+                    self.source,
+                    buffer_size=self.options.get('read_buffer_size', 1 << 20),
+                    thread=self.options.get('decompress_thread', False))
+                if self.fil is None:
+                    self.fil = io.open(self.source)
             except IOError:
                 self.fil = self.source
-        return self.reader_class(self.fil, **self.reader_kwargs)
+        reader = self.reader_class(self.fil, **self.reader_kwargs)
+        self.reader = reader
+        self.skipped = 0
+        begin = self.options.get('slice_begin')
+        if self.options.get('offset_index') and begin and begin > 1:
+            try:
+                self.skipped = self.seek(reader, begin - 1)
+            except Exception:
+                self.__exit__(None, None, None)
+                raise
+        return reader
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        close = getattr(self.reader, 'close', None)
+        if close:
+            close()
         try:
             self.fil.close()
         except (AttributeError, IOError):
             pass
 
+    def seek(self, reader, count):
+        """
+        Positions the reader after count records.
+
+        Returns:
+            int: Number of records actually skipped, remaining records
+            need to be read.
+        """
+        if hasattr(reader, 'seek'):
+            return reader.seek(count, step=self.get_offset_step())
+        index = self.get_offset_index(getattr(self.fil, 'name', None))
+        if index is None:
+            return 0
+        header = 0 if self.reader_kwargs.get('fieldnames') else 1
+        record, offset = index.find(count + header)
+        if record <= header:
+            return 0
+        if header:
+            # consumes the header line
+            getattr(reader, 'fieldnames', None)
+        self.fil.seek(offset)
+        return record - header
+
+    def get_offset_step(self):
+        """
+        Returns:
+            int: Number of records between indexed offsets.
+        """
+        step = self.options.get('offset_index')
+        return step if step and step is not True else 1000
+
+    def get_offset_index(self, path):
+        """
+        Returns:
+            OffsetIndex: Offset index for a text file or None if path is
+            not a file or compressed.
+        """
+        if (not isinstance(path, str) or not os.path.isfile(path) or
+                detect_compression(path)):
+            return None
+        quoting = self.reader_kwargs.get('quoting', csv.QUOTE_MINIMAL)
+        quotechar = None
+        if quoting != csv.QUOTE_NONE:
+            quotechar = self.reader_kwargs.get('quotechar', '"')
+        return OffsetIndex(
+            path, step=self.get_offset_step(), quotechar=quotechar,
+            delimiter=self.reader_kwargs.get('delimiter', ','),
+            skipinitialspace=self.reader_kwargs.get(
+                'skipinitialspace', False))
+
+    def count(self):
+        """
+        Returns the number of records of the source with readers which
+        provide a length method or by means of an offset index.
+
+        Returns:
+            int: Number of records or None if unknown.
+        """
+        with self as reader:
+            if hasattr(reader, 'length'):
+                return reader.length()
+        index = self.get_offset_index(self.source)
+        if index is None:
+            return None
+        index.load()
+        header = 0 if self.reader_kwargs.get('fieldnames') else 1
+        return max(index.count - header, 0)
+
 
 class Logger(object):
     """Class that holds the logger messages."""
@@ -106,6 +213,22 @@ class Logger(object):
 class Loader(object):
     """
     Generic mapper object for ETL.
+
+    If the checkpoint option is set (True for a file next to the source
+    or a store, see etl_sync.checkpoints), the position after the last
+    committed record, the counter figures, and a fingerprint of the
+    source are saved every checkpoint_interval records. With the resume
+    option, a load continues after the last checkpoint.
+
+    If the incremental option is set (True for a file next to the source
+    or a store), chunks of records which were loaded without rejections
+    by the previous run are skipped, see ChunkFingerprints. Slices keep
+    the fingerprints of the previous run unless incremental_merge is
+    False (set for the shards of a ParallelLoader).
+
+    If the delete_missing option is set, records of the target which
+    were not part of the source are deleted once the load completes, see
+    delete_missing.
     """
     transformer_class = Transformer
     reader_class = csv.DictReader
@@ -114,6 +237,11 @@ class Loader(object):
     model_class = None
     extractor_class = Extractor
     persistence = None
+    # errors which reject a record instead of aborting the load
+    rejected_errors = (ValidationError, IntegrityError, DatabaseError,
+                       ValueError)
+    # errors of readers which reject a record
+    reader_errors = (UnicodeDecodeError, csv.Error, CSVReader.Error)
 
     def __init__(self, source, model_class=None, logger=None, options=None):
         self.source = source
@@ -130,20 +258,117 @@ class Loader(object):
         self.generator = self.generator_class(self.model_class,
                                               persistence=self.persistence,
                                               options=self.options)
+        self.checkpoints = self.get_checkpoint_store()
+        self.checkpoint_pos = None
+        self.unchanged_chunks = 0
+        self.seen = None
+        self.unseen = 0
+        if self.options.get('delete_missing'):
+            if self.options.get('incremental'):
+                raise ValueError(
+                    'delete_missing cannot be combined with incremental '
+                    'loads, records of skipped chunks are not seen.')
+            self.seen = KeySet()
+
+    def get_checkpoint_store(self):
+        """
+        Returns:
+            Checkpoint store or None.
+        """
+        store = self.options.get('checkpoint')
+        if store is True or (store is None and self.options.get('resume')):
+            return FileCheckpointStore.for_source(self.source)
+        return store or None
 
-    def process(self, extractor):
+    def get_chunk_fingerprints(self, chunk_size):
         """
-        This is broken out from below and should be better
-        organized.
+        Returns:
+            ChunkFingerprints: Fingerprints of the previous run or None if
+            the load is not incremental.
         """
+        store = self.options.get('incremental')
+        if store is True:
+            store = FileCheckpointStore.for_source(self.source, '.etlchunks')
+        if not store:
+            return None
+        return ChunkFingerprints(store, {
+            'model': self.model_class._meta.label,
+            'loader': type(self).__name__, 'chunk_size': chunk_size})
+
+    def resume(self):
+        """
+        Restricts the load to the records after the last checkpoint. The
+        extractor seeks there with an offset index. The checkpoint is
+        ignored if the source has changed.
 
-        try:
-            dic = extractor.next()
-            # dic = CaseInsensitiveDict(extractor.next())
-        except (UnicodeDecodeError, csv.Error) as e:
-            self.logger.reject(str(e))
+        Returns:
+            dict: The checkpoint or None.
+        """
+        checkpoint = self.checkpoints.load() if self.checkpoints else None
+        if checkpoint and self.options.get('merge_delete'):
+            self.logger.status('Checkpoints are ignored with merge_delete, '
+                               'starting from the beginning.')
+            return None
+        if not checkpoint:
+            self.logger.status('No checkpoint found.')
+            return None
+        if checkpoint.get('fingerprint') != fingerprint(self.source):
+            self.logger.status('Source changed since the checkpoint, '
+                               'starting from the beginning.')
+            return None
+        self.slice_begin = checkpoint['pos']
+        # the options are shared with the generator, the copy is not
+        self.extractor.options = dict(
+            self.options, slice_begin=self.slice_begin,
+            offset_index=self.options.get('offset_index') or True)
+        self.logger.status('Resuming at record %s.', self.slice_begin)
+        return checkpoint
+
+    def checkpoint(self, force=False):
+        """
+        Saves the position after the last logged record, which must be
+        committed, if checkpoint_interval records (default 10000) were
+        loaded since the last checkpoint.
+        """
+        if not self.checkpoints:
+            return
+        counter = self.logger.counter
+        interval = self.options.get('checkpoint_interval', 10000)
+        if not force and counter.pos - self.checkpoint_pos < interval:
             return
+        self.checkpoint_pos = counter.pos
+        self.checkpoints.save({
+            'pos': counter.pos,
+            'fingerprint': fingerprint(self.source),
+            'counter': {
+                'created': counter.created, 'updated': counter.updated,
+                'unchanged': counter.unchanged,
+                'rejected': counter.rejected}})
+
+    def extract(self, extractor):
+        """
+        Reads the next record.
+
+        Returns:
+            tuple: Data dictionary and rejection message, which is None
+            for valid records.
+        """
+        try:
+            return extractor.next(), None
+        except self.reader_errors as e:
+            return None, str(e)
+
+    def transform(self, entry):
+        """
+        Transforms a record returned by extract.
 
+        Returns:
+            tuple: Data dictionary and rejection message, which is None
+            for valid records.
+        """
+        dic, error = entry
+        if error:
+            return entry
         defaults = self.options.get('defaults') or {}
         transformer = self.transformer_class(dic, defaults=defaults)
         try:
@@ -152,43 +377,348 @@ class Loader(object):
             else:
                 raise ValidationError(transformer.error)
         except (ValidationError, ValueError, IndexError, KeyError) as e:
-            self.logger.reject(str(e), dic)
+            return dic, str(e)
+        return dic, None
+
+    def read(self, extractor):
+        """
+        Reads and transforms the next record.
+
+        Returns:
+            tuple: Data dictionary and rejection message, which is None
+            for valid records.
+        """
+        return self.transform(self.extract(extractor))
+
+    def atomic(self):
+        """
+        Transaction which keeps the generator's caches consistent with
+        the database.
+        """
+        return atomic(self.generator.get_journals())
+
+    @staticmethod
+    def error_message(exc):
+        if hasattr(exc, 'message_dict'):
+            return ', '.join(' '.join([f, '(%s)' % ', '.join(err)])
+                             for f, err in exc.message_dict.items())
+        return str(exc)
+
+    def accept(self, res, dic, instance):
+        """
+        Logs a record which was written and keeps its primary key if
+        missing records are to be deleted. Records created in bulk
+        without persistence criteria have no primary key on backends
+        which do not return keys from bulk inserts, they are counted as
+        unseen.
+        """
+        if self.seen is not None and instance is not None:
+            if instance.pk is None:
+                self.unseen += 1
+            else:
+                self.seen.add(instance.pk)
+        self.logger.accept(res, dic, instance)
+
+    def delete_missing(self):
+        """
+        Deletes the records of the target (restricted by the
+        delete_filter option) which were not part of the source with
+        DELETE ... WHERE pk IN queries of delete_batch_size records
+        (default 1000) in a single transaction. If the soft_delete option
+        is set (field values, e.g. {'active': False}), records are
+        updated with these values instead.
+
+        Nothing is deleted if only part of the source was loaded, if
+        records were rejected or written without a known primary key
+        (their target records are unknown), or if more than the
+        delete_threshold fraction (default 0.1) of the target records
+        would be removed.
+        """
+        counter = self.logger.counter
+        if self.slice_begin or self.slice_end:
+            self.logger.status(
+                'Deletion skipped, the source was loaded partially.')
+            return
+        if counter.rejected:
+            self.logger.status(
+                'Deletion skipped, %s records were rejected.',
+                counter.rejected)
+            return
+        if self.unseen:
+            self.logger.status(
+                'Deletion skipped, the primary keys of %s records are '
+                'unknown.', self.unseen)
+            return
+        manager = self.model_class._default_manager
+        soft_delete = self.options.get('soft_delete')
+        queryset = manager.filter(**(self.options.get('delete_filter') or {}))
+        if soft_delete:
+            queryset = queryset.exclude(**soft_delete)
+        total = queryset.count()
+        limit = total * self.options.get('delete_threshold', 0.1)
+        missing = []
+        for pk in queryset.values_list('pk', flat=True).iterator():
+            if pk in self.seen:
+                continue
+            missing.append(pk)
+            if len(missing) > limit:
+                self.logger.status(
+                    'Deletion aborted, more than %s of %s records would be '
+                    'removed.', int(limit), total)
+                return
+        with self.atomic():
+            for batch in chunked(
+                    missing, self.options.get('delete_batch_size', 1000)):
+                batch = manager.filter(pk__in=batch)
+                if soft_delete:
+                    batch.update(**soft_delete)
+                else:
+                    batch.delete()
+        self.logger.delete(len(missing))
+
+    def process(self, extractor):
+        """
+        This is broken out from below and should be better
+        organized.
+        """
+        dic, error = self.read(extractor)
+        if error:
+            self.logger.reject(error, dic)
             return
 
         try:
-            with transaction.atomic():
+            with self.atomic():
                 instance = self.generator.get_instance(dic)
-        except (ValidationError, IntegrityError,
-                DatabaseError, ValueError) as exc:
-            if hasattr(exc, 'message_dict'):
-                msg = ', '.join(' '.join([f, '(%s)' % ', '.join(err)])
-                                for f, err in exc.message_dict.items())
-            else:
-                msg = str(exc)
-            self.logger.reject(msg, dic)
+        except self.rejected_errors as exc:
+            self.logger.reject(self.error_message(exc), dic)
             return
 
-        self.logger.accept(self.generator.res, dic, instance)
+        self.accept(self.generator.res, dic, instance)
+
+    def write_rows(self, dics):
+        """
+        Writes a list of dictionaries without transaction handling, with
+        the generator's bulk operations if the batch_size option is set.
+
+        Returns:
+            list: (status, instance, None) for each dictionary.
+        """
+        batch_size = self.options.get('batch_size')
+        ret = []
+        if not batch_size:
+            for dic in dics:
+                instance = self.generator.get_instance(
+                    dic.copy() if isinstance(dic, dict) else dic)
+                ret.append((self.generator.res, instance, None))
+            return ret
+        for batch in chunked(dics, batch_size):
+            instances = self.generator.get_instances(batch)
+            ret.extend((res, instance, None) for res, instance
+                       in zip(self.generator.results, instances))
+        return ret
+
+    def isolate(self, dics):
+        """
+        Writes a list of dictionaries within a savepoint. If writing
+        fails, the list is bisected with nested savepoints until the
+        offending dictionaries are isolated.
+
+        Returns:
+            list: (status, instance, error message) for each dictionary.
+        """
+        try:
+            with self.atomic():
+                return self.write_rows(dics)
+        except self.rejected_errors as exc:
+            if len(dics) == 1:
+                return [(None, None, self.error_message(exc))]
+        middle = len(dics) // 2
+        return self.isolate(dics[:middle]) + self.isolate(dics[middle:])
+
+    def write_batch(self, dics):
+        """
+        Writes a list of dictionaries in a single transaction. Offending
+        records are isolated by bisection and rejected, all others are
+        committed, see isolate. If the commit itself fails, dictionaries
+        are written in a transaction each.
+
+        Returns:
+            list: (status, instance, error message) for each dictionary.
+        """
+        try:
+            with self.atomic():
+                return self.isolate(dics)
+        except self.rejected_errors:
+            pass
+        return [result for dic in dics for result in self.isolate([dic])]
+
+    def process_batch(self, entries):
+        """
+        Writes a batch of records read with self.read and logs the
+        results in the order of the source.
+
+        Args:
+            entries (list): (dictionary, rejection message) tuples.
+        """
+        dics = [dic for dic, error in entries if not error]
+        results = iter(self.write_batch(dics) if dics else [])
+        for dic, error in entries:
+            if error:
+                self.logger.reject(error, dic)
+                continue
+            res, instance, error = next(results)
+            if error:
+                self.logger.reject(error, dic)
+            else:
+                self.accept(res, dic, instance)
 
     def load(self):
         """
         Loads data into database using Django models and error logging.
         """
         self.logger.status('Opening %s.', self.filename)
+        checkpoint = self.resume() if self.options.get('resume') else None
         self.logger.start()
+        if checkpoint:
+            for name, value in checkpoint['counter'].items():
+                setattr(self.logger.counter, name, value)
+        batch_size = self.options.get('batch_size')
+        incremental = self.options.get('incremental')
+        chunk_size = (self.options.get('chunk_size') or batch_size or
+                      (1000 if incremental else 1))
+        fingerprints = self.get_chunk_fingerprints(chunk_size)
 
         with self.extractor as extractor:
 
-            while self.slice_begin and self.slice_begin > self.logger.counter:
+            skipped = getattr(self.extractor, 'skipped', 0)
+            if skipped:
+                self.logger.skip(count=skipped)
+            while (self.slice_begin and
+                   self.slice_begin > self.logger.counter.pos):
                 extractor.next()
                 self.logger.skip()
-
-            while not self.slice_end or self.slice_end >= self.logger.counter:
-                try:
-                    self.process(extractor)
-                except StopIteration:
-                    break
+            self.checkpoint_pos = self.logger.counter.pos
+
+            if fingerprints:
+                self.load_batches(extractor, chunk_size, fingerprints)
+            elif self.options.get('pipeline'):
+                self.load_pipelined(extractor, chunk_size)
+            elif batch_size or chunk_size > 1:
+                self.load_batches(extractor, chunk_size)
+            else:
+                while (not self.slice_end or
+                       self.slice_end >= self.logger.counter.pos):
+                    try:
+                        self.process(extractor)
+                    except StopIteration:
+                        break
+                    self.checkpoint()
 
             if self.generator.finalize():
+                if self.checkpoints:
+                    self.checkpoints.clear()
+                if self.seen is not None:
+                    self.delete_missing()
+                deleted = getattr(self.generator, 'deleted', 0)
+                if deleted:
+                    self.logger.delete(deleted)
+                if fingerprints:
+                    fingerprints.save(merge=self.options.get(
+                        'incremental_merge',
+                        bool(self.slice_begin or self.slice_end)))
+                    self.logger.metric(
+                        'unchanged chunks skipped', self.unchanged_chunks)
+                for name, value in self.generator.get_metrics().items():
+                    self.logger.metric(name, value)
                 self.logger.finish()
                 return self.logger.counter
+
+    def load_batches(self, extractor, chunk_size, fingerprints=None):
+        """
+        Reads chunks of records and writes each chunk in a single
+        transaction, see write_batch. Chunks are checked against the
+        fingerprints of the previous run if given, see load_chunk.
+        """
+        read = self.extract if fingerprints else self.read
+        position = self.logger.counter.pos
+        entries = []
+        while not self.slice_end or self.slice_end >= position:
+            try:
+                entries.append(read(extractor))
+            except StopIteration:
+                break
+            position += 1
+            if len(entries) >= chunk_size:
+                self.load_chunk(entries, fingerprints)
+                self.checkpoint()
+                entries = []
+        if entries:
+            self.load_chunk(entries, fingerprints)
+
+    def load_chunk(self, entries, fingerprints=None):
+        """
+        Writes a chunk of records. With fingerprints, the records are
+        extracted but not yet transformed; a chunk which is unchanged
+        since the previous run is skipped without transforming it.
+        """
+        if not fingerprints:
+            self.process_batch(entries)
+            return
+        digest = fingerprints.fingerprint([dic for dic, error in entries])
+        if fingerprints.unchanged(digest):
+            self.logger.skip(count=len(entries))
+            self.unchanged_chunks += 1
+            return
+        rejected = self.logger.counter.rejected
+        self.process_batch([self.transform(entry) for entry in entries])
+        if self.logger.counter.rejected == rejected:
+            fingerprints.add(digest)
+
+    def extract_blocks(self, extractor, size):
+        """
+        Yields lists of records returned by extract until the end of the
+        source or slice.
+        """
+        position = self.logger.counter.pos
+        block = []
+        while not self.slice_end or self.slice_end >= position:
+            try:
+                block.append(self.extract(extractor))
+            except StopIteration:
+                break
+            position += 1
+            if len(block) >= size:
+                yield block
+                block = []
+        if block:
+            yield block
+
+    def load_pipelined(self, extractor, chunk_size):
+        """
+        Reads, transforms, and writes records in three stages. Reading
+        and transforming run in threads of their own which feed bounded
+        queues, records are written in chunks by the calling thread, see
+        write_batch. Queue metrics are reported when the load finishes.
+        """
+        block_size = min(chunk_size, 100)
+        pipeline = Pipeline(
+            max(self.options.get('queue_size', 10000) // block_size, 1))
+        try:
+            blocks = pipeline.stage(
+                'read', self.extract_blocks(extractor, block_size))
+            blocks = pipeline.stage('transform', (
+                [self.transform(entry) for entry in block]
+                for block in blocks))
+            entries = []
+            for block in blocks:
+                entries.extend(block)
+                while len(entries) >= chunk_size:
+                    self.process_batch(entries[:chunk_size])
+                    self.checkpoint()
+                    entries = entries[chunk_size:]
+            if entries:
+                self.process_batch(entries)
+        finally:
+            pipeline.close()
+        for name, value in pipeline.get_metrics().items():
+            self.logger.metric(name, value)
@@ -1,5 +1,6 @@
 from __future__ import print_function, absolute_import
 
+from collections import OrderedDict
 from datetime import datetime
 
 from .types import GenerationStatus
@@ -11,11 +12,14 @@ class Counter(object):
         self.rejected = 0
         self.created = 0
         self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
         self.start_time = datetime.now()
         self.finish_time = None
+        self.metrics = OrderedDict()
 
-    def next(self):
-        self.pos += 1
+    def next(self, step=1):
+        self.pos += step
 
     def finish(self):
         self.finish_time = datetime.now()
@@ -32,6 +36,29 @@ class Counter(object):
         self.rejected += 1
         self.next()
 
+    def keep(self):
+        """Counts a record which was found unchanged."""
+        self.unchanged += 1
+        self.next()
+
+    def delete(self, count=1):
+        """Counts records deleted from the target, not part of the source."""
+        self.deleted += count
+
+    def merge(self, other):
+        """
+        Adds the figures of another counter, e.g. of a worker process.
+        """
+        self.created += other.created
+        self.updated += other.updated
+        self.unchanged += other.unchanged
+        self.rejected += other.rejected
+        self.deleted += other.deleted
+        self.pos = max(self.pos, other.pos)
+        self.start_time = min(self.start_time, other.start_time)
+        for name, value in other.metrics.items():
+            self.metrics[name] = self.metrics.get(name, 0) + value
+
     @property
     def time(self):
         return self.finish_time - self.start_time
@@ -63,14 +90,26 @@ class BaseLogger:
             self.counter.create()
         elif action == GenerationStatus.Updated:
             self.counter.update()
+        elif action == GenerationStatus.Unchanged:
+            self.counter.keep()
         else:
             self.counter.next()
 
     def reject(self, msg, dic=None):
         self.counter.reject()
 
-    def skip(self, msg=None):
-        self.counter.next()
+    def skip(self, msg=None, count=1):
+        self.counter.next(count)
+
+    def delete(self, count=1):
+        self.counter.delete(count)
+
+    def metric(self, name, value):
+        """
+        Records additional figures, e.g. cache statistics, which are
+        reported when the load finishes.
+        """
+        self.counter.metrics[name] = value
 
 
 class StdoutLogger(BaseLogger):
@@ -89,12 +128,18 @@ class StdoutLogger(BaseLogger):
             '',
             '{} created'.format(self.counter.created),
             '{} updated'.format(self.counter.updated),
+            '{} unchanged'.format(self.counter.unchanged),
             '{} rejected'.format(self.counter.rejected),
+            '{} deleted'.format(self.counter.deleted),
             '',
             'Data extraction finished {}'.format(self.counter.finish_time),
             'Time spent: {}'.format(self.counter.time),
             '',
         ]
+        if self.counter.metrics:
+            lines.extend('{} {}'.format(value, name) for name, value
+                         in self.counter.metrics.items())
+            lines.append('')
         if msg:
             lines.append(msg)
         print('\n'.join(lines))
@@ -0,0 +1,230 @@
+from __future__ import absolute_import
+
+import io
+import json
+import mmap
+import os
+
+
+class RecordScanner(object):
+    """
+    Finds the ends of the records of delimited text as the csv module
+    splits them. A quote character starts a quoted field only at the
+    start of a field, i.e. at the start of a record or after a delimiter
+    (and spaces with skipinitialspace); elsewhere it is an ordinary
+    character. Newlines within quoted fields do not end a record, quote
+    characters within quoted fields are doubled. Escape characters are
+    not supported.
+
+    Works on bytes, mmap objects, and text alike; the tokens must be of
+    the same type as the scanned data.
+
+    Args:
+        delimiter: Field delimiter.
+        quotechar: Quote character or None if quoting is off.
+        skipinitialspace (bool): As for csv.reader.
+        newline: Line ending, defaults to a newline of the type of
+            delimiter.
+    """
+
+    def __init__(self, delimiter=b',', quotechar=b'"', skipinitialspace=False,
+                 newline=None):
+        self.delimiter = delimiter
+        self.quotechar = quotechar
+        self.skipinitialspace = skipinitialspace
+        if newline is None:
+            newline = b'\n' if isinstance(delimiter, bytes) else u'\n'
+        self.newline = newline
+        self.space = b' ' if isinstance(newline, bytes) else u' '
+
+    def field_start(self, buffer, position, start):
+        """
+        Returns:
+            bool: True if a field starts at position, which is not part
+            of a quoted field, scanning from a record at start.
+        """
+        while True:
+            if position <= start:
+                return True
+            previous = buffer[position - 1:position]
+            if previous == self.delimiter or previous == self.newline:
+                return True
+            if not (self.skipinitialspace and previous == self.space):
+                return False
+            position -= 1
+
+    def open_quote(self, buffer, start, begin, end):
+        """
+        Returns:
+            int: Offset of the first quote character between begin and end
+            starting a quoted field or -1.
+        """
+        position = buffer.find(self.quotechar, begin, end)
+        while position >= 0 and not self.field_start(buffer, position, start):
+            position = buffer.find(self.quotechar, position + 1, end)
+        return position
+
+    def close_quote(self, buffer, position):
+        """
+        Returns:
+            int: Offset after the quote character closing the quoted field
+            which starts before position, or the size of the buffer.
+        """
+        while True:
+            position = buffer.find(self.quotechar, position)
+            if position < 0:
+                return len(buffer)
+            following = buffer[position + 1:position + 2]
+            if following != self.quotechar:
+                return position + 1
+            position += 2
+
+    def find(self, buffer, start, offset=None):
+        """
+        Args:
+            buffer: Scanned data.
+            start (int): Offset at which a record starts.
+            offset (int): Offset to search from, defaults to start.
+
+        Returns:
+            int: Offset of the first newline at or after offset which ends
+            a record, or the size of the buffer.
+        """
+        size = len(buffer)
+        offset = start if offset is None else offset
+        position = start
+        while True:
+            end = buffer.find(self.newline, max(position, offset))
+            if end < 0:
+                end = size
+            if self.quotechar is None:
+                return end
+            quote = self.open_quote(buffer, start, position, end)
+            if quote < 0:
+                return end
+            position = self.close_quote(buffer, quote + 1)
+            if position >= size:
+                return size
+
+
+class OffsetIndex(object):
+    """
+    Sparse index of the byte offsets at which records of a delimited
+    text file start, used to seek to a slice without parsing the records
+    before it. The offset of every step-th record is stored. The first
+    line (e.g. the header) is record 0, blank lines are not counted
+    since the csv module skips them.
+
+    The index is built with a single pass over the file and stored in a
+    sidecar file next to the source (source name + suffix), which is
+    replaced atomically. It is reused as long as size and modification
+    time of the source are unchanged. If the sidecar cannot be written,
+    the index is kept in memory only.
+
+    Newlines within quoted fields do not end a record if quotechar is
+    set, see RecordScanner for the quoting rules.
+
+    Args:
+        path (str): Path to the source file.
+        step (int): Number of records between stored offsets.
+        quotechar (str): Quote character or None if quoting is off.
+        delimiter (str): Field delimiter.
+        skipinitialspace (bool): As for csv.reader.
+    """
+    suffix = '.etlidx'
+
+    def __init__(self, path, step=1000, quotechar='"', delimiter=',',
+                 skipinitialspace=False):
+        self.path = path
+        self.step = step
+        self.quotechar = quotechar
+        self.delimiter = delimiter
+        self.skipinitialspace = skipinitialspace
+        self.offsets = None
+        self.count = None
+
+    @property
+    def sidecar(self):
+        return self.path + self.suffix
+
+    def signature(self):
+        stat = os.stat(self.path)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime,
+                'step': self.step, 'quotechar': self.quotechar,
+                'delimiter': self.delimiter,
+                'skipinitialspace': self.skipinitialspace}
+
+    def load(self):
+        """
+        Loads the index from the sidecar file or builds it if the
+        sidecar is missing or outdated.
+        """
+        signature = self.signature()
+        try:
+            with io.open(self.sidecar, encoding='utf-8') as fil:
+                data = json.load(fil)
+        except (IOError, OSError, ValueError):
+            data = None
+        if data and data.get('signature') == signature and 'count' in data:
+            self.offsets, self.count = data['offsets'], data['count']
+            return
+        self.offsets, self.count = self.build()
+        # concurrent builders write temporary files of their own
+        temp = '{}.{}.tmp'.format(self.sidecar, os.getpid())
+        try:
+            with io.open(temp, 'w', encoding='utf-8') as fil:
+                fil.write(json.dumps({
+                    'signature': signature, 'offsets': self.offsets,
+                    'count': self.count}))
+            os.replace(temp, self.sidecar)
+        except (IOError, OSError):
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+    def build(self):
+        """
+        Scans the source file.
+
+        Returns:
+            tuple: Offsets of records 0, step, 2 * step, ... and the
+            number of records.
+        """
+        scanner = RecordScanner(
+            self.delimiter.encode('utf-8'),
+            self.quotechar.encode('utf-8') if self.quotechar else None,
+            self.skipinitialspace)
+        offsets = [0]
+        record = 0
+        with io.open(self.path, 'rb') as fil:
+            try:
+                buffer = mmap.mmap(fil.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                return offsets, record
+            with buffer:
+                size = len(buffer)
+                start = 0
+                while start < size:
+                    end = scanner.find(buffer, start)
+                    blank = end == start or (
+                        end == start + 1 and buffer[start] == 13)
+                    start = end + 1
+                    if blank:
+                        continue
+                    record += 1
+                    if record % self.step == 0 and end < size:
+                        offsets.append(start)
+        return offsets, record
+
+    def find(self, record):
+        """
+        Returns:
+            tuple: Number and offset of the closest indexed record at or
+            before the given record.
+        """
+        if self.offsets is None:
+            self.load()
+        index = min(record // self.step, len(self.offsets) - 1)
+        return index * self.step, self.offsets[index]
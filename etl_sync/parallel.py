@@ -0,0 +1,223 @@
+from __future__ import absolute_import
+
+import multiprocessing
+import os
+
+from django.db import connections
+
+from .checkpoints import FileCheckpointStore
+from .loaders import Loader
+from .logging import StdoutLogger
+
+
+class WorkerLogger(StdoutLogger):
+    """
+    Logger for worker processes. Rejections are printed, the summary is
+    left to the ParallelLoader.
+    """
+
+    def status(self, msg, *args):
+        pass
+
+    def finish(self, msg=None):
+        self.counter.finish()
+
+
+def init_worker():
+    """
+    Prepares a worker process, which must not use database connections
+    inherited from the parent process.
+    """
+    import django
+    from django.apps import apps
+    if not apps.ready:
+        django.setup()
+    connections.close_all()
+
+
+class FingerprintCollector(object):
+    """
+    Checkpoint store of a shard in incremental loads. Hands the chunk
+    fingerprints of the previous run to the shard and keeps those saved
+    by the shard, so that the ParallelLoader saves the fingerprints of
+    all shards at once instead of shards overwriting each other's.
+
+    Args:
+        data (dict): Fingerprints of the previous run or None.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.saved = None
+
+    def load(self):
+        return self.data
+
+    def save(self, data):
+        self.saved = data
+
+
+def load_shard(loader_class, source, model_class, logger_class, options):
+    """
+    Loads a slice of the source.
+
+    Returns:
+        tuple: The counter of the loader's logger and the fingerprints
+        saved by an incremental load or None.
+    """
+    loader = loader_class(source, model_class=model_class,
+                          logger=logger_class(), options=options)
+    counter = loader.load() or loader.logger.counter
+    collector = options.get('incremental')
+    return counter, collector.saved if collector else None
+
+
+class ParallelLoader(object):
+    """
+    Loads a source with a pool of worker processes. The source is split
+    into shards of records (slices), which are loaded by instances of
+    loader_class. The workers seek to their shards with the offset index
+    (see Extractor), the counters of all shards are merged into one
+    report.
+
+    Related records are resolved with the concurrent option of the
+    generators.
+
+    Args:
+        source (str): Path to the source, must be readable by all workers.
+        loader_class (Loader): Loader subclass, must be importable.
+        model_class (Model): Passed on to loader_class.
+        logger (BaseLogger): Logger for the merged report.
+        options (dict): Passed on to loader_class. Additional options are
+            workers (number of processes, defaults to the number of
+            cores) and shards (number of shards, defaults to four per
+            worker). With workers set to 0 all shards are loaded in the
+            current process. With the incremental option the shards
+            skip unchanged chunks, their fingerprints are saved once
+            all shards are loaded.
+    """
+    loader_class = Loader
+    worker_logger_class = WorkerLogger
+
+    def __init__(self, source, loader_class=None, model_class=None,
+                 logger=None, options=None):
+        self.source = source
+        self.loader_class = loader_class or self.loader_class
+        self.model_class = model_class or self.loader_class.model_class
+        self.logger = logger or StdoutLogger()
+        self.options = options or {}
+        self.workers = self.options.get('workers')
+        if self.workers is None:
+            self.workers = os.cpu_count() or 1
+        self.shards = self.options.get('shards') or 4 * max(self.workers, 1)
+
+    def count(self):
+        options = dict(self.options)
+        options.pop('slice_begin', None)
+        options.pop('slice_end', None)
+        extractor = self.loader_class.extractor_class(
+            self.source, self.loader_class.reader_class,
+            self.loader_class.reader_kwargs, options=options)
+        return extractor.count()
+
+    def get_shards(self):
+        """
+        Returns:
+            list: (slice_begin, slice_end) for each shard.
+        """
+        begin = self.options.get('slice_begin') or 1
+        end = self.options.get('slice_end')
+        count = self.count()
+        if count is None:
+            raise ValueError(
+                'Cannot determine the number of records of {}'.format(
+                    self.source))
+        if not end or end > count:
+            end = count
+        total = end - begin + 1
+        if total <= 0:
+            return []
+        size = -(-total // self.shards)
+        return [(start, min(start + size - 1, end))
+                for start in range(begin, end + 1, size)]
+
+    def get_fingerprint_store(self):
+        """
+        Returns:
+            Store of the chunk fingerprints or None if the load is not
+            incremental, see Loader.get_chunk_fingerprints.
+        """
+        store = self.options.get('incremental')
+        if store is True:
+            store = FileCheckpointStore.for_source(self.source, '.etlchunks')
+        return store or None
+
+    def get_tasks(self, fingerprints=None):
+        """
+        Args:
+            fingerprints (dict): Chunk fingerprints of the previous run
+                for incremental loads.
+        """
+        tasks = []
+        for begin, end in self.get_shards():
+            options = dict(self.options, slice_begin=begin, slice_end=end,
+                           concurrent=True)
+            options.setdefault('offset_index', True)
+            options.pop('workers', None)
+            # shards would overwrite each other's checkpoints
+            options.pop('checkpoint', None)
+            options.pop('resume', None)
+            if options.get('incremental'):
+                options['incremental'] = FingerprintCollector(fingerprints)
+                options['incremental_merge'] = False
+            tasks.append((self.loader_class, self.source, self.model_class,
+                          self.worker_logger_class, options))
+        return tasks
+
+    def load(self):
+        """
+        Loads all shards and reports the merged counters.
+
+        Returns:
+            Counter: Merged counter.
+        """
+        self.logger.status('Opening %s.', self.source)
+        self.logger.start()
+        store = self.get_fingerprint_store()
+        previous = store.load() if store else None
+        tasks = self.get_tasks(previous)
+        if self.workers:
+            # connections must not be shared with forked processes
+            connections.close_all()
+            pool = multiprocessing.Pool(self.workers, init_worker)
+            try:
+                results = pool.starmap(load_shard, tasks, chunksize=1)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [load_shard(*task) for task in tasks]
+        for counter, _ in results:
+            self.logger.counter.merge(counter)
+        if store:
+            self.save_fingerprints(
+                store, previous, [saved for _, saved in results if saved])
+        self.logger.finish()
+        return self.logger.counter
+
+    def save_fingerprints(self, store, previous, saved):
+        """
+        Saves the chunk fingerprints of all shards, merged with those of
+        the previous run if only part of the source was loaded.
+        """
+        if not saved:
+            return
+        signature = saved[0]['signature']
+        chunks = set()
+        for data in saved:
+            chunks.update(data['chunks'])
+        merge = self.options.get('slice_begin') or self.options.get(
+            'slice_end')
+        if merge and previous and previous.get('signature') == signature:
+            chunks.update(previous['chunks'])
+        store.save({'signature': signature, 'chunks': sorted(chunks)})
@@ -0,0 +1,156 @@
+from __future__ import absolute_import
+
+import threading
+import time
+from collections import OrderedDict
+from queue import Empty, Full, Queue
+
+# marks the end of a stage's output
+END = object()
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class MeteredQueue(Queue):
+    """
+    Bounded queue between two pipeline stages. Records the time the
+    producer waits for free slots, the time the consumer waits for
+    items, and the queue depth. Waiting is given up once the pipeline is
+    stopped.
+
+    Args:
+        maxsize (int): Maximum number of items.
+        stopped (threading.Event): Set when the pipeline is closed.
+    """
+    poll_interval = 0.1
+
+    def __init__(self, maxsize, stopped):
+        Queue.__init__(self, maxsize)
+        self.stopped = stopped
+        self.put_wait = 0.0
+        self.get_wait = 0.0
+        self.depth = 0
+        self.gets = 0
+
+    def put(self, item):
+        start = time.time()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    Queue.put(self, item, timeout=self.poll_interval)
+                    return
+                except Full:
+                    pass
+            raise PipelineStopped
+        finally:
+            self.put_wait += time.time() - start
+
+    def get(self):
+        self.depth += self.qsize()
+        self.gets += 1
+        start = time.time()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    return Queue.get(self, timeout=self.poll_interval)
+                except Empty:
+                    pass
+            raise PipelineStopped
+        finally:
+            self.get_wait += time.time() - start
+
+
+class Stage(threading.Thread):
+    """
+    Thread which puts the blocks of an iterable into a queue. An
+    exception raised by the iterable is passed on to the consumer, see
+    consume.
+    """
+
+    def __init__(self, blocks, output):
+        super(Stage, self).__init__()
+        self.daemon = True
+        self.blocks = blocks
+        self.output = output
+        self.error = None
+
+    def run(self):
+        try:
+            for block in self.blocks:
+                self.output.put(block)
+        except PipelineStopped:
+            return
+        except BaseException as exc:
+            self.error = exc
+        try:
+            self.output.put(END)
+        except PipelineStopped:
+            pass
+
+
+def consume(queue, stage):
+    """
+    Yields the blocks of a stage and raises its exception if any.
+    """
+    while True:
+        block = queue.get()
+        if block is END:
+            if stage.error is not None:
+                raise stage.error
+            return
+        yield block
+
+
+class Pipeline(object):
+    """
+    Chain of stages connected by bounded queues. Each stage runs in a
+    thread of its own, the last one is consumed by the calling thread.
+    Memory is bounded by the queue sizes.
+
+    Args:
+        queue_size (int): Maximum number of blocks per queue.
+    """
+
+    def __init__(self, queue_size):
+        self.queue_size = queue_size
+        self.stopped = threading.Event()
+        self.queues = OrderedDict()
+        self.stages = []
+
+    def stage(self, name, blocks):
+        """
+        Starts a stage iterating blocks in a thread.
+
+        Returns:
+            iterator: Blocks produced by the stage.
+        """
+        queue = MeteredQueue(self.queue_size, self.stopped)
+        stage = Stage(blocks, queue)
+        self.queues[name] = queue
+        self.stages.append(stage)
+        stage.start()
+        return consume(queue, stage)
+
+    def close(self):
+        self.stopped.set()
+        for stage in self.stages:
+            stage.join()
+
+    def get_metrics(self):
+        """
+        Returns the average depth of each queue, the time its producer
+        was blocked by a full queue (the consumer is the bottleneck), and
+        the time its consumer waited for input (the producer is the
+        bottleneck).
+        """
+        metrics = OrderedDict()
+        for name, queue in self.queues.items():
+            metrics['{} queue depth'.format(name)] = round(
+                float(queue.depth) / max(queue.gets, 1), 1)
+            metrics['{} stage blocked (s)'.format(name)] = round(
+                queue.put_wait, 3)
+            metrics['{} stage awaited (s)'.format(name)] = round(
+                queue.get_wait, 3)
+        return metrics
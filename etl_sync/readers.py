@@ -2,8 +2,21 @@
 from __future__ import print_function
 from future.utils import iteritems
 
+import csv
+import io
+import mmap
+import multiprocessing
+import os
 import warnings
-from osgeo import osr, ogr
+from collections.abc import Mapping
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from .compression import detect_compression
+from .offsets import OffsetIndex, RecordScanner
 
 
 def unicode_dic(dic, encoding):
@@ -28,11 +41,523 @@ def unicode_dic(dic, encoding):
     return new_dic
 
 
+class Row(Mapping):
+    """
+    Record returned by CSVReader. Values are kept in the list returned by
+    the csv module, the field names and their positions are shared by
+    all records of a file (see make_row_class). Behaves like a read-only
+    dictionary, copy returns a dictionary.
+    """
+    __slots__ = ('values', )
+    fields = ()
+    index = {}
+
+    def __init__(self, values):
+        self.values = values
+
+    def __getitem__(self, key):
+        return self.values[self.index[key]]
+
+    def __iter__(self):
+        return iter(self.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def __repr__(self):
+        return repr(self.copy())
+
+    def items(self):
+        values = self.values
+        return [(field, values[self.index[field]]) for field in self.fields]
+
+    def copy(self):
+        return dict(self.items())
+
+
+def make_row_class(fieldnames):
+    """
+    Returns a Row class for the given field names. Of repeated names the
+    last column is used, as with csv.DictReader.
+    """
+    index = dict((name, position) for position, name
+                 in enumerate(fieldnames))
+    fields = tuple(name for name in dict.fromkeys(fieldnames))
+    return type('Row', (Row, ), {
+        '__slots__': (), 'fields': fields, 'index': index})
+
+
+class CSVReader(object):
+    """
+    Reader for delimited text based on the C implementation of the csv
+    module. Duck-typed to csv.DictReader, but records are returned as
+    read-only Row objects, which Transformer consumes like dictionaries.
+    Set as reader_class of loaders which do not modify records before
+    Transformer.remap. Missing trailing values are set to restval,
+    surplus values are dropped.
+
+    Args:
+        f (file): Text file or file-like object.
+        fieldnames (Optional[list]): Field names, read from the first line
+            if not given.
+        restval: Value for missing fields. Defaults to None.
+        **kwargs: Dialect and formatting parameters of csv.reader.
+    """
+    Error = csv.Error
+
+    def __init__(self, f, fieldnames=None, restval=None, dialect='excel',
+                 **kwargs):
+        self.reader = csv.reader(f, dialect, **kwargs)
+        self._fieldnames = fieldnames
+        self.restval = restval
+        self.row_class = None
+        self.size = 0
+
+    @property
+    def fieldnames(self):
+        if self._fieldnames is None:
+            try:
+                self._fieldnames = next(self.reader)
+            except StopIteration:
+                pass
+        return self._fieldnames
+
+    @property
+    def line_num(self):
+        return self.reader.line_num
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.row_class is None:
+            if self.fieldnames is None:
+                raise StopIteration
+            self.row_class = make_row_class(self.fieldnames)
+            self.size = len(self.fieldnames)
+        row = next(self.reader)
+        while not row:
+            row = next(self.reader)
+        if len(row) < self.size:
+            row.extend([self.restval] * (self.size - len(row)))
+        return self.row_class(row)
+
+    next = __next__
+
+
+class MmapCSVReader(object):
+    """
+    Reader for large local delimited text files. The file is memory
+    mapped and decoded in blocks, records are split and only the fields
+    in columns are kept. Processes reading the same file share the page
+    cache. Duck-typed to csv.DictReader, records are returned as
+    Row objects.
+
+    Newlines within quoted fields do not end a record unless quoting is
+    csv.QUOTE_NONE, see RecordScanner. Records containing the quote
+    character are parsed with the csv module, all others are split at
+    the delimiter. Blank
+    lines are skipped. The encoding must be ASCII compatible, e.g.
+    UTF-8 or Latin-1. Close the reader or use it as a context manager
+    to unmap the file.
+
+    Args:
+        f (file or str): File opened from a path, or the path.
+        fieldnames (Optional[list]): Field names, read from the first line
+            if not given.
+        columns (Optional[list]): Field names to decode, defaults to all.
+        encoding (Optional[str]): Encoding. Defaults to 'utf-8'.
+        byte_range (Optional[tuple]): Start and end offsets of the
+            records to read, the start must be the start of a record.
+            Records starting before the end are read.
+        restval: Value for missing fields. Defaults to None.
+        delimiter, quoting, quotechar, **kwargs: As for csv.reader.
+        block_size (Optional[int]): Number of bytes decoded at once.
+            Defaults to 1 MB.
+    """
+    Error = csv.Error
+
+    def __init__(self, f, fieldnames=None, columns=None, encoding='utf-8',
+                 byte_range=None, restval=None, delimiter=',',
+                 quoting=csv.QUOTE_MINIMAL, quotechar='"',
+                 block_size=1 << 20, **kwargs):
+        self.path = getattr(f, 'name', f)
+        if detect_compression(self.path):
+            raise ValueError(
+                'Cannot memory map compressed file {}.'.format(self.path))
+        self.encoding = encoding
+        self.restval = restval
+        self.delimiter = delimiter
+        self.quotechar = None
+        if quoting != csv.QUOTE_NONE:
+            self.quotechar = quotechar
+        self.kwargs = dict(kwargs, delimiter=delimiter, quoting=quoting,
+                           quotechar=quotechar)
+        self.block_size = block_size
+        self.lines = iter(())
+        self.quote_bytes = (self.quotechar.encode(encoding)
+                            if self.quotechar else None)
+        skipinitialspace = kwargs.get('skipinitialspace', False)
+        self.scanner = RecordScanner(
+            delimiter.encode(encoding), self.quote_bytes, skipinitialspace)
+        self.text_scanner = RecordScanner(
+            delimiter, self.quotechar, skipinitialspace)
+        with io.open(self.path, 'rb') as fil:
+            try:
+                self.buffer = mmap.mmap(
+                    fil.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # empty file
+                self.buffer = b''
+        self.pos = 0
+        self.end = len(self.buffer)
+        self._fieldnames = fieldnames
+        self.header = fieldnames is None
+        self.columns = columns
+        self.row_class = None
+        self.positions = None
+        if self.header:
+            self.fieldnames
+        if byte_range:
+            self.pos = max(self.pos, byte_range[0])
+            self.end = min(self.end, byte_range[1])
+
+    @property
+    def fieldnames(self):
+        if self._fieldnames is None:
+            line = self.next_line()
+            if line is not None:
+                self._fieldnames = self.split(line.decode(self.encoding))
+        return self._fieldnames
+
+    def record_end(self, start):
+        """
+        Returns:
+            int: Offset of the newline ending the record at start or the
+            size of the file.
+        """
+        return self.scanner.find(self.buffer, start)
+
+    def next_line(self, end=None):
+        """
+        Returns:
+            bytes: The next non-blank record starting before end (default
+            the end of the range) without line ending or None.
+        """
+        end = self.end if end is None else end
+        while self.pos < end:
+            start = self.pos
+            stop = self.record_end(start)
+            self.pos = stop + 1
+            if stop > start and self.buffer[stop - 1:stop] == b'\r':
+                stop -= 1
+            if stop > start:
+                return self.buffer[start:stop]
+        return None
+
+    def split(self, line, positions=None):
+        """
+        Splits a decoded record into fields, all or those at positions.
+        """
+        if self.quotechar is not None and self.quotechar in line:
+            fields = next(csv.reader([line], **self.kwargs))
+        else:
+            fields = line.split(self.delimiter)
+        if positions is None:
+            return fields
+        size = len(fields)
+        return [fields[position] if position < size else self.restval
+                for position in positions]
+
+    def read_block(self):
+        """
+        Reads the records starting within the next block_size bytes of the
+        range, decoding them at once.
+
+        Returns:
+            list: Decoded records, may contain blank lines.
+        """
+        limit = min(self.pos + self.block_size, self.end)
+        stop = self.scanner.find(self.buffer, self.pos, limit - 1)
+        text = self.buffer[self.pos:stop].decode(self.encoding)
+        self.pos = stop + 1
+        if self.quotechar is None or self.quotechar not in text:
+            return text.split('\n')
+        records = []
+        start = 0
+        while start <= len(text):
+            stop = self.text_scanner.find(text, start)
+            records.append(text[start:stop])
+            start = stop + 1
+        return records
+
+    def seek(self, count, step=1000):
+        """
+        Skips count records with an offset index of the given step, see
+        Extractor.seek.
+        """
+        header = 1 if self.header else 0
+        index = OffsetIndex(
+            self.path, step=step, quotechar=self.quotechar,
+            delimiter=self.delimiter,
+            skipinitialspace=self.scanner.skipinitialspace)
+        record, offset = index.find(count + header)
+        skipped = 0
+        if record > header:
+            self.pos, skipped = offset, record - header
+        while (skipped < count and
+               self.next_line(len(self.buffer)) is not None):
+            skipped += 1
+        return skipped
+
+    def close(self):
+        """
+        Unmaps the file, no records are read afterwards.
+        """
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.buffer = b''
+        self.lines = iter(())
+        self.pos = self.end = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.row_class is None:
+            if self.fieldnames is None:
+                raise StopIteration
+            columns = self.columns or self.fieldnames
+            index = dict((name, position) for position, name
+                         in enumerate(self.fieldnames))
+            self.positions = [index[name] for name in columns]
+            self.row_class = make_row_class(columns)
+        while True:
+            try:
+                line = next(self.lines)
+            except StopIteration:
+                if self.pos >= self.end:
+                    raise
+                self.lines = iter(self.read_block())
+                continue
+            if line.endswith('\r'):
+                line = line[:-1]
+            if line:
+                return self.row_class(self.split(line, self.positions))
+
+    next = __next__
+
+
+def parse_range(path, fieldnames, columns, byte_range, kwargs):
+    """
+    Parses the records of a byte range with MmapCSVReader in a worker of
+    ParallelCSVReader.
+
+    Returns:
+        list: Values of each record, or the message of csv.Error for
+        records that cannot be parsed.
+    """
+    rows = []
+    with MmapCSVReader(path, fieldnames=fieldnames, columns=columns,
+                       byte_range=byte_range, **kwargs) as reader:
+        while True:
+            try:
+                rows.append(reader.next().values)
+            except StopIteration:
+                return rows
+            except csv.Error as e:
+                rows.append(str(e))
+
+
+class ParallelCSVReader(object):
+    """
+    Reader for large local delimited text files parsing byte ranges in a
+    pool of worker processes. The file is split into ranges of about
+    chunk_size bytes which end at the end of a record, see RecordScanner.
+    The ranges are parsed with MmapCSVReader, at most two per
+    worker are in flight. Records are returned in the order of the file,
+    with ordered set to False in the order in which ranges complete.
+    Duck-typed to csv.DictReader, records are returned as Row objects.
+
+    In a daemonic process, e.g. a worker of ParallelLoader, the ranges
+    are parsed in the current process.
+
+    Args:
+        f (file or str): File opened from a path, or the path.
+        fieldnames (Optional[list]): Field names, read from the first line
+            if not given.
+        columns (Optional[list]): Field names to decode, defaults to all.
+        workers (Optional[int]): Number of processes, defaults to the
+            number of cores. With 0 ranges are parsed in the current
+            process.
+        chunk_size (Optional[int]): Bytes per range. Defaults to 8 MB.
+        ordered (Optional[bool]): Return records in file order. Defaults
+            to True.
+        **kwargs: As for MmapCSVReader.
+    """
+    Error = csv.Error
+
+    def __init__(self, f, fieldnames=None, columns=None, workers=None,
+                 chunk_size=8 << 20, ordered=True, **kwargs):
+        self.reader = MmapCSVReader(
+            f, fieldnames=fieldnames, columns=columns, **kwargs)
+        self.path = self.reader.path
+        self.columns = columns
+        self.kwargs = kwargs
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if multiprocessing.current_process().daemon:
+            workers = 0
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.ordered = ordered
+        self.pool = None
+        self.chunks = None
+        self.rows = iter(())
+        self.row_class = None
+
+    @property
+    def fieldnames(self):
+        return self.reader.fieldnames
+
+    def seek(self, count, step=1000):
+        """
+        Skips count records with an offset index, see Extractor.seek.
+        """
+        return self.reader.seek(count, step=step)
+
+    def boundary(self, start, end):
+        """
+        Returns:
+            int: Offset of the first record starting at or after end in
+            the range beginning with a record at start.
+        """
+        buffer = self.reader.buffer
+        stop = self.reader.scanner.find(buffer, start, end - 1)
+        return min(stop + 1, len(buffer))
+
+    def ranges(self):
+        """
+        Yields:
+            tuple: Start and end offsets of the ranges after the current
+            position of the reader.
+        """
+        start = self.reader.pos
+        size = len(self.reader.buffer)
+        while start < size:
+            end = start + self.chunk_size
+            end = size if end >= size else self.boundary(start, end)
+            yield start, end
+            start = end
+
+    def get_tasks(self):
+        for byte_range in self.ranges():
+            yield (self.path, self.fieldnames, self.columns, byte_range,
+                   self.kwargs)
+
+    def parse(self):
+        """
+        Yields:
+            list: Parsed records of each range.
+        """
+        if not self.workers:
+            for task in self.get_tasks():
+                yield parse_range(*task)
+            return
+        self.pool = multiprocessing.Pool(self.workers)
+        tasks = enumerate(self.get_tasks())
+        done = queue.Queue()
+        results = {}
+        pending = 0
+        expected = 0
+        while True:
+            while pending < 2 * self.workers:
+                task = next(tasks, None)
+                if task is None:
+                    break
+                index, args = task
+                self.pool.apply_async(
+                    parse_range, args,
+                    callback=lambda rows, index=index: done.put(
+                        (index, rows)),
+                    error_callback=lambda exc, index=index: done.put(
+                        (index, exc)))
+                pending += 1
+            if not pending:
+                break
+            index, rows = done.get()
+            pending -= 1
+            if isinstance(rows, Exception):
+                raise rows
+            if not self.ordered:
+                yield rows
+                continue
+            results[index] = rows
+            while expected in results:
+                yield results.pop(expected)
+                expected += 1
+        self.stop()
+
+    def stop(self):
+        """
+        Stops the worker processes.
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+    def close(self):
+        """
+        Stops the worker processes and unmaps the file.
+        """
+        self.stop()
+        self.reader.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.row_class is None:
+            if self.fieldnames is None:
+                raise StopIteration
+            self.row_class = make_row_class(self.columns or self.fieldnames)
+            self.chunks = self.parse()
+        while True:
+            for values in self.rows:
+                if isinstance(values, str):
+                    raise self.Error(values)
+                return self.row_class(values)
+            self.rows = iter(next(self.chunks))
+
+    next = __next__
+
+
 class OGRReader(object):
     """
     OGRReader for supported OGR formats. Partially (duck-typed)
     compatible with csv.DictReader.
 
+    Geometries are transformed to target_epsg unless the layer's spatial
+    reference is already the same (or not set) and returned as WKT, or
+    as WKB with wkb set, which InstanceGenerator reads without parsing
+    text.
+
     Args:
         source (bytes): Complete path to the source file.
         encoding (Optional[bytes]): Encoding string. Defaults to 'utf-8'.
@@ -41,17 +566,23 @@ class OGRReader(object):
         target_epsg (Optional[int]): Spatial reference. Defaults to 4326.
         feature_class_name (Optional[bytes]): Name of the feature class within ds.
             Defaults to the first returned by GDAL.
+        wkb (Optional[bool]): Return geometries as WKB. Defaults to False.
+        flatten (Optional[bool]): Reduce geometries to two dimensions.
+            Defaults to False.
     """
 
     def __init__(self, source, encoding='utf-8',
                  delimiter='', quoting='', target_epsg=4326,
-                 feature_class_name=''):
+                 feature_class_name='', wkb=False, flatten=False):
         # if source already open, close and reopen in OGR
+        from osgeo import osr, ogr
         if hasattr(source, 'name'):
             s = source.name
             source.close()
             source = s
         self.encoding = encoding
+        self.wkb = wkb
+        self.flatten = flatten
         self.ds = ogr.Open(source)
         if not feature_class_name:
             self.layer = self.ds.GetLayer(0)
@@ -61,11 +592,21 @@ class OGRReader(object):
         source = self.layer.GetSpatialRef()
         target = osr.SpatialReference()
         target.ImportFromEPSG(target_epsg)
-        self.transform = osr.CoordinateTransformation(source, target)
+        self.transform = None
+        if source is not None and not source.IsSame(target):
+            self.transform = osr.CoordinateTransformation(source, target)
 
     def length(self):
         return self.layer.GetFeatureCount()
 
+    def seek(self, count, step=None):
+        """
+        Skips count features by feature index, see Extractor.seek. The
+        step of an offset index is not needed.
+        """
+        self.layer.SetNextByIndex(count)
+        return count
+
     def next(self):
         feature = self.layer.GetNextFeature()
         try:
@@ -76,8 +617,14 @@ class OGRReader(object):
             ret = unicode_dic(ret, self.encoding)
             ogr_geom = feature.geometry()
             if ogr_geom:
-                ogr_geom.Transform(self.transform)
-                ret['geometry'] = ogr_geom.ExportToWkt()
+                if self.transform is not None:
+                    ogr_geom.Transform(self.transform)
+                if self.flatten:
+                    ogr_geom.FlattenTo2D()
+                if self.wkb:
+                    ret['geometry'] = bytes(ogr_geom.ExportToWkb())
+                else:
+                    ret['geometry'] = ogr_geom.ExportToWkt()
             return ret
 
 
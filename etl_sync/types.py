@@ -6,6 +6,7 @@ class GenerationStatus(Enum):
     Updated = 'updated'
     Exists = 'exists'
     Created = 'created'
+    Unchanged = 'unchanged'
 
 
 class CaseInsensitiveDict(dict):
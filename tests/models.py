@@ -148,6 +148,26 @@ class TwoRelatedAsUnique(models.Model):
     class Meta:
         unique_together = ('numero', 'another')
 
+class Station(models.Model):
+    code = models.PositiveIntegerField(unique=True)
+    name = models.CharField(max_length=10, blank=True)
+    lnames = models.ManyToManyField(AnotherModel)
+
+
+class Reading(models.Model):
+    station = models.CharField(max_length=10)
+    day = models.DateField()
+    value = models.DecimalField(max_digits=6, decimal_places=2, null=True)
+
+    class Meta:
+        unique_together = ('station', 'day')
+
+
 class RelatedRelated(models.Model):
     key = models.ForeignKey(TwoRelatedAsUnique, on_delete=models.CASCADE)
     value = models.CharField(max_length=5)
+
+
+class Checkpoint(models.Model):
+    key = models.CharField(max_length=255, unique=True)
+    data = models.TextField()
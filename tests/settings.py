@@ -3,7 +3,9 @@ import os
 DATABASES = {
     'default': {
         'ENGINE': 'django.contrib.gis.db.backends.spatialite',
-        'NAME': 'test.db'
+        'NAME': 'test.db',
+        # worker processes of parallel loads need a file
+        'TEST': {'NAME': 'test_etl_sync.db'}
     }
 }
 MEDIA_ROOT = os.path.dirname(os.path.realpath(__file__))+'/tests',
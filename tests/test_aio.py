@@ -0,0 +1,76 @@
+from __future__ import absolute_import
+
+import asyncio
+
+from django.test import TransactionTestCase
+
+from etl_sync.aio import AsyncInstanceGenerator, AsyncLoader
+from etl_sync.types import GenerationStatus
+from .models import Numero, Polish, TestModel
+from .utils import captured_output
+
+
+async def stream(records):
+    for record in records:
+        await asyncio.sleep(0)
+        yield record
+
+
+class TestAsyncLoader(TransactionTestCase):
+
+    def test_load(self):
+        records = [{'record': str(number), 'name': 'name',
+                    'numero': 'uno' if number != 3 else None}
+                   for number in range(1, 8)]
+        loader = AsyncLoader(stream(records), model_class=TestModel,
+                             options={'chunk_size': 2, 'max_concurrency': 1})
+        with captured_output() as (out, err):
+            counter = asyncio.run(loader.load())
+        self.assertEqual(counter.created, 6)
+        self.assertEqual(counter.rejected, 1)
+        self.assertEqual(counter.pos, 8)
+        self.assertIn('Error, row 4', out.getvalue())
+        self.assertEqual(TestModel.objects.count(), 6)
+        loader = AsyncLoader(records[:2], model_class=TestModel)
+        with captured_output():
+            counter = asyncio.run(loader.load())
+        self.assertEqual(counter.unchanged, 2)
+        self.assertEqual(len(loader.loaders), 1)
+
+    def test_concurrency(self):
+        # chunks in flight share related records
+        records = [{'record': str(number), 'name': 'name',
+                    'numero': 'n{}'.format(number % 3)}
+                   for number in range(1, 31)]
+        loader = AsyncLoader(stream(records), model_class=TestModel,
+                             options={'chunk_size': 4, 'max_concurrency': 3})
+        with captured_output() as (out, err):
+            counter = asyncio.run(loader.load())
+        self.assertEqual(counter.created, 30)
+        self.assertEqual(counter.rejected, 0)
+        self.assertEqual(Numero.objects.count(), 3)
+        self.assertTrue(all(each.generator.concurrent
+                            for each in loader.loaders))
+
+
+class TestAsyncInstanceGenerator(TransactionTestCase):
+
+    def test_generate(self):
+        async def run():
+            generator = AsyncInstanceGenerator(
+                Polish, options={'max_concurrency': 2})
+            try:
+                results = await asyncio.gather(
+                    generator.generate([{'record': '1', 'ilosc': 'jeden'}]),
+                    generator.generate([{'record': '2', 'ilosc': 'dwa'}]))
+                instance = await generator.get_instance(
+                    {'record': '1', 'ilosc': 'eins'})
+            finally:
+                await generator.close()
+            return results, instance
+
+        results, instance = asyncio.run(run())
+        self.assertEqual([res for result in results for res, _ in result],
+                         [GenerationStatus.Created, GenerationStatus.Created])
+        self.assertEqual(instance.ilosc, 'eins')
+        self.assertEqual(Polish.objects.count(), 2)
@@ -0,0 +1,209 @@
+from __future__ import absolute_import
+
+from django.test import TestCase
+
+from etl_sync.caches import KeySet, PersistenceIndex, RelatedCache, atomic
+from etl_sync.generators import InstanceGenerator
+from etl_sync.types import GenerationStatus
+from tests import models
+
+
+class TestRelatedCache(TestCase):
+
+    def test_lru(self):
+        cache = RelatedCache(maxsize=2)
+        for value in ['a', 'b', 'c']:
+            cache.set(cache.make_key(models.Nombre, value), value)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get(cache.make_key(models.Nombre, 'a')))
+        self.assertEqual(cache.get(cache.make_key(models.Nombre, 'b')), 'b')
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_make_key(self):
+        key = RelatedCache.make_key(
+            models.Nombre, {'name': 'a', 'nested': {'x': [1, 2]}})
+        self.assertEqual(key, RelatedCache.make_key(
+            models.Nombre, {'nested': {'x': [1, 2]}, 'name': 'a'}))
+        self.assertIsNone(RelatedCache.make_key(
+            models.Nombre, models.Nombre(name='a')))
+        self.assertIsNone(RelatedCache.make_key(models.Nombre, {'a': {1}}))
+
+    def test_rollback(self):
+        cache = RelatedCache()
+        cache.set('kept', 1)
+        cache.begin()
+        cache.set('outer', 2)
+        cache.begin()
+        cache.set('inner', 3)
+        cache.commit()
+        cache.rollback()
+        self.assertEqual(list(cache.data), ['kept'])
+
+    def test_preload(self):
+        models.Nombre.objects.create(name='un')
+        models.Nombre.objects.create(name='deux')
+        cache = RelatedCache()
+        with self.assertNumQueries(1):
+            cache.preload(models.Nombre)
+        self.assertEqual(len(cache), 4)
+
+
+class TestGeneratorCache(TestCase):
+
+    def test_fk_cache(self):
+        generator = InstanceGenerator(
+            models.TestModel, options={'related_cache_size': 100})
+        generator.get_instance(
+            {'record': '1', 'numero': 'uno', 'nombre': {'name': 'un'}})
+        with self.assertNumQueries(2):
+            instance = generator.get_instance(
+                {'record': '2', 'numero': 'uno', 'nombre': {'name': 'un'}})
+        self.assertEqual(instance.numero.name, 'uno')
+        self.assertEqual(models.Numero.objects.count(), 1)
+        self.assertEqual(generator.get_metrics()['related cache hits'], 2)
+
+    def test_preloaded_fk_cache(self):
+        models.Numero.objects.create(name='uno')
+        generator = InstanceGenerator(models.TestModel, options={
+            'related_cache_size': 100,
+            'related_cache_preload': [models.Numero]})
+        instance = generator.get_instance({'record': '1', 'numero': 'uno'})
+        self.assertEqual(generator.related_cache.misses, 0)
+        self.assertEqual(instance.numero.name, 'uno')
+
+    def test_preloaded_m2m_cache(self):
+        pks = [models.AnotherModel.objects.create(record=record).pk
+               for record in ['a', 'b']]
+        generator = InstanceGenerator(models.Station, options={
+            'related_cache_size': 100,
+            'related_cache_preload': [models.AnotherModel]})
+        instance = generator.get_instance({'code': 1, 'lnames': pks})
+        self.assertEqual(generator.related_cache.misses, 0)
+        self.assertEqual(instance.lnames.count(), 2)
+
+
+class TestChangeCounter(TestCase):
+
+    def test_rollback(self):
+        models.Polish.objects.create(record='1', ilosc='jeden')
+        generator = InstanceGenerator(models.Polish)
+        generator.get_instance({'record': '1', 'ilosc': 'jedynka'})
+        with self.assertRaises(ValueError):
+            with atomic(generator.get_journals()):
+                generator.get_instance({'record': '1', 'ilosc': 'raz'})
+                generator.get_instances([{'record': '1', 'ilosc': 'jeden'}])
+                raise ValueError
+        self.assertEqual(generator.get_metrics(), {'changed ilosc': 1})
+        self.assertEqual(generator.changed_fields.most_common(),
+                         [('ilosc', 1)])
+
+
+class TestPersistenceIndex(TestCase):
+
+    def test_index(self):
+        models.WellDefinedModel.objects.create(something='a', somenumber=1)
+        index = PersistenceIndex(
+            models.WellDefinedModel, [('something', 'somenumber')])
+        with self.assertNumQueries(1):
+            self.assertTrue(index.contains(
+                (('something', 'a'), ('somenumber', 1))))
+            self.assertFalse(index.contains(
+                (('something', 'a'), ('somenumber', 2))))
+        self.assertIsNone(index.contains((('something', 'a'),)))
+        index.add((('something', 'a'), ('somenumber', 2)))
+        self.assertTrue(index.contains(
+            (('something', 'a'), ('somenumber', 2))))
+
+    def test_primary_keys(self):
+        station = models.Station.objects.create(code=5)
+        index = PersistenceIndex(models.Station, ['code'])
+        self.assertEqual(index.get((('code', '5'),)), station.pk)
+        self.assertIsNone(index.get((('code', '6'),)))
+        try:
+            with atomic([index]):
+                index.add((('code', 6),), 10)
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertFalse(index.contains((('code', 6),)))
+        with atomic([index]):
+            index.add((('code', 6),), 10)
+        self.assertEqual(index.get((('code', '6'),)), 10)
+
+    def test_limit(self):
+        for name in ['a', 'b', 'c']:
+            models.Polish.objects.create(record=name, ilosc=name)
+        index = PersistenceIndex(models.Polish, ['record'], limit=2)
+        self.assertIsNone(index.contains((('record', 'a'),)))
+        self.assertTrue(index.disabled)
+
+    def test_generator(self):
+        models.Polish.objects.create(record='1', ilosc='jeden')
+        generator = InstanceGenerator(
+            models.Polish, options={'persistence_index': True})
+        generator.get_instance({'record': '1', 'ilosc': 'jedynka'})
+        self.assertEqual(generator.res, GenerationStatus.Updated)
+        with self.assertNumQueries(1):
+            generator.get_instance({'record': '2', 'ilosc': 'dwa'})
+        self.assertEqual(generator.res, GenerationStatus.Created)
+        generator.get_instance({'record': '2', 'ilosc': 'dwa'})
+        self.assertEqual(generator.res, GenerationStatus.Unchanged)
+        generator.get_instances([
+            {'record': '3', 'ilosc': 'trzy'},
+            {'record': '1', 'ilosc': 'jeden'}])
+        self.assertEqual(generator.results, [
+            GenerationStatus.Created, GenerationStatus.Updated])
+        self.assertEqual(models.Polish.objects.count(), 3)
+
+    def test_generator_lookups(self):
+        for code in range(1, 4):
+            models.Station.objects.create(code=code, name='old')
+        generator = InstanceGenerator(models.Station, options={
+            'persistence_index': True, 'update': False})
+        generator.get_instance({'code': '1'})
+        with self.assertNumQueries(0):
+            instance = generator.get_instance({'code': '2'})
+        self.assertEqual(generator.res, GenerationStatus.Exists)
+        self.assertEqual(
+            instance.pk, models.Station.objects.get(code=2).pk)
+        # fields are not set to their defaults but loaded on access
+        self.assertIn('name', instance.get_deferred_fields())
+        self.assertFalse(instance._state.adding)
+        self.assertEqual(instance.name, 'old')
+        with self.assertNumQueries(0):
+            generator.get_instances([{'code': '1'}, {'code': '3'}])
+        generator = InstanceGenerator(
+            models.Station, options={'persistence_index': True})
+        generator.get_instances([{'code': 4, 'name': 'new'}])
+        # one query fetching the rows by primary key, one update
+        with self.assertNumQueries(2):
+            generator.get_instances([
+                {'code': 1, 'name': 'new'}, {'code': 2, 'name': 'new'},
+                {'code': 4, 'name': 'new'}])
+        self.assertEqual(generator.results, [
+            GenerationStatus.Updated, GenerationStatus.Updated,
+            GenerationStatus.Unchanged])
+        self.assertEqual(
+            models.Station.objects.filter(name='new').count(), 3)
+
+
+class TestKeySet(TestCase):
+
+    def test_integers(self):
+        keys = KeySet()
+        for key in (5, 3, 9, 3):
+            keys.add(key)
+        self.assertIn(3, keys)
+        self.assertNotIn(4, keys)
+        self.assertNotIn(10, keys)
+        self.assertEqual(len(keys), 3)
+        keys.add(1)
+        self.assertIn(1, keys)
+
+    def test_other_keys(self):
+        keys = KeySet()
+        keys.add(1)
+        keys.add('a')
+        self.assertIn(1, keys)
+        self.assertIn('a', keys)
+        self.assertEqual(len(keys), 2)
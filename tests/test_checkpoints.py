@@ -0,0 +1,153 @@
+from __future__ import absolute_import
+
+import io
+import os
+
+from django.test import TestCase, TransactionTestCase
+
+from etl_sync.checkpoints import FileCheckpointStore, ModelCheckpointStore
+from etl_sync.loaders import Loader
+from .models import Checkpoint, TestModel
+from .utils import SourceFileMixin, captured_output
+
+
+class Crash(Exception):
+    pass
+
+
+class TestStores(SourceFileMixin, TestCase):
+
+    def test_file_store(self):
+        store = FileCheckpointStore.for_source(self.path)
+        self.assertEqual(store.path, self.path + '.etlckpt')
+        self.assertIsNone(store.load())
+        store.save({'pos': 5})
+        self.assertEqual(store.load(), {'pos': 5})
+        store.clear()
+        self.assertIsNone(store.load())
+        store.clear()
+        self.assertIsNone(FileCheckpointStore.for_source(io.StringIO()))
+
+    def test_model_store(self):
+        store = ModelCheckpointStore(Checkpoint, 'data.txt')
+        self.assertIsNone(store.load())
+        store.save({'pos': 5})
+        store.save({'pos': 7})
+        self.assertEqual(store.load(), {'pos': 7})
+        store.clear()
+        self.assertIsNone(store.load())
+
+
+class TestResume(SourceFileMixin, TransactionTestCase):
+
+    def record(self, number):
+        return number, u'n%s' % number, u'' if number == 2 else u'uno'
+
+    def crash(self, options):
+        loader = Loader(self.path, model_class=TestModel, options=options)
+        process_batch = loader.process_batch
+        calls = []
+
+        def crashing(entries):
+            calls.append(entries)
+            if len(calls) == 3:
+                raise Crash
+            process_batch(entries)
+
+        loader.process_batch = crashing
+        with captured_output():
+            self.assertRaises(Crash, loader.load)
+
+    def test_resume(self):
+        options = {'checkpoint': True, 'checkpoint_interval': 1,
+                   'chunk_size': 3, 'offset_index': 2}
+        self.crash(options)
+        store = FileCheckpointStore.for_source(self.path)
+        checkpoint = store.load()
+        self.assertEqual(checkpoint['pos'], 7)
+        self.assertEqual(checkpoint['counter']['created'], 5)
+        self.assertEqual(checkpoint['counter']['rejected'], 1)
+        self.assertEqual(TestModel.objects.count(), 5)
+        loader = Loader(self.path, model_class=TestModel,
+                        options=dict(options, resume=True))
+        with captured_output() as (out, err):
+            counter = loader.load()
+        self.assertIn('Resuming at record 7', out.getvalue())
+        # the closest indexed record is 6, record 7 is read and skipped
+        self.assertEqual(loader.extractor.skipped, 5)
+        self.assertEqual(counter.created, 9)
+        self.assertEqual(counter.rejected, 1)
+        self.assertEqual(TestModel.objects.count(), 9)
+        self.assertIsNone(store.load())
+
+    def test_row_by_row(self):
+        options = {'checkpoint': True, 'checkpoint_interval': 4}
+        loader = Loader(self.path, model_class=TestModel, options=options)
+        process = loader.process
+
+        def crashing(extractor):
+            if loader.logger.counter.pos == 7:
+                raise Crash
+            process(extractor)
+
+        loader.process = crashing
+        with captured_output():
+            self.assertRaises(Crash, loader.load)
+        store = FileCheckpointStore.for_source(self.path)
+        self.assertEqual(store.load()['pos'], 5)
+        loader = Loader(self.path, model_class=TestModel,
+                        options=dict(options, resume=True))
+        with captured_output():
+            counter = loader.load()
+        # records 5 and 6 were committed after the checkpoint
+        self.assertEqual(counter.created, 7)
+        self.assertEqual(counter.unchanged, 2)
+        self.assertEqual(TestModel.objects.count(), 9)
+
+    def test_changed_source(self):
+        options = {'checkpoint': True, 'checkpoint_interval': 1,
+                   'chunk_size': 3}
+        self.crash(options)
+        with io.open(self.path, 'a') as fil:
+            fil.write(u'11\tn11\tuno\n')
+        loader = Loader(self.path, model_class=TestModel,
+                        options=dict(options, resume=True))
+        with captured_output() as (out, err):
+            counter = loader.load()
+        self.assertIn('Source changed', out.getvalue())
+        self.assertEqual(counter.created, 5)
+        self.assertEqual(counter.unchanged, 5)
+        self.assertEqual(counter.rejected, 1)
+
+
+class TestIncremental(SourceFileMixin, TransactionTestCase):
+    changed = None
+
+    def record(self, number):
+        return (number, u'x' if number == self.changed else u'n%s' % number,
+                u'' if number == 2 else u'uno')
+
+    def load(self):
+        loader = Loader(self.path, model_class=TestModel, options={
+            'incremental': True, 'chunk_size': 3})
+        with captured_output():
+            return loader.load()
+
+    def test_incremental(self):
+        counter = self.load()
+        self.assertEqual(counter.created, 9)
+        self.assertEqual(counter.rejected, 1)
+        self.assertTrue(os.path.exists(self.path + '.etlchunks'))
+        counter = self.load()
+        # the first chunk contains a rejected record and is loaded again
+        self.assertEqual(counter.unchanged, 2)
+        self.assertEqual(counter.rejected, 1)
+        self.assertEqual(counter.metrics['unchanged chunks skipped'], 3)
+        self.assertEqual(counter.pos, 11)
+        self.changed = 8
+        self.write()
+        counter = self.load()
+        self.assertEqual(counter.updated, 1)
+        self.assertEqual(counter.unchanged, 4)
+        self.assertEqual(counter.metrics['unchanged chunks skipped'], 2)
+        self.assertEqual(TestModel.objects.get(record='8').name, 'x')
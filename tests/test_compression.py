@@ -0,0 +1,85 @@
+from __future__ import absolute_import
+
+import bz2
+import gzip
+import io
+import lzma
+import os
+
+from django.test import TestCase, TransactionTestCase
+
+from etl_sync.compression import (
+    ThreadedReader, detect_compression, open_compressed)
+from etl_sync.loaders import Extractor, Loader
+from .models import TestModel
+from .utils import SourceFileMixin, captured_output
+
+
+class CompressedFiles(SourceFileMixin):
+    size = 100
+
+    def setUp(self):
+        super(CompressedFiles, self).setUp()
+        self.paths = {}
+        for name, module in [('gz', gzip), ('bz2', bz2), ('xz', lzma)]:
+            path = self.path + '.' + name
+            with module.open(path, 'wb') as fil:
+                fil.write(self.content().encode('utf-8'))
+            self.paths[name] = path
+
+    def record(self, number):
+        return number, u'n%s' % number, u'uno'
+
+
+class TestCompression(CompressedFiles, TestCase):
+
+    def test_detect(self):
+        self.assertIs(detect_compression(self.paths['gz']), gzip.GzipFile)
+        self.assertIs(detect_compression(self.paths['bz2']), bz2.BZ2File)
+        self.assertIs(detect_compression(self.paths['xz']), lzma.LZMAFile)
+        self.assertIsNone(detect_compression(self.path))
+        self.assertIsNone(detect_compression(self.directory))
+        self.assertIsNone(open_compressed(self.path))
+        # text starting like a bzip2 header
+        self.write(u'BZh\tname\tnumero\n1\tn1\tuno\n')
+        self.assertIsNone(detect_compression(self.path))
+        with bz2.open(self.paths['bz2'], 'wb'):
+            pass
+        self.assertIs(detect_compression(self.paths['bz2']), bz2.BZ2File)
+
+    def test_extract(self):
+        for thread in (False, True):
+            for path in self.paths.values():
+                extractor = Extractor(path, options={
+                    'decompress_thread': thread, 'read_buffer_size': 64})
+                with extractor as reader:
+                    records = list(reader)
+                self.assertEqual(len(records), 100)
+                self.assertEqual(records[-1]['name'], 'n100')
+                self.assertTrue(extractor.fil.closed)
+
+    def test_threaded_reader(self):
+        raw = ThreadedReader(io.BytesIO(b'abcdefgh'), chunk_size=3)
+        self.assertEqual(raw.read(2), b'ab')
+        self.assertEqual(raw.read(5), b'c')
+        self.assertEqual(raw.readall(), b'defgh')
+        raw.close()
+        with io.open(self.paths['gz'], 'rb') as fil:
+            truncated = io.BytesIO(fil.read()[:-20])
+        raw = ThreadedReader(gzip.GzipFile(fileobj=truncated), chunk_size=16)
+        self.assertRaises(EOFError, raw.readall)
+        raw.close()
+
+
+class TestCompressedLoad(CompressedFiles, TransactionTestCase):
+
+    def test_load(self):
+        loader = Loader(self.paths['xz'], model_class=TestModel, options={
+            'slice_begin': 51, 'offset_index': True,
+            'decompress_thread': True})
+        with captured_output():
+            counter = loader.load()
+        self.assertEqual(counter.created, 50)
+        self.assertEqual(loader.extractor.skipped, 0)
+        self.assertFalse(os.path.exists(self.paths['xz'] + '.etlidx'))
+        self.assertIsNone(loader.extractor.count())
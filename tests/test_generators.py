@@ -2,15 +2,20 @@ from __future__ import absolute_import
 
 from django.forms.models import model_to_dict
 from django.utils import version
-from django.db import IntegrityError
+from django.db import IntegrityError, connection
 from django.db.models import Model
 from django.contrib.gis.db.models import CharField
 from django.core.exceptions import ValidationError
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from tests import models
+from etl_sync.caches import MergeOrderError, atomic
+from etl_sync.types import GenerationStatus
 from etl_sync.generators import (
-    get_unique_fields, get_unambiguous_fields, get_fields,
-    BaseGenerator, InstanceGenerator, HashMixin)
+    get_unambiguous_fields, get_fields,
+    get_model_info, clear_model_info,
+    BaseGenerator, InstanceGenerator, HashMixin, MergeJoinMixin,
+    UpsertMixin)
 
 
 VERSION = version.get_version()[2]
@@ -18,12 +23,6 @@ VERSION = version.get_version()[2]
 
 class TestUtils(TestCase):
 
-    def test_get_unique_fields(self):
-        self.assertEqual(
-            get_unique_fields(models.Polish), ['record'])
-        self.assertEqual(get_unique_fields(models.TwoUnique),
-            ['record', 'anotherfield'])
-
     def test_get_unambigous_fields(self):
         results = [
             (models.TestModelWoFk, []),
@@ -44,6 +43,17 @@ class TestUtils(TestCase):
         else:
             self.assertEqual(length, 5)
 
+    def test_get_model_info(self):
+        info = get_model_info(models.Polish)
+        self.assertIs(info, get_model_info(models.Polish))
+        self.assertEqual(info.persistence, ['record'])
+        generator = InstanceGenerator(models.Polish)
+        self.assertIs(generator.field_names, info.field_names)
+        generator.persistence.append('ilosc')
+        self.assertEqual(info.persistence, ['record'])
+        clear_model_info(sender=models.Polish)
+        self.assertIsNot(info, get_model_info(models.Polish))
+
 
 class TestBaseGenerator(TestCase):
 
@@ -139,7 +149,7 @@ class TestForeignKeyRelations(TestCase):
             'nombre': {
                 'name': 'un', 'etl_create': False},
             'numero': 'quattre'})
-        self.assertEqual(generator.res, 'created')
+        self.assertEqual(generator.res, GenerationStatus.Created)
         with self.assertRaises((ValueError, IntegrityError)):
             generator.get_instance({
                 'record': '2', 'name': 'two', 'zahl': 'eins',
@@ -152,12 +162,12 @@ class TestForeignKeyRelations(TestCase):
         instance = generator.get_instance({
             'record': '1', 'name': 'one', 'zahl': 'eins', 'nombre': 'un',
             'numero': 'uno', 'elnumero': 'el uno'})
-        self.assertEqual(generator.res, 'created')
+        self.assertEqual(generator.res, GenerationStatus.Created)
         self.assertEqual(instance.elnumero.rec, 'el uno')
         instance = generator.get_instance({
             'record': '2', 'name': 'two', 'zahl': 'zwei', 'nombre': 'deux',
             'numero': 'due', 'elnumero': 'el dos'})
-        self.assertEqual(generator.res, 'created')
+        self.assertEqual(generator.res, GenerationStatus.Created)
 
     def test_fk_model(self):
         generator = InstanceGenerator(models.SimpleFkModel)
@@ -235,6 +245,85 @@ class TestRelations(TestCase):
         self.assertEqual(rec.nombre.testonetoonemodel, rec)
 
 
+class TestManyToMany(TestCase):
+
+    def test_through_model(self):
+        generator = InstanceGenerator(models.SomeModel)
+        dic = {'record': '1', 'lnames': [
+            {'record': '1:1', 'last_name': 'Doe'},
+            {'record': '1:2', 'last_name': 'Carvello'}]}
+        instance = generator.get_instance(dic)
+        # existing links are not inserted again
+        with self.assertNumQueries(1):
+            generator.assign_related_many([
+                (instance, generator.related_instances)])
+        generator.get_instance(dic)
+        self.assertEqual(models.IntermediateModel.objects.count(), 2)
+
+    def test_batch_links(self):
+        generator = InstanceGenerator(models.TestModel)
+        generator.get_instances([
+            {'record': '1', 'numero': 'uno', 'related': [
+                {'record': '10', 'ilosc': 'dziesiec'}]},
+            {'record': '2', 'numero': 'due', 'related': [
+                {'record': '10', 'ilosc': 'dziesiec'}]}])
+        instances = generator.get_instances([
+            {'record': '1', 'numero': 'uno', 'related': [
+                {'record': '20', 'ilosc': 'dwadziescia'}]},
+            {'record': '2', 'numero': 'due', 'related': [
+                {'record': '10', 'ilosc': 'dziesiec'}]}])
+        self.assertEqual(instances[0].related.count(), 2)
+        self.assertEqual(instances[1].related.count(), 1)
+
+    def test_replace(self):
+        generator = InstanceGenerator(
+            models.TestModel, options={'m2m_replace': True})
+        generator.get_instance({'record': '1', 'numero': 'uno', 'related': [
+            {'record': '10', 'ilosc': 'dziesiec'},
+            {'record': '20', 'ilosc': 'dwadziescia'}]})
+        instance = generator.get_instance(
+            {'record': '1', 'numero': 'uno', 'related': [
+                {'record': '20', 'ilosc': 'dwadziescia'},
+                {'record': '30', 'ilosc': 'trzydziesci'}]})
+        self.assertEqual(
+            sorted(instance.related.values_list('record', flat=True)),
+            ['20', '30'])
+        generator.get_instance({'record': '1', 'numero': 'uno'})
+        self.assertEqual(instance.related.count(), 2)
+
+
+class TestBackReferences(TestCase):
+
+    def get_dics(self, children):
+        return [
+            {'name': name, 'simplefkmodel': [
+                {'name': '{}{}'.format(name, index)}
+                for index in range(children)]}
+            for name in ['un', 'deux']]
+
+    def test_batched_children(self):
+        generator = InstanceGenerator(models.Nombre)
+        instances = generator.get_instances(self.get_dics(1))
+        self.assertEqual(models.SimpleFkModel.objects.count(), 2)
+        with CaptureQueriesContext(connection) as context:
+            generator.get_instances(self.get_dics(1))
+        with self.assertNumQueries(len(context.captured_queries)):
+            generator.get_instances(self.get_dics(20))
+        self.assertEqual(models.SimpleFkModel.objects.count(), 44)
+        self.assertEqual(instances[1].simplefkmodel_set.count(), 22)
+
+    def test_single_parent(self):
+        generator = InstanceGenerator(models.Numero)
+        generator.get_instance({'name': 'uno', 'tworelatedasunique': [
+            {'another': {'record': '1'}, 'value': 'a'},
+            {'another': {'record': '2'}, 'value': 'b'}]})
+        generator.get_instance({'name': 'uno', 'tworelatedasunique': [
+            {'another': {'record': '1'}, 'value': 'c'}]})
+        self.assertEqual(
+            sorted(models.TwoRelatedAsUnique.objects.values_list(
+                'value', flat=True)), ['b', 'c'])
+
+
 class TestUpdate(TestCase):
 
     def test_update(self):
@@ -246,9 +335,9 @@ class TestUpdate(TestCase):
             models.HashTestModel, persistence='record')
         res = generator.get_instance(dic)
         self.assertEqual(res.numero.name, 'cento')
-        self.assertEqual(generator.res, 'created')
+        self.assertEqual(generator.res, GenerationStatus.Created)
         generator.get_instance(dic)
-        self.assertEqual(generator.res, 'updated')
+        self.assertEqual(generator.res, GenerationStatus.Unchanged)
         dic = {'record': '100', 'numero': 'hundert', 'zahl': 'hundert'}
         res = generator.get_instance(dic)
         self.assertTrue(generator.res, 'updated')
@@ -257,6 +346,61 @@ class TestUpdate(TestCase):
         res = generator.get_instance(dic)
         self.assertTrue(generator.res, 'updated')
 
+    def test_update_queries(self):
+        generator = InstanceGenerator(models.Polish)
+        generator.get_instance({'record': '1', 'ilosc': 'jeden'})
+        with self.assertNumQueries(2):
+            instance = generator.get_instance(
+                {'record': '1', 'ilosc': 'jedynka'})
+        self.assertEqual(instance.ilosc, 'jedynka')
+        self.assertEqual(
+            models.Polish.objects.get(record='1').ilosc, 'jedynka')
+
+    def test_update_without_materialize(self):
+        generator = InstanceGenerator(
+            models.TestModel, options={'materialize': False})
+        generator.get_instance({'record': '1', 'name': 'a', 'numero': 'uno'})
+        instance = generator.get_instance({'record': '1', 'name': 'b'})
+        self.assertEqual(generator.res, GenerationStatus.Updated)
+        self.assertIn('zahl', instance.get_deferred_fields())
+        self.assertEqual(instance.name, 'b')
+        instances = generator.get_instances([{'record': '1', 'name': 'c'}])
+        self.assertIn('zahl', instances[0].get_deferred_fields())
+        self.assertEqual(models.TestModel.objects.get(record='1').name, 'c')
+
+    def test_unchanged_update(self):
+        generator = InstanceGenerator(models.Polish)
+        generator.get_instance({'record': '1', 'ilosc': 'jeden'})
+        with self.assertNumQueries(1):
+            generator.get_instance({'record': '1', 'ilosc': 'jeden'})
+        self.assertEqual(generator.res, GenerationStatus.Unchanged)
+        generator.get_instances([
+            {'record': '1', 'ilosc': 'jeden'},
+            {'record': '1', 'ilosc': 'dwa'}])
+        self.assertEqual(generator.results, [
+            GenerationStatus.Unchanged, GenerationStatus.Updated])
+        self.assertEqual(generator.get_metrics()['changed ilosc'], 1)
+        generator = InstanceGenerator(
+            models.Polish, options={'report_unchanged': False})
+        with self.assertNumQueries(1):
+            generator.get_instance({'record': '1', 'ilosc': 'dwa'})
+        self.assertEqual(generator.res, GenerationStatus.Updated)
+
+    def test_update_changed_columns(self):
+        generator = InstanceGenerator(models.TestModel)
+        generator.get_instance({'record': '1', 'name': 'a', 'numero': 'uno'})
+        with CaptureQueriesContext(connection) as queries:
+            generator.get_instance(
+                {'record': '1', 'name': 'b', 'numero': 'uno'})
+        self.assertEqual(generator.res, GenerationStatus.Updated)
+        updates = [query['sql'] for query in queries.captured_queries
+                   if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"name"', updates[0])
+        self.assertNotIn('"numero_id"', updates[0])
+        generator.get_instance({'record': '1', 'name': 'b', 'numero': 'uno'})
+        self.assertEqual(generator.res, GenerationStatus.Unchanged)
+
     def test_related_update(self):
         """
         Test update of related records if parent record is
@@ -340,6 +484,19 @@ class TestPreparations(TestCase):
                 'geom2d': geom, 'geom3d': geom, 'name': 'testcase 2'})
         item = models.GeometryModel.objects.filter(name='testcase 2')[0]
         self.assertFalse(item.geom2d.hasz)
+        geom = GEOSGeometry(example3d_string)
+        generator.get_instance({
+            'geom2d': bytes(geom.wkb), 'geom3d': geom.wkb,
+            'name': 'testcase wkb'})
+        item = models.GeometryModel.objects.filter(name='testcase wkb')[0]
+        self.assertFalse(item.geom2d.hasz)
+        self.assertTrue(item.geom3d.hasz)
+        generator.get_instance({
+            'geom2d': example3d_string.encode('utf-8'),
+            'geom3d': geom.json.encode('utf-8'), 'name': 'testcase text'})
+        item = models.GeometryModel.objects.filter(name='testcase text')[0]
+        self.assertFalse(item.geom2d.hasz)
+        self.assertTrue(item.geom3d.hasz)
         generator.get_instance({
                 'geom2d': None, 'geom3d': None, 'name': 'emptytest'})
         item = models.GeometryModel.objects.filter(name='emptytest')[0]
@@ -356,7 +513,7 @@ class TestPreparations(TestCase):
                 'datetimenotnull': '', 'datetimenull': '2014-10-14'})
         generator.get_instance({
             'datetimenotnull': '2014-10-14', 'datetimenull': ''})
-        self.assertEqual(generator.res, 'created')
+        self.assertEqual(generator.res, GenerationStatus.Created)
 
     def test_prepare_string(self):
         generator = InstanceGenerator(models.TestModel)
@@ -372,6 +529,18 @@ class TestPreparations(TestCase):
         self.assertEqual(res['somenumber'], 0)
         self.assertEqual(bk_ref, {})
 
+    def test_preparation_plan(self):
+        generator = InstanceGenerator(models.Nombre)
+        plan, back_refs = generator.get_preparation_plan()
+        self.assertIs(plan, InstanceGenerator(
+            models.Nombre).get_preparation_plan()[0])
+        self.assertIn('testmodel', back_refs)
+        self.assertNotIn('testmodel', plan)
+        res, bk_ref = generator.prepare(
+            {'name': 'un', 'unknown': 1, 'testmodel': {'record': '1'}})
+        self.assertEqual(res, {'name': 'un'})
+        self.assertEqual(list(bk_ref.values()), [{'record': '1'}])
+
 
 class TestResults(TestCase):
 
@@ -380,12 +549,12 @@ class TestResults(TestCase):
         generator = InstanceGenerator(
             models.HashTestModel, persistence='record')
         generator.get_instance(dic)
-        self.assertEqual(generator.res, 'created')
+        self.assertEqual(generator.res, GenerationStatus.Created)
         generator.get_instance(dic)
-        self.assertEqual(generator.res, 'updated')
+        self.assertEqual(generator.res, GenerationStatus.Unchanged)
         dic['numero'] = 'due'
         generator.get_instance(dic)
-        self.assertEqual(generator.res, 'updated')
+        self.assertEqual(generator.res, GenerationStatus.Updated)
 
 
 class TestHashing(TestCase):
@@ -397,21 +566,129 @@ class TestHashing(TestCase):
         generator = self.HashGenerator(models.HashTestModel)
         instance = generator.get_instance({'record': '1', 'zahl': 'alfred'})
         self.assertEqual(len(instance.md5), 32)
-        self.assertEqual(generator.res, 'created')
+        self.assertEqual(generator.res, GenerationStatus.Created)
         generator.get_instance({'zahl': 'alfred', 'record': '1'})
-        self.assertEqual(generator.res, 'exists')
+        self.assertEqual(generator.res, GenerationStatus.Exists)
         generator.get_instance({'zahl': 'britta', 'record': '1'})
-        self.assertEqual(generator.res, 'updated')
+        self.assertEqual(generator.res, GenerationStatus.Updated)
         generator.get_instance({'zahl': 'britta', 'record': '2'})
 
+    def test_hash_compatibility(self):
+        from hashlib import md5
+        generator = self.HashGenerator(models.HashTestModel)
+        self.assertEqual(
+            generator.hash({'record': '1', 'zahl': 'alfred', 'id': 3}),
+            md5(b'1alfred').hexdigest())
+        generator = self.HashGenerator(
+            models.HashTestModel, options={'hash_algorithm': 'blake2b'})
+        self.assertEqual(len(generator.hash({'record': '1'})), 32)
+
+    def test_canonical_hash(self):
+        for options in ({'hash_algorithm': 'blake2b'},
+                        {'hash_encoding': 'canonical'}):
+            generator = self.HashGenerator(
+                models.HashTestModel, options=options)
+            hashes = set(generator.hash(dic) for dic in [
+                {'record': '1', 'zahl': '23'}, {'record': '12', 'zahl': '3'},
+                {'record': '1', 'name': '23'}, {'record': '1', 'zahl': None},
+                {'record': '1', 'zahl': 'None'}])
+            self.assertEqual(len(hashes), 5)
+            self.assertEqual(
+                generator.hash({'record': '1', 'zahl': '23', 'id': 3}),
+                generator.hash({'zahl': '23', 'record': '1'}))
+
+    def test_hash_index(self):
+        generator = self.HashGenerator(
+            models.HashTestModel, options={'hash_index': True})
+        generator.get_instance({'record': '1', 'zahl': 'alfred'})
+        self.assertEqual(generator.res, GenerationStatus.Created)
+        with self.assertNumQueries(0):
+            instance = generator.get_instance(
+                {'record': '1', 'zahl': 'alfred'})
+        self.assertEqual(generator.res, GenerationStatus.Exists)
+        self.assertEqual(
+            instance.pk, models.HashTestModel.objects.get(record='1').pk)
+        generator.get_instance({'record': '1', 'zahl': 'britta'})
+        self.assertEqual(generator.res, GenerationStatus.Updated)
+        self.assertEqual(models.HashTestModel.objects.count(), 1)
+
+    def test_batch_hashing(self):
+        generator = self.HashGenerator(models.HashTestModel)
+        generator.get_instances([
+            {'record': '1', 'zahl': 'alfred'},
+            {'record': '2', 'zahl': 'britta'}])
+        with self.assertNumQueries(1):
+            generator.get_instances([
+                {'record': '1', 'zahl': 'alfred'},
+                {'record': '2', 'zahl': 'britta'}])
+        self.assertEqual(generator.results, [GenerationStatus.Exists] * 2)
+        generator = self.HashGenerator(
+            models.HashTestModel, options={'hash_index': True})
+        generator.get_instances([
+            {'record': '1', 'zahl': 'alfred'},
+            {'record': '2', 'zahl': 'carl'}])
+        self.assertEqual(generator.results, [
+            GenerationStatus.Exists, GenerationStatus.Updated])
+        self.assertEqual(
+            models.HashTestModel.objects.get(record='2').zahl, 'carl')
+
+    def test_batch_hashing_repeated_rows(self):
+        for options in ({}, {'hash_index': True}):
+            models.HashTestModel.objects.all().delete()
+            generator = self.HashGenerator(
+                models.HashTestModel, options=options)
+            generator.get_instance({'record': '1', 'zahl': 'a'})
+            generator.get_instances([
+                {'record': '1', 'zahl': 'a'}, {'record': '1', 'zahl': 'b'},
+                {'record': '1', 'zahl': 'a'}])
+            self.assertEqual(generator.results, [
+                GenerationStatus.Exists, GenerationStatus.Updated,
+                GenerationStatus.Updated])
+            self.assertEqual(
+                models.HashTestModel.objects.get(record='1').zahl, 'a')
+
+    def test_hash_index_update(self):
+        generator = self.HashGenerator(
+            models.HashTestModel, options={'hash_index': True})
+        generator.get_instance({'record': '1', 'zahl': 'a'})
+        generator.get_instance({'record': '1', 'zahl': 'b'})
+        generator.get_instance({'record': '1', 'zahl': 'a'})
+        self.assertEqual(generator.res, GenerationStatus.Updated)
+        self.assertEqual(
+            models.HashTestModel.objects.get(record='1').zahl, 'a')
+        index = generator.hash_index
+        self.assertEqual(len(index), 1)
+        try:
+            with atomic([index]):
+                generator.get_instance({'record': '1', 'zahl': 'c'})
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertEqual(list(index.hashes.values()), list(index.data))
+        self.assertEqual(len(index), 1)
+        with self.assertNumQueries(0):
+            generator.get_instance({'record': '1', 'zahl': 'a'})
+        self.assertEqual(generator.res, GenerationStatus.Exists)
+
+    def test_hash_index_rollback(self):
+        generator = self.HashGenerator(
+            models.HashTestModel, options={'hash_index': True})
+        journal = generator.hash_index
+        journal.begin()
+        generator.get_instance({'record': '1', 'zahl': 'alfred'})
+        journal.rollback()
+        models.HashTestModel.objects.all().delete()
+        generator.get_instance({'record': '1', 'zahl': 'alfred'})
+        self.assertEqual(generator.res, GenerationStatus.Created)
+
     def test_hashing_without_hashfield(self):
         generator = self.HashGenerator(models.TestModel)
         generator.get_instance({'record': 1, 'numero': '23'})
-        self.assertEqual(generator.res, 'created')
+        self.assertEqual(generator.res, GenerationStatus.Created)
         generator.get_instance({'record': 1, 'numero': '23'})
-        self.assertEqual(generator.res, 'updated')
+        self.assertEqual(generator.res, GenerationStatus.Unchanged)
         generator.get_instance({'record': 2, 'numero': '22'})
-        self.assertEqual(generator.res, 'created')
+        self.assertEqual(generator.res, GenerationStatus.Created)
 
 
 class TestSelectRelatedByRelated(TestCase):
@@ -455,3 +732,244 @@ class TestSelectRelatedByRelated(TestCase):
         self.assertEqual(item.key.numero.name, 'hello')
         self.assertEqual(item.key.another.last_name, 'Mueller')
         self.assertEqual(item.value, 'test')
+
+
+class TestBatchGeneration(TestCase):
+
+    def test_get_instances(self):
+        generator = InstanceGenerator(models.TestModel)
+        instances = generator.get_instances([
+            {'record': '1', 'name': 'one', 'numero': 'uno'},
+            {'record': '2', 'name': 'two', 'numero': 'due'},
+            {'record': '1', 'name': 'uno', 'numero': 'uno'}])
+        self.assertEqual(generator.results, [
+            GenerationStatus.Created, GenerationStatus.Created,
+            GenerationStatus.Updated])
+        self.assertIs(instances[0], instances[2])
+        self.assertIsNotNone(instances[0].pk)
+        self.assertEqual(models.TestModel.objects.count(), 2)
+        self.assertEqual(
+            models.TestModel.objects.get(record='1').name, 'uno')
+        self.assertEqual(models.Numero.objects.count(), 2)
+        instances = generator.get_instances([
+            {'record': '2', 'name': 'zwei', 'numero': 'due'},
+            {'record': '3', 'name': 'three', 'numero': 'tre'}])
+        self.assertEqual(generator.results, [
+            GenerationStatus.Updated, GenerationStatus.Created])
+        self.assertEqual(
+            models.TestModel.objects.get(record='2').name, 'zwei')
+        self.assertEqual(models.TestModel.objects.count(), 3)
+
+    def test_get_instances_options(self):
+        generator = InstanceGenerator(
+            models.TestModel, options={'update': False})
+        generator.get_instances([{'record': '1', 'numero': 'uno'}])
+        generator.get_instances([
+            {'record': '1', 'name': 'one', 'numero': 'uno'},
+            {'record': '2', 'numero': 'due', 'etl_create': False}])
+        self.assertEqual(
+            generator.results, [GenerationStatus.Exists, None])
+        self.assertIsNone(models.TestModel.objects.get(record='1').name)
+        self.assertEqual(models.TestModel.objects.count(), 1)
+
+    def test_get_instances_unique_together(self):
+        generator = InstanceGenerator(models.ParentModel)
+        instances = generator.get_instances([
+            {'well_defined': {'something': 'donkey', 'somenumber': 1}},
+            {'well_defined': {'something': 'donkey', 'somenumber': 1}}])
+        self.assertEqual(models.WellDefinedModel.objects.count(), 1)
+        self.assertEqual(instances[0].well_defined, instances[1].well_defined)
+        generator = InstanceGenerator(models.WellDefinedModel)
+        generator.get_instances([
+            {'something': 'donkey', 'somenumber': 1},
+            {'something': 'donkey', 'somenumber': 2}])
+        self.assertEqual(generator.results, [
+            GenerationStatus.Unchanged, GenerationStatus.Created])
+
+    def test_get_instances_related(self):
+        generator = InstanceGenerator(models.TestModel)
+        instances = generator.get_instances([
+            {'record': '1', 'numero': 'uno', 'related': [
+                {'record': '10', 'ilosc': 'dziesiec'}]},
+            {'record': '2', 'numero': 'due', 'related': [
+                {'record': '10', 'ilosc': 'dziesiec'},
+                {'record': '20', 'ilosc': 'dwadziescia'}]}])
+        self.assertEqual(instances[0].related.count(), 1)
+        self.assertEqual(instances[1].related.count(), 2)
+
+    def test_get_instances_typed_keys(self):
+        generator = InstanceGenerator(models.Station)
+        for status in (GenerationStatus.Created, GenerationStatus.Unchanged):
+            instances = generator.get_instances([
+                {'code': '5', 'name': 'five', 'lnames': ['a', 'b']}])
+            self.assertEqual(generator.results, [status])
+            self.assertIsNotNone(instances[0].pk)
+            self.assertEqual(instances[0].lnames.count(), 2)
+        self.assertEqual(models.Station.objects.count(), 1)
+
+
+class TestUpsert(TestCase):
+
+    class UpsertGenerator(UpsertMixin, InstanceGenerator):
+        pass
+
+    def test_upsert(self):
+        generator = self.UpsertGenerator(models.Polish)
+        with CaptureQueriesContext(connection) as queries:
+            instances = generator.get_instances([
+                {'record': '1', 'ilosc': 'jeden'},
+                {'record': '2', 'ilosc': 'dwa'}])
+        inserts = [query for query in queries.captured_queries
+                   if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(generator.results, [
+            GenerationStatus.Created, GenerationStatus.Created])
+        self.assertEqual(
+            instances[1].pk, models.Polish.objects.get(record='2').pk)
+        generator.get_instances([
+            {'record': '2', 'ilosc': 'zwei'},
+            {'record': '3', 'ilosc': 'trzy'},
+            {'record': '3', 'ilosc': 'drei'}])
+        self.assertEqual(generator.results, [
+            GenerationStatus.Updated, GenerationStatus.Created,
+            GenerationStatus.Updated])
+        self.assertEqual(
+            models.Polish.objects.get(record='2').ilosc, 'zwei')
+        self.assertEqual(
+            models.Polish.objects.get(record='3').ilosc, 'drei')
+        self.assertEqual(models.Polish.objects.count(), 3)
+        instance = generator.get_instance({'record': '1', 'ilosc': 'eins'})
+        self.assertEqual(generator.res, GenerationStatus.Updated)
+        self.assertEqual(instance.ilosc, 'eins')
+
+    def test_upsert_options(self):
+        generator = self.UpsertGenerator(
+            models.Polish, options={'update': False})
+        generator.get_instances([{'record': '1', 'ilosc': 'jeden'}])
+        instances = generator.get_instances([
+            {'record': '1', 'ilosc': 'eins'},
+            {'record': '2', 'ilosc': 'zwei', 'etl_create': False},
+            {'record': '3', 'ilosc': 'drei', 'etl_update': True}])
+        self.assertEqual(generator.results, [
+            GenerationStatus.Exists, None, GenerationStatus.Created])
+        self.assertEqual(instances[0].ilosc, 'jeden')
+        self.assertEqual(
+            models.Polish.objects.get(record='1').ilosc, 'jeden')
+        self.assertEqual(models.Polish.objects.count(), 2)
+
+    def test_upsert_related(self):
+        generator = self.UpsertGenerator(models.TestModel)
+        generator.get_instances([
+            {'record': '1', 'name': 'one', 'numero': 'uno', 'related': [
+                {'record': '10', 'ilosc': 'dziesiec'}]}])
+        instances = generator.get_instances([
+            {'record': '1', 'name': 'uno', 'numero': 'uno', 'related': [
+                {'record': '10', 'ilosc': 'dziesiec'},
+                {'record': '20', 'ilosc': 'dwadziescia'}]}])
+        self.assertEqual(generator.results, [GenerationStatus.Updated])
+        self.assertEqual(instances[0].related.count(), 2)
+        self.assertEqual(instances[0].numero.name, 'uno')
+        self.assertIn('zahl', instances[0].get_deferred_fields())
+        self.assertEqual(models.Numero.objects.count(), 1)
+
+    def test_upsert_unique_together(self):
+        generator = self.UpsertGenerator(models.WellDefinedModel)
+        generator.get_instances([
+            {'something': 'donkey', 'somenumber': 1},
+            {'something': 'donkey', 'somenumber': 2}])
+        generator.get_instances([{'something': 'donkey', 'somenumber': 1}])
+        self.assertEqual(generator.results, [GenerationStatus.Updated])
+        self.assertEqual(models.WellDefinedModel.objects.count(), 2)
+
+    def test_fallback(self):
+        generator = self.UpsertGenerator(
+            models.TestModelWoFk, persistence='record')
+        generator.get_instance({'record': '1', 'name': 'one'})
+        generator.get_instance({'record': '1', 'name': 'uno'})
+        self.assertEqual(generator.res, GenerationStatus.Updated)
+        self.assertEqual(models.TestModelWoFk.objects.count(), 1)
+
+
+class TestMergeJoin(TestCase):
+
+    class MergeGenerator(MergeJoinMixin, InstanceGenerator):
+        pass
+
+    def setUp(self):
+        for record in ['01', '02', '03', '04', '05', '06']:
+            models.Polish.objects.create(record=record, ilosc='a')
+
+    def test_merge(self):
+        generator = self.MergeGenerator(models.Polish, options={
+            'merge_join': 'record', 'merge_delete': True,
+            'merge_page_size': 4})
+        with CaptureQueriesContext(connection) as queries:
+            generator.get_instances([
+                {'record': '01', 'ilosc': 'a'},
+                {'record': '02', 'ilosc': 'b'}])
+        self.assertEqual(generator.results, [
+            GenerationStatus.Unchanged, GenerationStatus.Updated])
+        selects = [query for query in queries.captured_queries
+                   if query['sql'].startswith('SELECT')]
+        self.assertEqual(len(selects), 1)
+        generator.get_instances([
+            {'record': '04', 'ilosc': 'a'},
+            {'record': '05', 'ilosc': 'a'},
+            {'record': '07', 'ilosc': 'a'}])
+        self.assertEqual(generator.results[2], GenerationStatus.Created)
+        self.assertFalse(models.Polish.objects.filter(record='03').exists())
+        # out of order, the row of 03 is gone already
+        with self.assertRaises(MergeOrderError):
+            generator.get_instance({'record': '03', 'ilosc': 'a'})
+        self.assertTrue(generator.finalize())
+        self.assertEqual(
+            list(models.Polish.objects.order_by('record').values_list(
+                'record', flat=True)),
+            ['01', '02', '04', '05', '07'])
+        self.assertEqual(models.Polish.objects.get(record='02').ilosc, 'b')
+        self.assertEqual(generator.deleted, 2)
+        metrics = generator.get_metrics()
+        self.assertEqual(metrics['merge rows scanned'], 6)
+        self.assertEqual(metrics['merge fallback lookups'], 0)
+
+    def test_fallback(self):
+        generator = self.MergeGenerator(
+            models.Polish, options={'merge_join': 'record'})
+        generator.get_instances([{'record': '03', 'ilosc': 'b'}])
+        # out of order, looked up with a query
+        generator.get_instance({'record': '00', 'ilosc': 'a'})
+        self.assertEqual(generator.res, GenerationStatus.Created)
+        generator.get_instance({'record': '02', 'ilosc': 'b'})
+        self.assertEqual(generator.res, GenerationStatus.Updated)
+        self.assertEqual(
+            generator.get_metrics()['merge fallback lookups'], 2)
+        self.assertEqual(models.Polish.objects.count(), 7)
+
+    def test_rollback(self):
+        generator = self.MergeGenerator(models.Polish, options={
+            'merge_join': 'record', 'merge_delete': True})
+        try:
+            with atomic(generator.get_journals()):
+                generator.get_instances([{'record': '03', 'ilosc': 'b'}])
+                raise ValueError
+        except ValueError:
+            pass
+        self.assertIsNone(generator.merge_cursor.last)
+        generator.get_instances([{'record': '04', 'ilosc': 'b'}])
+        generator.finalize()
+        # the record of the rolled back transaction is kept
+        self.assertEqual(
+            list(models.Polish.objects.order_by('record').values_list(
+                'record', flat=True)), ['03', '04'])
+
+    def test_options(self):
+        self.assertRaises(
+            ValueError, self.MergeGenerator, models.Polish,
+            options={'merge_join': 'ilosc'})
+        self.assertRaises(
+            ValueError, self.MergeGenerator, models.Polish,
+            options={'merge_join': 'record', 'merge_delete': True,
+                     'slice_begin': 10})
+        generator = self.MergeGenerator(models.Polish)
+        generator.get_instance({'record': '03', 'ilosc': 'b'})
+        self.assertEqual(generator.res, GenerationStatus.Updated)
@@ -6,12 +6,13 @@ import os
 import re
 from unittest import skip
 
+from django.db import connection
 from django.test import TestCase, TransactionTestCase
 from six import StringIO, text_type
 
 from etl_sync.loaders import Extractor, Loader
 from etl_sync.transformations import Transformer
-from .models import ElNumero, TestModel
+from .models import ElNumero, Reading, Station, TestModel, TestModelWoFk
 from .utils import captured_output
 
 
@@ -106,6 +107,175 @@ class TestLoad(TransactionTestCase):
         loader.load()
         self.assertEqual(TestModel.objects.all().count(), 3)
 
+    def test_batch_load_from_file(self):
+        loader = Loader(
+            self.filename, model_class=TestModel, options={'batch_size': 2})
+        with captured_output():
+            counter = loader.load()
+        self.assertEqual(TestModel.objects.all().count(), 3)
+        self.assertEqual(counter.created, 3)
+        self.assertEqual(counter.pos, 4)
+        loader = Loader(
+            self.filename, model_class=TestModel, options={'batch_size': 2})
+        with captured_output():
+            counter = loader.load()
+        self.assertEqual(counter.unchanged, 3)
+        self.assertEqual(TestModel.objects.all().count(), 3)
+
+    def test_modified_record(self):
+        # the default reader returns records which may be modified
+        class UpperTransformer(Transformer):
+            def remap(self, dic):
+                dic['name'] = dic['name'].upper()
+                return super(UpperTransformer, self).remap(dic)
+
+        class UpperLoader(Loader):
+            transformer_class = UpperTransformer
+
+        with captured_output():
+            counter = UpperLoader(self.filename, model_class=TestModel).load()
+        self.assertEqual(counter.created, 3)
+        self.assertEqual(
+            sorted(TestModel.objects.values_list('name', flat=True)),
+            ['ONE', 'THREE', 'TWO'])
+
+    def test_batch_reload_typed_keys(self):
+        for model_class, content in [
+                (Station, u'code\tname\n5\tfive\n7\tseven\n'),
+                (Reading, u'station\tday\tvalue\nx\t2020-01-02\t1.5\n'
+                 u'x\t2020-01-03\t2\n')]:
+            for created, unchanged in [(2, 0), (0, 2)]:
+                loader = Loader(
+                    StringIO(content), model_class=model_class,
+                    options={'batch_size': 10})
+                with captured_output():
+                    counter = loader.load()
+                self.assertEqual(counter.rejected, 0)
+                self.assertEqual(counter.created, created)
+                self.assertEqual(counter.unchanged, unchanged)
+            self.assertEqual(model_class.objects.count(), 2)
+
+    def test_batch_rejection(self):
+        content = StringIO(
+            u'record\tname\tnumero\n1\tone\tuno\n2\ttwo\t\n'
+            u'3\tthree\ttres\n')
+        loader = Loader(
+            content, model_class=TestModel, options={'batch_size': 10})
+        with captured_output() as (out, err):
+            counter = loader.load()
+        self.assertEqual(counter.created, 2)
+        self.assertEqual(counter.rejected, 1)
+        self.assertIn('Error, row 3', out.getvalue())
+        self.assertEqual(TestModel.objects.all().count(), 2)
+
+    def test_related_cache_rollback(self):
+        content = StringIO(
+            u'record\tnombre\tnumero\n1\tun\t\n2\tun\tdue\n')
+        loader = Loader(content, model_class=TestModel,
+                        options={'related_cache_size': 10})
+        with captured_output() as (out, err):
+            counter = loader.load()
+        self.assertEqual(counter.rejected, 1)
+        self.assertEqual(TestModel.objects.get(record='2').nombre.name, 'un')
+        self.assertIn('related cache misses', out.getvalue())
+
+    def test_chunk_rejection(self):
+        content = StringIO(
+            u'record\tname\tnumero\n1\tone\tuno\n2\ttwo\t\n'
+            u'3\tthree\ttres\n4\tfour\t\n5\tfive\tcinque\n')
+        loader = Loader(
+            content, model_class=TestModel, options={'chunk_size': 10})
+        isolate = loader.isolate
+        calls = []
+
+        def count(dics):
+            calls.append(len(dics))
+            return isolate(dics)
+
+        loader.isolate = count
+        with captured_output() as (out, err):
+            counter = loader.load()
+        self.assertEqual(counter.created, 3)
+        self.assertEqual(counter.rejected, 2)
+        self.assertEqual(calls[0], 5)
+        output = out.getvalue()
+        self.assertLess(
+            output.index('Error, row 3'), output.index('Error, row 5'))
+        self.assertEqual(
+            sorted(TestModel.objects.values_list('record', flat=True)),
+            ['1', '3', '5'])
+        loader = Loader(
+            StringIO(u'record\tname\tnumero\n1\tuno\tuno\n'),
+            model_class=TestModel, options={'chunk_size': 10})
+        with captured_output():
+            counter = loader.load()
+        self.assertEqual(counter.updated, 1)
+
+    def test_pipelined_load(self):
+        content = StringIO(
+            u'record\tname\tnumero\n1\tone\tuno\n2\ttwo\t\n'
+            u'3\tthree\ttres\n4\tfour\tquattro\n')
+        loader = Loader(content, model_class=TestModel, options={
+            'pipeline': True, 'chunk_size': 3, 'queue_size': 2})
+        with captured_output() as (out, err):
+            counter = loader.load()
+        self.assertEqual(counter.created, 3)
+        self.assertEqual(counter.rejected, 1)
+        self.assertIn('Error, row 3', out.getvalue())
+        self.assertIn('transform queue depth', counter.metrics)
+        self.assertIn('read stage blocked (s)', counter.metrics)
+        self.assertEqual(TestModel.objects.count(), 3)
+
+
+    def test_delete_missing(self):
+
+        def load(records, extra=u'', **options):
+            content = StringIO(u'record\tname\tnumero\n' + u''.join(
+                u'{0}\tn{0}\tuno\n'.format(record) for record in records) +
+                extra)
+            options['delete_missing'] = True
+            loader = Loader(content, model_class=TestModel, options=options)
+            with captured_output() as (out, err):
+                return loader.load(), out.getvalue()
+
+        load(range(1, 11))
+        counter, out = load(range(1, 10), batch_size=4)
+        self.assertEqual(counter.deleted, 1)
+        self.assertIn('1 deleted', out)
+        self.assertFalse(TestModel.objects.filter(record='10').exists())
+        counter, out = load(range(1, 6))
+        self.assertEqual(counter.deleted, 0)
+        self.assertIn('Deletion aborted', out)
+        self.assertEqual(TestModel.objects.count(), 9)
+        counter, out = load(
+            range(1, 6), delete_threshold=0.5, soft_delete={'zahl': 'x'})
+        self.assertEqual(counter.deleted, 4)
+        self.assertEqual(TestModel.objects.filter(zahl='x').count(), 4)
+        counter, out = load(
+            range(1, 5), extra=u'11\tn11\t\n', delete_threshold=1)
+        self.assertEqual(counter.rejected, 1)
+        self.assertIn('Deletion skipped', out)
+        self.assertEqual(TestModel.objects.count(), 9)
+        self.assertRaises(ValueError, Loader, None, model_class=TestModel,
+                          options={'delete_missing': True,
+                                   'incremental': True})
+
+    def test_delete_missing_without_keys(self):
+        # no persistence criteria, bulk inserts may not return keys
+        TestModelWoFk.objects.create(record='0')
+        content = StringIO(u'record\tname\n1\ta\n2\tb\n3\tc\n')
+        loader = Loader(content, model_class=TestModelWoFk, options={
+            'batch_size': 10, 'delete_missing': True, 'delete_threshold': 1})
+        with captured_output() as (out, err):
+            counter = loader.load()
+        self.assertEqual(counter.created, 3)
+        if connection.features.can_return_ids_from_bulk_insert:
+            self.assertEqual(counter.deleted, 1)
+        else:
+            self.assertEqual(counter.deleted, 0)
+            self.assertIn('Deletion skipped', out.getvalue())
+        self.assertEqual(
+            TestModelWoFk.objects.count(), 4 - counter.deleted)
 
 class TestHeaderlessLoad(TransactionTestCase):
     """
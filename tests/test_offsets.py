@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+
+import csv
+import io
+import json
+import os
+
+from django.test import TestCase, TransactionTestCase
+
+from etl_sync.loaders import Loader
+from etl_sync.offsets import OffsetIndex
+from etl_sync.readers import MmapCSVReader, ParallelCSVReader
+from .models import TestModel
+from .utils import SourceFileMixin, captured_output
+
+
+class TestOffsetIndex(SourceFileMixin, TestCase):
+    filename = 'data.csv'
+
+    def content(self):
+        return (u'record,name\r\n1,"one\r\nuno"\r\n\r\n2,two\r\n'
+                u'3,"th""ree"\r\n4,four\r\n5,"fi\nve"\r\n')
+
+    def test_build(self):
+        index = OffsetIndex(self.path, step=2)
+        index.load()
+        with io.open(self.path, 'rb') as fil:
+            content = fil.read()
+        # blank lines are not counted, the reader skips them
+        self.assertEqual(index.offsets, [
+            0, content.index(b'\r\n2,two'), content.index(b'4,four'),
+            len(content)])
+        self.assertEqual(index.find(3), (2, index.offsets[1]))
+        self.assertEqual(index.find(9), (6, index.offsets[3]))
+        self.assertEqual(index.count, 6)
+        index = OffsetIndex(self.path, step=2, quotechar=None)
+        offsets, count = index.build()
+        self.assertEqual((len(offsets), count), (5, 8))
+
+    def test_stray_quote(self):
+        # a quote within an unquoted field is an ordinary character
+        self.write(u'record\tname\n1\tO"Brien\n2\t"two\nlines"\n'
+                   u'3\tthree\n4\tfour\n')
+        index = OffsetIndex(self.path, step=2, delimiter=u'\t')
+        index.load()
+        with io.open(self.path, 'rb') as fil:
+            content = fil.read()
+        self.assertEqual(index.count, 5)
+        self.assertEqual(index.offsets, [
+            0, content.index(b'2\t'), content.index(b'4\t')])
+
+    def test_sidecar(self):
+        index = OffsetIndex(self.path, step=2)
+        index.load()
+        self.assertTrue(os.path.exists(index.sidecar))
+        reused = OffsetIndex(self.path, step=2)
+        reused.build = None
+        reused.load()
+        self.assertEqual(reused.offsets, index.offsets)
+        with io.open(self.path, 'a') as fil:
+            fil.write(u'6,six\r\n')
+        rebuilt = OffsetIndex(self.path, step=2)
+        rebuilt.build = lambda: ([0], 1)
+        rebuilt.load()
+        self.assertEqual(rebuilt.offsets, [0])
+
+
+class TestSeek(SourceFileMixin, TransactionTestCase):
+
+    def test_slice(self):
+        loader = Loader(self.path, model_class=TestModel, options={
+            'slice_begin': 8, 'offset_index': 3})
+        with captured_output():
+            counter = loader.load()
+        self.assertEqual(loader.extractor.skipped, 5)
+        self.assertEqual(counter.created, 3)
+        self.assertEqual(
+            sorted(TestModel.objects.values_list('record', flat=True)),
+            ['10', '8', '9'])
+        loader = Loader(self.path, model_class=TestModel, options={
+            'slice_begin': 2, 'slice_end': 3, 'offset_index': True})
+        with captured_output():
+            counter = loader.load()
+        self.assertEqual(loader.extractor.skipped, 0)
+        self.assertEqual(counter.created, 2)
+        self.assertEqual(TestModel.objects.get(record='2').name, 'name 2')
+
+    def test_mmap_slice(self):
+
+        class MmapLoader(Loader):
+            reader_class = MmapCSVReader
+            reader_kwargs = {'delimiter': u'\t', 'quoting': csv.QUOTE_NONE,
+                             'columns': ['record', 'numero']}
+
+        loader = MmapLoader(self.path, model_class=TestModel, options={
+            'slice_begin': 8, 'slice_end': 9, 'offset_index': True})
+        with captured_output():
+            counter = loader.load()
+        self.assertEqual(loader.extractor.skipped, 7)
+        self.assertEqual(counter.created, 2)
+        self.assertEqual(
+            sorted(TestModel.objects.values_list('record', 'name')),
+            [('8', None), ('9', None)])
+
+    def test_mmap_step(self):
+
+        class MmapLoader(Loader):
+            reader_class = MmapCSVReader
+            reader_kwargs = {'delimiter': u'\t', 'quoting': csv.QUOTE_NONE}
+
+        loader = MmapLoader(self.path, model_class=TestModel, options={
+            'slice_begin': 8, 'offset_index': 3})
+        with captured_output():
+            counter = loader.load()
+        self.assertEqual(counter.created, 3)
+        with io.open(self.path + OffsetIndex.suffix) as fil:
+            self.assertEqual(json.load(fil)['signature']['step'], 3)
+        self.assertEqual(loader.extractor.reader.buffer, b'')
+
+    def test_parallel_reader(self):
+
+        class RangeLoader(Loader):
+            reader_class = ParallelCSVReader
+            reader_kwargs = {'delimiter': u'\t', 'quoting': csv.QUOTE_NONE,
+                             'workers': 2, 'chunk_size': 32}
+
+        loader = RangeLoader(self.path, model_class=TestModel, options={
+            'slice_begin': 4, 'slice_end': 6, 'offset_index': True})
+        with captured_output():
+            counter = loader.load()
+        self.assertEqual(counter.created, 3)
+        self.assertEqual(
+            sorted(TestModel.objects.values_list('record', flat=True)),
+            ['4', '5', '6'])
+        self.assertIsNone(loader.extractor.reader.pool)
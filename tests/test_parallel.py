@@ -0,0 +1,163 @@
+from __future__ import absolute_import
+
+import fcntl
+import io
+import os
+import tempfile
+from unittest import mock, skipIf
+
+from django.db import IntegrityError, connection, transaction
+from django.test import TestCase, TransactionTestCase
+
+from etl_sync.checkpoints import FileCheckpointStore
+from etl_sync.generators import InstanceGenerator
+from etl_sync.loaders import Loader
+from etl_sync.logging import Counter
+from etl_sync.parallel import ParallelLoader
+from .models import Numero, TestModel
+from .utils import SourceFileMixin, captured_output
+
+
+LOCK_PATH = os.path.join(tempfile.gettempdir(), 'etl_sync_tests.lock')
+
+
+class SerializedLoader(Loader):
+    """
+    SQLite allows a single writer, worker processes write one chunk at
+    a time.
+    """
+
+    def write_batch(self, dics):
+        if connection.vendor != 'sqlite':
+            return super(SerializedLoader, self).write_batch(dics)
+        with open(LOCK_PATH, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return super(SerializedLoader, self).write_batch(dics)
+
+
+class ShardedSourceMixin(SourceFileMixin):
+
+    def record(self, number):
+        return number, u'name %s' % number, u'uno' if number % 2 else u''
+
+
+class TestParallelLoader(ShardedSourceMixin, TestCase):
+
+    def test_shards(self):
+        loader = ParallelLoader(
+            self.path, model_class=TestModel,
+            options={'workers': 2, 'shards': 3})
+        self.assertEqual(loader.get_shards(), [(1, 4), (5, 8), (9, 10)])
+        loader = ParallelLoader(
+            self.path, model_class=TestModel,
+            options={'shards': 2, 'slice_begin': 3, 'slice_end': 20})
+        self.assertEqual(loader.get_shards(), [(3, 6), (7, 10)])
+
+    def test_load(self):
+        loader = ParallelLoader(
+            self.path, model_class=TestModel,
+            options={'workers': 0, 'shards': 3, 'offset_index': 2})
+        with captured_output() as (out, err):
+            counter = loader.load()
+        self.assertEqual(counter.created, 5)
+        self.assertEqual(counter.rejected, 5)
+        self.assertEqual(counter.pos, 11)
+        self.assertEqual(out.getvalue().count('created'), 1)
+        self.assertIn('Error, row 11', out.getvalue())
+        self.assertEqual(TestModel.objects.count(), 5)
+        self.assertEqual(Numero.objects.count(), 1)
+
+    def test_incremental(self):
+        def load(slice_end=None):
+            loader = ParallelLoader(self.path, model_class=TestModel, options={
+                'workers': 0, 'shards': 2, 'chunk_size': 2,
+                'incremental': True, 'slice_end': slice_end})
+            with captured_output():
+                return loader.load()
+
+        def chunks():
+            store = FileCheckpointStore.for_source(self.path, '.etlchunks')
+            return store.load()['chunks']
+
+        self.write(u'record\tname\tnumero\n' + u''.join(
+            u'{0}\tname {0}\tuno\n'.format(number)
+            for number in range(1, 11)))
+        self.assertEqual(load().created, 10)
+        # three chunks per shard, fingerprints of both shards are saved
+        self.assertEqual(len(chunks()), 6)
+        counter = load()
+        self.assertEqual(counter.metrics['unchanged chunks skipped'], 6)
+        self.assertEqual(counter.created + counter.unchanged, 0)
+        with io.open(self.path, 'a') as fil:
+            fil.write(u'11\tname 11\tuno\n')
+        # shards move, stale fingerprints are dropped
+        self.assertEqual(load().created, 1)
+        self.assertEqual(len(chunks()), 6)
+        # a slice adds its chunks to those of the previous run
+        load(slice_end=3)
+        self.assertEqual(len(chunks()), 7)
+
+    def test_merge(self):
+        counter = Counter()
+        other = Counter()
+        other.created = 2
+        other.pos = 5
+        other.metrics['related cache hits'] = 3
+        counter.merge(other)
+        counter.merge(other)
+        self.assertEqual(counter.created, 4)
+        self.assertEqual(counter.pos, 5)
+        self.assertEqual(counter.metrics['related cache hits'], 6)
+
+
+@skipIf(connection.vendor == 'sqlite' and connection.is_in_memory_db(),
+        'Worker processes cannot share an in-memory database.')
+class TestWorkers(ShardedSourceMixin, TransactionTestCase):
+
+    def test_load(self):
+        loader = ParallelLoader(
+            self.path, loader_class=SerializedLoader, model_class=TestModel,
+            options={'workers': 2, 'shards': 4, 'chunk_size': 2})
+        with captured_output():
+            counter = loader.load()
+        self.assertEqual(counter.created, 5)
+        self.assertEqual(counter.rejected, 5)
+        self.assertEqual(counter.pos, 11)
+        self.assertEqual(TestModel.objects.count(), 5)
+        # shared by all shards
+        self.assertEqual(Numero.objects.count(), 1)
+
+
+class TestConcurrentGeneration(TestCase):
+
+    def test_conflicting_lookup(self):
+        # created by another process after the lookup
+        Numero.objects.create(name='uno')
+        lookup = InstanceGenerator.get_from_db
+        calls = []
+
+        def get_from_db(generator, dic, persistence):
+            calls.append(generator.model_class)
+            if len(calls) == 1:
+                return Numero.objects.none()
+            return lookup(generator, dic, persistence)
+
+        generator = InstanceGenerator(
+            TestModel, options={'concurrent': True})
+        with mock.patch.object(InstanceGenerator, 'get_from_db',
+                               get_from_db):
+            instance = generator.get_instance(
+                {'record': '1', 'numero': 'uno'})
+        self.assertEqual(calls[:2], [Numero, Numero])
+        self.assertEqual(instance.numero.name, 'uno')
+        self.assertEqual(Numero.objects.count(), 1)
+
+    def test_rolled_back_with_parent(self):
+        # related records are written in the caller's transaction
+        generator = InstanceGenerator(
+            TestModel, options={'concurrent': True})
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                generator.get_instance({'record': '1', 'numero': 'uno'})
+                raise IntegrityError
+        self.assertEqual(Numero.objects.count(), 0)
@@ -0,0 +1,45 @@
+from __future__ import absolute_import
+
+from unittest import TestCase
+
+from etl_sync.pipeline import Pipeline
+
+
+class TestPipeline(TestCase):
+
+    def test_stages(self):
+        pipeline = Pipeline(2)
+        try:
+            blocks = pipeline.stage('read', ([i] for i in range(10)))
+            blocks = pipeline.stage(
+                'double', ([2 * i for i in block] for block in blocks))
+            self.assertEqual(
+                [i for block in blocks for i in block],
+                list(range(0, 20, 2)))
+        finally:
+            pipeline.close()
+        metrics = pipeline.get_metrics()
+        self.assertEqual(list(metrics)[:3], [
+            'read queue depth', 'read stage blocked (s)',
+            'read stage awaited (s)'])
+
+    def test_error(self):
+        def fail():
+            yield [1]
+            raise ValueError('broken')
+
+        pipeline = Pipeline(2)
+        try:
+            blocks = pipeline.stage('read', fail())
+            blocks = pipeline.stage('copy', (block for block in blocks))
+            with self.assertRaises(ValueError):
+                list(blocks)
+        finally:
+            pipeline.close()
+
+    def test_close(self):
+        pipeline = Pipeline(1)
+        blocks = pipeline.stage('read', ([i] for i in range(1000)))
+        next(blocks)
+        pipeline.close()
+        self.assertFalse(any(stage.is_alive() for stage in pipeline.stages))
@@ -3,9 +3,15 @@ from __future__ import absolute_import
 from six import text_type
 from future.utils import iteritems
 
+import csv
+import gzip
+import io
 import os
 from unittest import TestCase
-from etl_sync.readers import unicode_dic, OGRReader
+from etl_sync.readers import (
+    unicode_dic, CSVReader, MmapCSVReader, ParallelCSVReader, OGRReader)
+from etl_sync.transformations import Transformer
+from .utils import SourceFileMixin
 
 
 class TestReaders(TestCase):
@@ -25,9 +31,203 @@ class TestReaders(TestCase):
         for k, v in iteritems(dic):
             self.assertIsInstance(k, text_type)
 
+    def test_csv_reader(self):
+        reader = CSVReader(io.StringIO(
+            u'a\tb\ta\n1\t2\t3\n\n4\n5\t6\t7\t8\n'), delimiter=u'\t')
+        self.assertEqual(reader.fieldnames, ['a', 'b', 'a'])
+        rows = list(reader)
+        self.assertEqual(len(rows), 3)
+        self.assertEqual(rows[0].copy(), {'a': '3', 'b': '2'})
+        self.assertEqual(rows[1]['b'], None)
+        self.assertEqual(dict(rows[2]), {'a': '7', 'b': '6'})
+        self.assertIn('b', rows[2])
+        self.assertNotIn('c', rows[2])
+        self.assertIs(type(rows[0]), type(rows[2]))
+
+        class Remap(Transformer):
+            mappings = {'c': 'a'}
+
+        transformer = Remap(rows[0])
+        self.assertTrue(transformer.is_valid())
+        self.assertEqual(transformer.cleaned_data, {'b': '2', 'c': '3'})
+        with self.assertRaises(TypeError):
+            rows[0]['a'] = '4'
+
+    def test_csv_reader_errors(self):
+        reader = CSVReader(io.StringIO(u'a,b\n"1"x,2\n'), strict=True)
+        self.assertRaises(csv.Error, reader.next)
+        reader = CSVReader(io.StringIO(u''))
+        self.assertRaises(StopIteration, reader.next)
+
     def test_ogr_reader(self):
         reader = OGRReader(self.testfilename)
         dic = reader.next()
         self.assertEqual(dic['text'], u'three')
         dic = reader.next()
         self.assertEqual(dic['text'], u'two')
+
+    def test_ogr_reader_seek(self):
+        reader = OGRReader(self.testfilename)
+        self.assertEqual(reader.seek(1), 1)
+        dic = reader.next()
+        self.assertEqual(dic['text'], u'two')
+
+    def test_ogr_reader_wkb(self):
+        from osgeo import ogr
+        wkt = OGRReader(self.testfilename).next()['geometry']
+        reader = OGRReader(self.testfilename, wkb=True, flatten=True)
+        wkb = reader.next()['geometry']
+        self.assertIsInstance(wkb, bytes)
+        geom = ogr.CreateGeometryFromWkb(wkb)
+        self.assertEqual(geom.GetCoordinateDimension(), 2)
+        self.assertEqual(
+            geom.ExportToWkt(), ogr.CreateGeometryFromWkt(wkt).ExportToWkt())
+
+
+class TestMmapCSVReader(SourceFileMixin, TestCase):
+    filename = 'data.csv'
+
+    def content(self):
+        return (u'record,name,text\r\n1,"one\r\nuno",a\r\n\r\n'
+                u'2,two,b\r\n3,"th""ree",\u00e4\r\n4,four\r\n'
+                u'5,"fi,ve",e')
+
+    def test_read(self):
+        with io.open(self.path, newline='', encoding='utf-8') as fil:
+            expected = [row.copy() for row in CSVReader(fil)]
+        with io.open(self.path) as fil:
+            reader = MmapCSVReader(fil)
+            self.assertEqual(reader.fieldnames, ['record', 'name', 'text'])
+            self.assertEqual([row.copy() for row in reader], expected)
+        for block_size in (1, 7, 16):
+            reader = MmapCSVReader(self.path, block_size=block_size)
+            self.assertEqual([row.copy() for row in reader], expected)
+        reader = MmapCSVReader(self.path, columns=['text', 'record'])
+        rows = list(reader)
+        self.assertEqual(rows[2].copy(), {'record': '3', 'text': u'\u00e4'})
+        self.assertNotIn('name', rows[0])
+        self.assertEqual(rows[3]['text'], None)
+
+    def test_stray_quote(self):
+        self.write(u'record\tname\n1\tO"Brien\n2\t"two\nlines"\n'
+                   u'3\t5" x\n4\t"fo""ur"x"\n5\t"five"\n')
+        with io.open(self.path, newline='', encoding='utf-8') as fil:
+            expected = [row.copy() for row in CSVReader(
+                fil, delimiter=u'\t')]
+        self.assertEqual(len(expected), 5)
+        for block_size in (1, 7, 1 << 20):
+            reader = MmapCSVReader(
+                self.path, delimiter=u'\t', block_size=block_size)
+            self.assertEqual([row.copy() for row in reader], expected)
+        reader = ParallelCSVReader(
+            self.path, workers=0, chunk_size=8, delimiter=u'\t')
+        self.assertEqual([row.copy() for row in reader], expected)
+
+    def test_seek(self):
+        reader = MmapCSVReader(self.path)
+        self.assertEqual(reader.seek(3), 3)
+        self.assertEqual(reader.next()['record'], '4')
+        self.assertTrue(os.path.exists(self.path + '.etlidx'))
+        reader = MmapCSVReader(self.path)
+        self.assertEqual(reader.seek(10), 5)
+        self.assertRaises(StopIteration, reader.next)
+
+    def test_close(self):
+        with MmapCSVReader(self.path) as reader:
+            buffer = reader.buffer
+            self.assertEqual(reader.next()['record'], '1')
+        self.assertTrue(buffer.closed)
+        self.assertRaises(StopIteration, reader.next)
+        reader = ParallelCSVReader(self.path, workers=0)
+        buffer = reader.reader.buffer
+        reader.close()
+        self.assertTrue(buffer.closed)
+
+    def test_byte_range(self):
+        with io.open(self.path, 'rb') as fil:
+            content = fil.read()
+        start = content.index(b'2,two')
+        reader = MmapCSVReader(
+            self.path, byte_range=(start, content.index(b'4,four')))
+        self.assertEqual(
+            [row['record'] for row in reader], ['2', '3'])
+        reader = MmapCSVReader(
+            self.path, fieldnames=['a', 'b', 'c'], quoting=csv.QUOTE_NONE,
+            byte_range=(content.index(b'4,four'), len(content)))
+        self.assertEqual([row['b'] for row in reader], ['four', '"fi'])
+
+    def test_compressed(self):
+        path = os.path.join(self.directory, 'data.csv.gz')
+        with gzip.open(path, 'wb') as fil:
+            fil.write(b'record\n1\n')
+        self.assertRaises(ValueError, MmapCSVReader, path)
+
+
+class TestParallelCSVReader(SourceFileMixin, TestCase):
+    filename = 'data.csv'
+
+    def setUp(self):
+        super(TestParallelCSVReader, self).setUp()
+        with io.open(self.path, newline='', encoding='utf-8') as fil:
+            self.expected = [row.copy() for row in CSVReader(fil)]
+
+    def content(self):
+        return u'record,name\n' + u''.join(
+            u'{0},"name\n{0}"\n'.format(number) for number in range(1, 51))
+
+    def test_ranges(self):
+        reader = ParallelCSVReader(self.path, workers=0, chunk_size=10)
+        with io.open(self.path, 'rb') as fil:
+            content = fil.read()
+        ranges = list(reader.ranges())
+        self.assertEqual(ranges[0], (12, content.index(b'2,')))
+        for start, end in ranges[1:]:
+            self.assertEqual(content[start - 2:start], b'"\n')
+
+    def test_ranges_stray_quote(self):
+        # a quote within an unquoted field is an ordinary character
+        self.write(u'record\tname\n' + u''.join(
+            u'{0}\t{1}\n'.format(number, u'O"Brien' if number == 5 else u'x')
+            for number in range(1, 201)))
+        with io.open(self.path, 'rb') as fil:
+            content = fil.read()
+        reader = ParallelCSVReader(
+            self.path, workers=0, chunk_size=100, delimiter=u'\t')
+        ranges = list(reader.ranges())
+        self.assertGreater(len(ranges), 10)
+        for start, end in ranges:
+            self.assertEqual(content[start - 1:start], b'\n')
+
+    def test_read(self):
+        for workers in (0, 2):
+            reader = ParallelCSVReader(
+                self.path, workers=workers, chunk_size=40)
+            self.assertEqual([row.copy() for row in reader], self.expected)
+            self.assertIsNone(reader.pool)
+        reader = ParallelCSVReader(
+            self.path, workers=2, chunk_size=40, ordered=False,
+            columns=['record'])
+        self.assertEqual(
+            sorted(int(row['record']) for row in reader), list(range(1, 51)))
+
+    def test_seek(self):
+        reader = ParallelCSVReader(self.path, workers=2, chunk_size=40)
+        self.assertEqual(reader.seek(45), 45)
+        self.assertEqual([row['record'] for row in reader],
+                         ['46', '47', '48', '49', '50'])
+
+    def test_errors(self):
+        with io.open(self.path, 'a') as fil:
+            fil.write(u'51,"fi"x\n52,y\n')
+        reader = ParallelCSVReader(
+            self.path, workers=2, chunk_size=40, strict=True)
+        records = []
+        while True:
+            try:
+                records.append(reader.next()['record'])
+            except csv.Error:
+                records.append(None)
+            except StopIteration:
+                break
+        self.assertEqual(records[-3:], ['50', None, '52'])
+        reader.close()
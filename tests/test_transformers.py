@@ -52,6 +52,14 @@ class TestTransformer(TestCase):
         self.assertEqual(res['third_field'], 'text')
         self.assertNotIn('TEST', res)
         self.assertNotIn('another_field', res)
+        self.assertIn('TEST', dic)
+
+    def test_chained_remap(self):
+        transformer = Transformer({'a': 1, 'b': 2, 'c': 3})
+        transformer.mappings = {'b': 'c', 'a': 'b'}
+        # mappings are applied in turn, the second removes the target of
+        # the first
+        self.assertEqual(transformer.remap(transformer.dic), {'a': 2})
 
     def test_blacklist(self):
         dic = {'test': 'something', 'another_field': 'rubish and something'}
@@ -1,4 +1,8 @@
+import io
+import os
+import shutil
 import sys
+import tempfile
 from contextlib import contextmanager
 from six import StringIO
 
@@ -14,3 +18,33 @@ def captured_output():
         yield sys.stdout, sys.stderr
     finally:
         sys.stdout, sys.stderr = old_out, old_err
+
+
+class SourceFileMixin(object):
+    """
+    Writes a source file to a temporary directory, which is removed after
+    each test. The default source is tab-delimited with a header and
+    records 1 to size, override content or record for others.
+    """
+    filename = 'data.txt'
+    size = 10
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, self.filename)
+        self.write()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def record(self, number):
+        return number, u'name {}'.format(number), u'uno'
+
+    def content(self):
+        return u'record\tname\tnumero\n' + u''.join(
+            u'{}\t{}\t{}\n'.format(*self.record(number))
+            for number in range(1, self.size + 1))
+
+    def write(self, content=None):
+        with io.open(self.path, 'w', newline='', encoding='utf-8') as fil:
+            fil.write(self.content() if content is None else content)